@@ -0,0 +1,43 @@
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Dict
+
+from fastapi import Request, Response
+
+
+def validators(version: int, updated_at: datetime, *variant) -> Dict[str, str]:
+    """Заголовки ETag и Last-Modified записи.
+
+    Время изменения входит в ETag, поэтому запись, созданная заново с прежним id, не совпадет со старой.
+    variant различает представления одной записи, например с питомцами и без.
+    """
+    updated_at = updated_at.replace(tzinfo=timezone.utc)
+    tag = "-".join(map(str, (*variant, version, int(updated_at.timestamp() * 1000000))))
+    return {"etag": f'"{tag}"', "last-modified": format_datetime(updated_at, usegmt=True)}
+
+
+def is_conditional(request: Request) -> bool:
+    return "if-none-match" in request.headers or "if-modified-since" in request.headers
+
+
+def not_modified(request: Request, headers: Dict[str, str]) -> bool:
+    """Проверяет If-None-Match, а без него - If-Modified-Since."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in tags or headers["etag"] in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        # Last-Modified передается с точностью до секунды
+        return parsedate_to_datetime(headers["last-modified"]) <= since
+    return False
+
+
+def not_modified_response(headers: Dict[str, str]) -> Response:
+    return Response(status_code=304, headers=headers)
@@ -1,13 +1,41 @@
-from db.database import SessionLocal
+from fastapi import Request, Response
+from sqlalchemy.orm import sessionmaker
+
+from config.settings import settings
+from db.database import AsyncSessionLocal, ReadSessionLocal
 from repositories.logs import logger
 
+READ_PRIMARY_HEADER = "X-Read-Primary"
+READ_PRIMARY_COOKIE = "read_primary"
+
 
-def get_db():
-    db = SessionLocal()
+async def get_db(response: Response):
+    """Сессия пула записи."""
+    if settings.read_database_url and settings.read_primary_after_write > 0:
+        # Реплика может еще не получить эту запись: какое-то время клиент читает из основной базы
+        response.set_cookie(READ_PRIMARY_COOKIE, "1", max_age=max(int(settings.read_primary_after_write), 1),
+                            httponly=True)
+    db = AsyncSessionLocal()
     logger.debug("Соединение с базой данных открыто")
     try:
         yield db
     finally:
-        db.close()
+        await db.close()
         logger.debug("Соединение с базой данных закрыто")
 
+
+def read_session_factory(request: Request) -> sessionmaker:
+    """Пул чтения, а для запросов, которым нужны собственные записи клиента, - пул записи."""
+    if request.headers.get(READ_PRIMARY_HEADER) == "1" or READ_PRIMARY_COOKIE in request.cookies:
+        return AsyncSessionLocal
+    return ReadSessionLocal
+
+
+async def get_read_db(request: Request):
+    db = read_session_factory(request)()
+    logger.debug("Соединение с базой данных открыто")
+    try:
+        yield db
+    finally:
+        await db.close()
+        logger.debug("Соединение с базой данных закрыто")
@@ -1,14 +1,22 @@
-import uvicorn
-from fastapi import Depends, FastAPI
+from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse, PlainTextResponse
 
-from api.dependencies import get_db
+from api.middleware import SQLTimingMiddleware
 from api.pets import router_pet, router_pets
 from api.users import router_user, router_users
-from db.database import Base
-from db.database import engine
-
-Base.metadata.create_all(bind=engine)
+from config.settings import settings
+from db.database import async_engine, read_engine
+from db.instrumentation import install_sql_instrumentation
+from db.shards import pet_shards
+from repositories.cache import read_cache
+from repositories.crud import pet_counts_batcher
+from repositories.email_validation import domain_checker
+from repositories.group_commit import pet_insert_batcher
+from repositories.metrics import metrics
+from repositories.passwords import password_hasher
 
+# Схема базы создается и обновляется один раз до запуска рабочих процессов (main.py, prestart),
+# импорт приложения базу не затрагивает
 app = FastAPI(
     title="Тестовое API",
     description="Пятая версия приложения",
@@ -16,13 +24,74 @@ app = FastAPI(
     license_info={
         "name": "Допустим под лицензией Apache 2.0",
         "url": "https://www.apache.org/licenses/LICENSE-2.0.html"},
-    dependencies=[Depends(get_db)]
+    default_response_class=ORJSONResponse
 )
 
+if settings.sql_instrumentation_enabled:
+    # Для базы в памяти пул чтения - тот же движок, что и пул записи
+    for instrumented_engine in {async_engine, read_engine, *pet_shards.engines, *pet_shards.read_engines}:
+        install_sql_instrumentation(instrumented_engine.sync_engine)
+    app.add_middleware(SQLTimingMiddleware)
+
+
+@app.on_event("startup")
+async def open_db_connections():
+    # Первое соединение пула инициализирует диалект под блокировкой потока. Если в это время второй запрос
+    # того же событийного цикла тоже открывает соединение, он ждет блокировку, останавливая весь цикл,
+    # поэтому первое соединение каждого пула открывается до приема запросов
+    for pool_engine in {async_engine, read_engine, *pet_shards.engines, *pet_shards.read_engines}:
+        async with pool_engine.connect():
+            pass
+
+
+@app.on_event("shutdown")
+async def close_db_connections():
+    await pet_insert_batcher.close()
+    await pet_counts_batcher.close()
+    password_hasher.close()
+    # Пул держит соединения aiosqlite в отдельных потоках, без закрытия процесс не завершится
+    await async_engine.dispose()
+    await read_engine.dispose()
+    await pet_shards.dispose()
+
+
 app.include_router(router_user)
 app.include_router(router_users)
 app.include_router(router_pet)
 app.include_router(router_pets)
 
-if __name__ == '__main__':
-    uvicorn.run(app, host="0.0.0.0", port=8006)
+if settings.metrics_enabled:
+    metrics.instrument_routes(app.routes)
+
+
+def collect_runtime_stats():
+    """Загрузка пулов соединений и счетчики кэшей, групповой записи и хеширования паролей для выгрузки метрик."""
+    values = {}
+    for name, pool_engine in (("write", async_engine), ("read", read_engine)):
+        pool = pool_engine.pool
+        if not hasattr(pool, "checkedout"):
+            # StaticPool базы в памяти: одно соединение, общее для обоих пулов
+            continue
+        label = f'pool="{name}"'
+        values.update({
+            ("db_pool_size", label): pool.size(),
+            ("db_pool_checked_out", label): pool.checkedout(),
+            ("db_pool_overflow", label): max(pool.overflow(), 0),
+            ("db_pool_max_connections", label): pool.size() + max(pool._max_overflow, 0)
+        })
+    for name, stats in (("read", read_cache.stats()), ("email_domain", domain_checker.stats())):
+        values.update({(f"cache_{key}", f'cache="{name}"'): value for key, value in stats.items()})
+    values.update({(f"pet_group_commit_{key}", ""): value for key, value in pet_insert_batcher.stats().items()})
+    if pet_shards.enabled:
+        values.update({(f"pet_count_group_commit_{key}", ""): value
+                       for key, value in pet_counts_batcher.stats().items()})
+    values.update({(f"password_hash_{key}", ""): value for key, value in password_hasher.stats().items()})
+    return values
+
+
+metrics.collectors.append(collect_runtime_stats)
+
+
+@app.get("/metrics", include_in_schema=False, response_class=PlainTextResponse)
+async def show_metrics():
+    return metrics.render()
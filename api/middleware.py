@@ -0,0 +1,40 @@
+from time import perf_counter
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from db.instrumentation import QueryStats, current_query_stats
+
+
+class SQLTimingMiddleware:
+    """Добавляет к ответу заголовок Server-Timing с числом и временем SQL-запросов и временем обработки.
+
+    db - суммарное время SQL-запросов и их число, db-slowest - самый долгий запрос,
+    app - время обработки без учета SQL.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = QueryStats()
+        token = current_query_stats.set(stats)
+        started = perf_counter()
+
+        async def send_with_timing(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                handler_time = perf_counter() - started
+                header = (
+                    f'db;desc="queries={stats.count}";dur={stats.total_time * 1000:.2f}, '
+                    f"db-slowest;dur={stats.slowest_time * 1000:.2f}, "
+                    f"app;dur={max(handler_time - stats.total_time, 0) * 1000:.2f}"
+                )
+                message.setdefault("headers", []).append((b"server-timing", header.encode("latin-1")))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current_query_stats.reset(token)
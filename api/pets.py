@@ -1,130 +1,207 @@
-from typing import List
-from sqlalchemy.orm import Session
-from fastapi import Depends, Path, Query, APIRouter, HTTPException
-
-from api.dependencies import get_db
+from typing import List, Optional
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+from fastapi import Body, Depends, Path, Query, APIRouter, Request
+from fastapi.responses import ORJSONResponse
+
+from api import conditional
+from api.dependencies import get_db, get_read_db, read_session_factory
+from config.settings import settings
 from models.pets import PetModel
+from models.users import UserModel
 from repositories import crud
+from repositories.export import export_response
+from repositories.group_commit import pet_insert_batcher
 from repositories.logs import logger
-from schemas.pets import PetCreate, PetSchemas
+from schemas.base_schemas import BatchResult, BulkResult, Count, Detail, Page, PetsDeleteResult
+from schemas.pets import PetBulkCreate, PetCreate, PetSchemas
 
 
-router_pet = APIRouter(
-    prefix="/pet",
-    tags=["Pet Operations"],
-    dependencies=[Depends(get_db)]
-)
-router_pets = APIRouter(
-    prefix="/pets",
-    tags=["Pet Operations"],
-    dependencies=[Depends(get_db)]
-)
+router_pet = APIRouter(prefix="/pet", tags=["Pet Operations"])
+router_pets = APIRouter(prefix="/pets", tags=["Pet Operations"])
 
 
 # POST
-@router_pet.post("/{user_id}/")
+@router_pet.post("/{user_id}/", response_model=Detail)
 async def create_pet_for_user(
         pet: PetCreate,
         user_id: int = Path(..., description="Пользовательский id"),
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_db)
 ):
-    logger.info(f'Попытка добавления питомца по кличке "{pet.animal_name}" пользователю с id = "{user_id}"')
-    user = crud.get_user(user_id, db)
-    crud.check_for_existence_in_db(user, f"Пользователь с id {user_id} не найден")
-    all_pets_from_user = crud.get_all_pets_from_user(user_id, db)
-    for users_pet in all_pets_from_user:
-        if pet.animal_name == users_pet.animal_name and pet.description == users_pet.description:
-            status_code, detail = 400, f"У пользователя с id {user_id} уже есть питомец с такой кличкой и описанием"
-            logger.warning(f"{status_code} {detail}")
-            raise HTTPException(status_code, detail)
-    crud.create_user_pet(pet, user_id, db)
+    logger.info('Попытка добавления питомца по кличке "%s" пользователю с id = "%s"', pet.animal_name, user_id)
+    if settings.pet_group_commit_enabled:
+        # Существование хозяина и дубликаты проверяются при записи порции, ошибки приходят как HTTPException
+        try:
+            await pet_insert_batcher.submit(pet, user_id)
+        except IntegrityError as match:
+            crud.checking_for_matches_in_db(match, "Питомец был добавлен параллельно, повторите запрос",
+                                            status_code=409)
+        return {"detail": "Питомец добавлен"}
+    user_exists = await crud.entry_exists(UserModel, db, UserModel.id == user_id)
+    crud.check_for_existence_in_db(user_exists, f"Пользователь с id {user_id} не найден")
+    try:
+        await crud.create_user_pet(pet, user_id, db)
+    except IntegrityError as match:
+        crud.checking_for_matches_in_db(match, f"У пользователя с id {user_id} уже есть питомец "
+                                               f"с такой кличкой и описанием")
     return {"detail": "Питомец добавлен"}
 
 
+@router_pets.post("/bulk", response_model=BulkResult)
+async def create_pets(
+        new_pets: List[PetBulkCreate] = Body(..., min_items=1, max_items=settings.bulk_max_items),
+        db: AsyncSession = Depends(get_db)
+):
+    logger.info("Попытка массового добавления питомцев: %s", len(new_pets))
+    try:
+        results = await crud.create_pets(new_pets, db)
+    except IntegrityError as match:
+        crud.checking_for_matches_in_db(match, "Питомцы из запроса были добавлены параллельно, "
+                                               "повторите запрос", status_code=409)
+    return {"created": sum(item["status_code"] == 201 for item in results), "items": results}
+
+
 # GET
 @router_pet.get("/", response_model=PetSchemas)
 async def show_pet(
         pet_id: int = Query(..., description="id питомца"),
         owner_id: int = Query(..., description="Пользовательский id"),
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_read_db)
 ):
-    logger.info(f"Попытка отобразить информацию о питомце по id хозяина = {owner_id} и id животного = {pet_id}")
-    pet = crud.get_pet(owner_id, pet_id, db)
+    logger.info("Попытка отобразить информацию о питомце по id хозяина = %s и id животного = %s", owner_id, pet_id)
+    pet = await crud.get_pet(owner_id, pet_id, db, cached=True)
     crud.check_for_existence_in_db(pet, f"Питомец по id хозяина = {owner_id} и id животного = {pet_id} не найден")
-    logger.info(f"Информация о питомце по id хозяина = {owner_id} и id животного = {pet_id} предоставлена")
+    logger.info("Информация о питомце по id хозяина = %s и id животного = %s предоставлена", owner_id, pet_id)
     return pet
 
 
-@router_pets.get("/{user_id}/")
+@router_pets.get("/{user_id}/", response_model=List[PetSchemas])
 async def show_pets_of_user(
+        request: Request,
         user_id: int = Path(..., description="Пользовательский id"),
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_read_db)
 ):
-    logger.info(f"Попытка отобразить всех питомцев пользователя с id = {user_id}")
-    pets_of_user = crud.get_all_pets_from_user(user_id, db)
-    crud.check_for_existence_in_db(pets_of_user, f"У пользователя с id = {user_id} нет питомцев "
-                                                 f"или пользователя с таким id не существует")
-    logger.info(f"Информация о питомцах пользователя с id = {user_id} предоставлена")
-    return pets_of_user
-
-
-@router_pets.get("/", response_model=List[PetSchemas])
+    logger.info("Попытка отобразить всех питомцев пользователя с id = %s", user_id)
+    missing = f"У пользователя с id = {user_id} нет питомцев или пользователя с таким id не существует"
+    # Версия хозяина увеличивается при любом изменении его питомцев, включая удаление,
+    # поэтому вместе с их числом она описывает список без чтения самих питомцев
+    version = await crud.get_user_version(user_id, db, cached=True)
+    crud.check_for_existence_in_db(version and version.pet_count, missing)
+    headers = conditional.validators(version.version, version.updated_at, "pets", user_id, version.pet_count)
+    if conditional.not_modified(request, headers):
+        return conditional.not_modified_response(headers)
+    pets_of_user = await crud.get_all_pets_from_user(user_id, db, cached=True)
+    crud.check_for_existence_in_db(pets_of_user, missing)
+    logger.info("Информация о питомцах пользователя с id = %s предоставлена", user_id)
+    return ORJSONResponse(pets_of_user, headers=headers)
+
+
+@router_pets.get("/", response_model=Page[PetSchemas])
 async def show_all_pets(
-        skip: int = Query(0, description="Сколько записей пропустить"),
-        limit: int = Query(100, description="Максимальное число отображаемых записей"),
-        db: Session = Depends(get_db)
+        cursor: Optional[str] = Query(None, description="Курсор страницы из next_cursor предыдущего ответа"),
+        limit: int = Query(100, ge=1, description="Максимальное число отображаемых записей"),
+        db: AsyncSession = Depends(get_read_db)
 ):
     logger.info("Попытка отобразить всех питомцев в магазине")
-    all_pets = crud.get_entries(PetModel, db, skip, limit)
-    crud.check_for_existence_in_db(all_pets, "База данных питомцев пуста")
+    all_pets, next_cursor = await crud.get_rows_page(PetModel, db, cursor, limit, cached=True)
+    if cursor is None:
+        crud.check_for_existence_in_db(all_pets, "База данных питомцев пуста")
     logger.info("Информация о всех питомцах в магазине предоставлена")
-    return all_pets
+    return ORJSONResponse({"items": all_pets, "next_cursor": next_cursor})
+
+
+@router_pets.get("/count", response_model=Count)
+async def count_pets(
+        owner_id: Optional[int] = Query(None, description="Считать только питомцев пользователя"),
+        db: AsyncSession = Depends(get_read_db)
+):
+    if owner_id is None:
+        return {"count": await crud.count_entries(PetModel, db, cached=True)}
+    return {"count": await crud.count_entries(PetModel, db, PetModel.owner_id == owner_id)}
+
+
+@router_pets.get("/batch", response_model=BatchResult[PetSchemas])
+async def show_pets_by_ids(
+        ids: List[int] = Query(..., min_items=1, max_items=settings.bulk_max_items, description="id питомцев"),
+        owner_id: Optional[int] = Query(None, description="Искать только среди питомцев пользователя"),
+        db: AsyncSession = Depends(get_read_db)
+):
+    logger.info("Попытка отобразить питомцев по списку id: %s", len(ids))
+    pets = await crud.get_rows_by_ids(PetModel, ids, db, owner_id=owner_id)
+    return ORJSONResponse({
+        "items": [pets.get(pet_id) for pet_id in ids],
+        "missing": [pet_id for pet_id in ids if pet_id not in pets]
+    })
+
+
+@router_pets.get("/search", response_model=Page[PetSchemas])
+async def search_pets(
+        q: str = Query(..., min_length=1, description="Слова из клички или описания питомца"),
+        owner_id: Optional[int] = Query(None, description="Искать только среди питомцев пользователя"),
+        prefix: bool = Query(True, description="Последнее слово может быть началом слова"),
+        cursor: Optional[str] = Query(None, description="Курсор страницы из next_cursor предыдущего ответа"),
+        limit: int = Query(100, ge=1, description="Максимальное число отображаемых записей"),
+        db: AsyncSession = Depends(get_read_db)
+):
+    logger.info('Поиск питомцев по запросу "%s"', q)
+    found_pets, next_cursor = await crud.search_pets(q, db, owner_id, prefix, cursor, limit, cached=True)
+    return ORJSONResponse({"items": found_pets, "next_cursor": next_cursor})
+
+
+@router_pets.get("/export")
+async def export_pets(
+        export_format: str = Query("ndjson", alias="format", regex="^(ndjson|csv)$",
+                                   description="Формат выгрузки: ndjson или csv"),
+        session_factory: sessionmaker = Depends(read_session_factory)
+):
+    logger.info("Выгрузка питомцев в формате %s", export_format)
+    columns = [PetModel.id, PetModel.animal_name, PetModel.description, PetModel.owner_id]
+    return export_response(columns, export_format, settings.export_chunk_size, "pets", session_factory)
 
 
 # PUT
-@router_pet.put("/{pet_id}/{owner_id}/")
+@router_pet.put("/{pet_id}/{owner_id}/", response_model=Detail)
 async def change_pet(
         pet_id: int = Path(..., description="id питомца"),
         owner_id: int = Path(..., description="id пользователя"),
         new_animal_name: str = Query(..., description="Измененная кличка"),
         new_description: str = Query(..., description="Измененное описание"),
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_db)
 ):
-    logger.info(f"Попытка изменить информацию о питомце по id хозяина = {owner_id} и id животного = {pet_id}")
-    user = crud.get_user(owner_id, db)
-    crud.check_for_existence_in_db(user, f"Пользователь с id {owner_id} не найден")
-    user = crud.get_pet(owner_id, pet_id, db)
-    crud.check_for_existence_in_db(user, f"Питомец с таким id у данного пользователя не найден")
-    modified_pet = crud.get_pets_by_animal_name_and_description(new_animal_name, new_description, db)
-    crud.checking_for_matches_in_db(modified_pet, "У пользователя уже есть питомец с такой кличкой и описанием")
-    pet = crud.get_pet(owner_id, pet_id, db)
-    crud.put_pet(pet, new_animal_name, new_description, db)
+    logger.info("Попытка изменить информацию о питомце по id хозяина = %s и id животного = %s", owner_id, pet_id)
+    user_exists = await crud.entry_exists(UserModel, db, UserModel.id == owner_id)
+    crud.check_for_existence_in_db(user_exists, f"Пользователь с id {owner_id} не найден")
+    pet = await crud.get_pet(owner_id, pet_id, db)
+    crud.check_for_existence_in_db(pet, f"Питомец с таким id у данного пользователя не найден")
+    try:
+        await crud.put_pet(pet, new_animal_name, new_description, db)
+    except IntegrityError as match:
+        crud.checking_for_matches_in_db(match, "У пользователя уже есть питомец с такой кличкой и описанием")
     return {"detail": "Данные питомца изменены"}
 
 
 # DELETE
-@router_pet.delete("/{pet_id}/{owner_id}/")
+@router_pet.delete("/{pet_id}/{owner_id}/", response_model=PetsDeleteResult)
 async def delete_pet(
         pet_id: int = Path(..., description="id питомца"),
         owner_id: int = Path(..., description="id пользователя"),
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_db)
 ):
-    logger.info(f"Попытка удаления питомца по id хозяина = {owner_id} и id животного = {pet_id}")
-    pet_to_be_deleted = crud.get_pet(owner_id, pet_id, db)
-    crud.check_for_existence_in_db(pet_to_be_deleted,
+    logger.info("Попытка удаления питомца по id хозяина = %s и id животного = %s", owner_id, pet_id)
+    deleted_pets = await crud.delete_user_pet(owner_id, pet_id, db)
+    crud.check_for_existence_in_db(deleted_pets,
                                    f"Питомец с id хозяина = {owner_id} и id животного = {pet_id} не найден")
-    crud.delete_entry(pet_to_be_deleted, db)
-    return {"detail": "Питомец удален"}
+    return {"detail": "Питомец удален", "deleted": {"pets": deleted_pets}}
 
 
-@router_pets.delete("/{owner_id}/")
+@router_pets.delete("/{owner_id}/", response_model=PetsDeleteResult)
 async def deleting_all_pets_from_user(
         owner_id: int = Path(..., description="id пользователя"),
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_db)
 ):
-    logger.info(f"Попытка удаления все питомцев у пользователя с id = {owner_id}")
-    all_pets_from_user = crud.get_all_pets_from_user(owner_id, db)
-    crud.check_for_existence_in_db(all_pets_from_user, f"У пользователей с id = {owner_id} нет питомцев"
-                                                       f"или такого пользователя не существует")
-    crud.delete_entries(all_pets_from_user, db)
-    return {"detail": "Все питомцы пользователя удалены"}
+    logger.info("Попытка удаления все питомцев у пользователя с id = %s", owner_id)
+    deleted_pets = await crud.delete_all_pets_from_user(owner_id, db)
+    crud.check_for_existence_in_db(deleted_pets, f"У пользователей с id = {owner_id} нет питомцев"
+                                                 f"или такого пользователя не существует")
+    return {"detail": "Все питомцы пользователя удалены", "deleted": {"pets": deleted_pets}}
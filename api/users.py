@@ -1,93 +1,184 @@
-from typing import List
-from sqlalchemy.orm import Session
-from fastapi import Depends, Path, Query, APIRouter
+from typing import List, Optional
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+from fastapi import Body, Depends, Path, Query, APIRouter, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import ORJSONResponse
 
-from api.dependencies import get_db
+from api import conditional
+from api.dependencies import get_db, get_read_db, read_session_factory
+from config.settings import settings
 from models.users import UserModel
-from models.pets import PetModel
-from repositories import crud
+from repositories import crud, email_validation
+from repositories.export import export_response
 from repositories.logs import logger
-from schemas.users import UserCreate, UserSchemas
+from schemas.base_schemas import BatchResult, BulkResult, Count, Detail, Page, UsersDeleteResult
+from schemas.users import UserCreate, UserInfoSchemas, UserLogin, UserSchemas, UsersStats
 
 
-router_user = APIRouter(prefix="/user", tags=["Operations with users"], dependencies=[Depends(get_db)])
-router_users = APIRouter(prefix="/users", tags=["Operations with users"], dependencies=[Depends(get_db)])
+router_user = APIRouter(prefix="/user", tags=["Operations with users"])
+router_users = APIRouter(prefix="/users", tags=["Operations with users"])
 
 
 # POST
 @router_user.post("/", response_model=UserSchemas)
-async def create_user(new_user: UserCreate, db: Session = Depends(get_db)):
-    logger.info(f'Попытка создать пользователя с email: "{new_user.email}"')
-    user_by_new_email = crud.get_user_by_email(new_user.email, db)
-    crud.checking_for_matches_in_db(user_by_new_email, "Пользователь с таким email уже зарегистрирован")
-    return crud.create_user(new_user, db)
+async def create_user(new_user: UserCreate, db: AsyncSession = Depends(get_db)):
+    logger.info('Попытка создать пользователя с email: "%s"', new_user.email)
+    await email_validation.check_deliverability(new_user.email)
+    try:
+        return await crud.create_user(new_user, db)
+    except IntegrityError as match:
+        crud.checking_for_matches_in_db(match, "Пользователь с таким email уже зарегистрирован")
+
+
+@router_user.post("/login", response_model=UserInfoSchemas)
+async def login_user(credentials: UserLogin, db: AsyncSession = Depends(get_db)):
+    logger.info('Попытка входа пользователя с email: "%s"', credentials.email)
+    user = await crud.authenticate_user(credentials.email, credentials.password, db)
+    crud.check_for_existence_in_db(user, "Неверный email или пароль", status_code=401)
+    return user
+
+
+@router_users.post("/bulk", response_model=BulkResult)
+async def create_users(
+        new_users: List[UserCreate] = Body(..., min_items=1, max_items=settings.bulk_max_items),
+        db: AsyncSession = Depends(get_db)
+):
+    logger.info("Попытка массового создания пользователей: %s", len(new_users))
+    undeliverable = await email_validation.find_undeliverable(user.email for user in new_users)
+    try:
+        results = await crud.create_users(new_users, db, undeliverable)
+    except IntegrityError as match:
+        crud.checking_for_matches_in_db(match, "Пользователи из запроса были зарегистрированы параллельно, "
+                                               "повторите запрос", status_code=409)
+    return {"created": sum(item["status_code"] == 201 for item in results), "items": results}
 
 
 # GET
-@router_users.get("/", response_model=List[UserSchemas])
+@router_users.get("/", response_model=Page[UserSchemas])
 async def show_users(
-        skip: int = Query(0, description="Сколько записей пропустить"),
-        limit: int = Query(100, description="Максимальное число отображаемых записей"),
-        db: Session = Depends(get_db)
+        cursor: Optional[str] = Query(None, description="Курсор страницы из next_cursor предыдущего ответа"),
+        limit: int = Query(100, ge=1, description="Максимальное число отображаемых записей"),
+        include_pets: bool = Query(True, description="Отображать питомцев пользователей"),
+        order_by: str = Query("id", regex="^(id|pet_count)$",
+                              description="Порядок: id - по возрастанию id, pet_count - по убыванию числа питомцев"),
+        db: AsyncSession = Depends(get_read_db)
 ):
     logger.info("Попытка отобразить всех пользователей")
-    users = crud.get_entries(UserModel, db, skip, limit)
-    crud.check_for_existence_in_db(users, "База данных пользователей пуста")
+    if order_by == "pet_count":
+        users, next_cursor = await crud.get_users_by_pet_count(db, cursor, limit, include_pets, cached=True)
+    else:
+        users, next_cursor = await crud.get_rows_page(UserModel, db, cursor, limit, include_pets, cached=True)
+    if cursor is None:
+        crud.check_for_existence_in_db(users, "База данных пользователей пуста")
     logger.info("Информация о пользователях предоставлена")
-    return users
+    # Строки уже имеют вид UserSchemas (без pets при include_pets=false), повторная проверка моделью не нужна
+    return ORJSONResponse({"items": users, "next_cursor": next_cursor})
+
+
+@router_users.get("/count", response_model=Count)
+async def count_users(db: AsyncSession = Depends(get_read_db)):
+    return {"count": await crud.count_entries(UserModel, db, cached=True)}
+
+
+@router_users.get("/stats", response_model=UsersStats)
+async def show_users_stats(
+        top: int = Query(10, ge=1, le=100, description="Размер списков самых крупных владельцев и частых кличек"),
+        db: AsyncSession = Depends(get_read_db)
+):
+    logger.info("Попытка получить статистику пользователей")
+    return await crud.get_stats(db, top, cached=True)
+
+
+@router_users.get("/batch", response_model=BatchResult[UserSchemas])
+async def show_users_by_ids(
+        ids: List[int] = Query(..., min_items=1, max_items=settings.bulk_max_items, description="id пользователей"),
+        include_pets: bool = Query(True, description="Отображать питомцев пользователей"),
+        db: AsyncSession = Depends(get_read_db)
+):
+    logger.info("Попытка отобразить пользователей по списку id: %s", len(ids))
+    users = await crud.get_rows_by_ids(UserModel, ids, db, include_pets)
+    return ORJSONResponse({
+        "items": [users.get(user_id) for user_id in ids],
+        "missing": [user_id for user_id in ids if user_id not in users]
+    })
+
+
+@router_users.get("/export")
+async def export_users(
+        export_format: str = Query("ndjson", alias="format", regex="^(ndjson|csv)$",
+                                   description="Формат выгрузки: ndjson или csv"),
+        session_factory: sessionmaker = Depends(read_session_factory)
+):
+    logger.info("Выгрузка пользователей в формате %s", export_format)
+    return export_response([UserModel.id, UserModel.email], export_format, settings.export_chunk_size, "users",
+                           session_factory)
 
 
 @router_user.get("/{user_id}/", response_model=UserSchemas)
 async def show_user(
+        request: Request,
+        response: Response,
         user_id: int = Path(..., description="Пользовательский id"),
-        db: Session = Depends(get_db)
+        include_pets: bool = Query(True, description="Отображать питомцев пользователя"),
+        db: AsyncSession = Depends(get_read_db)
 ):
-    logger.info(f"Попытка отобразить пользователя с id = {user_id}")
-    user = crud.get_user(user_id, db)
+    logger.info("Попытка отобразить пользователя с id = %s", user_id)
+    if conditional.is_conditional(request):
+        # Для проверки условия читается только версия пользователя, без питомцев
+        version = await crud.get_user_version(user_id, db, cached=True)
+        crud.check_for_existence_in_db(version, f"Пользователь с id {user_id} не найден")
+        headers = conditional.validators(version.version, version.updated_at, "user", user_id, int(include_pets))
+        if conditional.not_modified(request, headers):
+            return conditional.not_modified_response(headers)
+    user = await crud.get_user(user_id, db, "joined" if include_pets else "noload", cached=True)
     crud.check_for_existence_in_db(user, f"Пользователь с id {user_id} не найден")
-    logger.info(f"Информация о пользователе с id = {user_id} предоставлена")
+    logger.info("Информация о пользователе с id = %s предоставлена", user_id)
+    # Версия берется из той же выборки, что и данные пользователя, и всегда им соответствует
+    headers = conditional.validators(user.version, user.updated_at, "user", user_id, int(include_pets))
+    if not include_pets:
+        return ORJSONResponse(jsonable_encoder(UserInfoSchemas.from_orm(user)), headers=headers)
+    response.headers.update(headers)
     return user
 
 
 # PUT
-@router_user.put("/{user_id}/")
+@router_user.put("/{user_id}/", response_model=Detail)
 async def change_user_by_id(
         user_id: int = Path(..., description="Пользовательский id"),
         new_email: str = Query(..., description="Новый email"),
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_db)
 ):
-    logger.info(f"Попытка изменить информацию о пользователе с id = {user_id}")
-    user = crud.get_user(user_id, db)
+    logger.info("Попытка изменить информацию о пользователе с id = %s", user_id)
+    user = await crud.get_user(user_id, db, "noload")
     crud.check_for_existence_in_db(user, f"Пользователь с id {user_id} не найден")
-    user_with_the_same_email = crud.get_user_by_email(new_email, db)
-    crud.checking_for_matches_in_db(user_with_the_same_email, f"Пользователь с email: {new_email} уже зарегистрирован")
-    user = crud.get_user(user_id, db)
-    crud.put_user(user, new_email, db)
+    try:
+        await crud.put_user(user, new_email, db)
+    except IntegrityError as match:
+        crud.checking_for_matches_in_db(match, f"Пользователь с email: {new_email} уже зарегистрирован")
     return {"detail": "Электронная почта пользователя изменена"}
 
 
 # DELETE
-@router_user.delete("/{user_id}/")
+@router_user.delete("/{user_id}/", response_model=UsersDeleteResult)
 async def delete_user(
         user_id: int = Path(..., description="id удаляемого пользователя"),
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_db)
 ):
-    logger.info(f"Попытка удаления пользователя с id = {user_id}")
-    all_pets_from_user = crud.get_all_pets_from_user(user_id, db)
-    crud.delete_entries(all_pets_from_user, db)
-    user_to_be_deleted = crud.get_user(user_id, db)
-    crud.check_for_existence_in_db(user_to_be_deleted, f"Пользователь с id = {user_id} не найден")
-    crud.delete_entry(user_to_be_deleted, db)
-    return {"detail": "Пользователь удален"}
+    logger.info("Попытка удаления пользователя с id = %s", user_id)
+    deleted_users, deleted_pets = await crud.delete_user(user_id, db)
+    crud.check_for_existence_in_db(deleted_users, f"Пользователь с id = {user_id} не найден")
+    return {"detail": "Пользователь удален", "deleted": {"users": deleted_users, "pets": deleted_pets}}
 
 
-@router_users.delete("/")
-async def delete_all_users(db: Session = Depends(get_db)):
+@router_users.delete("/", response_model=UsersDeleteResult)
+async def delete_all_users(
+        chunk_size: Optional[int] = Query(None, ge=1, description="Удалять порциями указанного размера"),
+        db: AsyncSession = Depends(get_db)
+):
     logger.info("Попытка очистки базы данных пользователей")
-    all_pets = crud.get_entries(PetModel, db, display_all=True)
-    crud.check_for_existence_in_db(all_pets, "База данных питомцев пуста", exception=False)
-    crud.delete_entries(all_pets, db)
-    all_users = crud.get_entries(UserModel, db, display_all=True)
-    crud.check_for_existence_in_db(all_users, "База данных пользователей пуста")
-    crud.delete_entries(all_users, db)
-    return {"detail": "Все пользователи удалены"}
+    deleted_users, deleted_pets = await crud.delete_all_users(db, chunk_size)
+    crud.check_for_existence_in_db(deleted_pets, "База данных питомцев пуста", exception=False)
+    crud.check_for_existence_in_db(deleted_users, "База данных пользователей пуста")
+    return {"detail": "Все пользователи удалены", "deleted": {"users": deleted_users, "pets": deleted_pets}}
@@ -0,0 +1,116 @@
+from typing import List
+
+from pydantic import BaseSettings
+
+
+class Settings(BaseSettings):
+    # Синхронный URL используется для создания схемы и служебных скриптов,
+    # асинхронный - для обработки запросов (aiosqlite локально, asyncpg и т.п. в продакшене)
+    database_url: str = "sqlite:///.././SQLite_db.db"
+    async_database_url: str = "sqlite+aiosqlite:///.././SQLite_db.db"
+    # GET-запросы выполняются в отдельном пуле соединений только для чтения. read_database_url - асинхронный URL
+    # реплики, пустая строка - читать из основной базы. Реплика может отставать, поэтому после записи клиент
+    # read_primary_after_write секунд читает из основной базы (cookie read_primary, 0 - не переключать),
+    # а заголовок X-Read-Primary: 1 направляет в основную базу отдельный запрос. Столько же секунд после изменения
+    # данных прочитанное из реплики не сохраняется в кэше чтения
+    read_database_url: str = ""
+    read_primary_after_write: float = 5
+
+    # Сервер (main.py): рабочие процессы uvicorn, событийный цикл и HTTP-парсер ("auto" выбирает uvloop
+    # и httptools, если они установлены), время keep-alive в секундах и очередь входящих соединений
+    server_host: str = "0.0.0.0"
+    server_port: int = 8006
+    server_workers: int = 1
+    server_loop: str = "auto"
+    server_http: str = "auto"
+    server_keep_alive: int = 5
+    server_backlog: int = 2048
+
+    # Пул соединений: для SQLite в файле используется очередь соединений (с WAL читатели не ждут писателя),
+    # для SQLite в памяти - одно общее соединение, для серверных СУБД - очередь с указанными размерами
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_timeout: float = 30
+    db_pool_recycle: int = -1
+    db_pool_pre_ping: bool = False
+
+    # Прагмы SQLite, выполняемые при открытии каждого соединения
+    sqlite_journal_mode: str = "WAL"
+    sqlite_synchronous: str = "NORMAL"
+    sqlite_busy_timeout: int = 5000  # мс
+    sqlite_cache_size: int = -64000  # отрицательное значение - размер в КиБ
+    sqlite_mmap_size: int = 268435456  # байт, 0 отключает отображение файла в память
+
+    # Хеширование паролей: "scrypt" или "pbkdf2_sha256" из hashlib, вычисляется в пуле потоков ("thread")
+    # или процессов ("process") из password_hash_workers исполнителей. Параметры стоимости сохраняются
+    # вместе с хешем: после их изменения пароль перехешируется при следующем входе пользователя
+    password_hash_algorithm: str = "scrypt"
+    password_scrypt_n: int = 2 ** 14
+    password_scrypt_r: int = 8
+    password_scrypt_p: int = 1
+    password_pbkdf2_iterations: int = 600000
+    password_hash_workers: int = 4
+    password_hash_executor: str = "thread"
+
+    # Максимальное число записей в одном запросе массового создания
+    bulk_max_items: int = 1000
+
+    # Групповая фиксация POST /pet/{user_id}/: питомцы из параллельных запросов записываются
+    # одной транзакцией через max_delay_ms после первого запроса или при накоплении max_rows записей
+    pet_group_commit_enabled: bool = False
+    pet_group_commit_max_delay_ms: float = 5
+    pet_group_commit_max_rows: int = 500
+
+    # Шардирование питомцев: асинхронные URL баз, по которым распределяется таблица pets (переменная окружения -
+    # JSON-список). Хозяин закрепляется за шардом по хешу своего id (users.pet_shard), пользователи и счетчики
+    # остаются в основной базе. Питомцы пользователей, созданных до включения шардов, хранятся в основной базе,
+    # пока их не перенесет команда rebalance-pet-shards. Пустой список - питомцы хранятся в основной базе.
+    # id питомцев в этом режиме выдаются блоками по pet_id_block_size из общей для всех баз последовательности,
+    # а счетчики владельцев записываются в основную базу групповой фиксацией с задержкой до max_delay_ms
+    pet_shard_urls: List[str] = []
+    pet_id_block_size: int = 1000
+    pet_count_group_commit_max_delay_ms: float = 2
+    pet_count_group_commit_max_rows: int = 500
+
+    # Размер порции строк при потоковой выгрузке таблиц
+    export_chunk_size: int = 1000
+
+    # Проверка существования почтового домена (DNS MX) при регистрации
+    email_check_deliverability: bool = True
+    email_dns_timeout: float = 3.0
+    # Что делать, если DNS не ответил вовремя: "syntax" - принять email после проверки синтаксиса,
+    # "reject" - отклонить регистрацию
+    email_dns_fallback: str = "syntax"
+    email_cache_size: int = 4096
+    email_cache_ttl: float = 3600
+    email_cache_negative_ttl: float = 300
+
+    # Учет SQL-запросов каждого HTTP-запроса (заголовок Server-Timing) и журнал медленных запросов:
+    # запросы дольше порога записываются в журнал вместе с планом выполнения
+    sql_instrumentation_enabled: bool = True
+    slow_query_threshold_ms: float = 100
+    slow_query_explain: bool = True
+
+    # Метрики в формате Prometheus по адресу /metrics
+    metrics_enabled: bool = True
+
+    # Журналирование: запись в файл выполняет фоновый поток, sample_rate - доля сохраняемых
+    # DEBUG/INFO сообщений (предупреждения и ошибки сохраняются всегда). Файл журнала, выросший до
+    # log_max_bytes, переименовывается, хранится log_backup_count старых файлов (log_max_bytes = 0 - без ротации)
+    log_file: str = "../python_logging.log"
+    log_max_bytes: int = 10 * 1024 * 1024
+    log_backup_count: int = 3
+    log_level: str = "INFO"
+    log_sample_rate: float = 1.0
+    log_json: bool = False
+
+    # Кэш результатов чтения для GET-запросов
+    read_cache_enabled: bool = True
+    read_cache_size: int = 10000
+    read_cache_ttl: float = 30
+
+    class Config:
+        env_prefix = "PETS_STORE_"
+
+
+settings = Settings()
@@ -1,9 +1,134 @@
-from sqlalchemy import create_engine
+from time import perf_counter
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool, StaticPool
+
+from config.settings import Settings, settings
+from repositories.metrics import metrics
+
+
+class _CheckoutTimingMixin:
+    """Учитывает в метриках время ожидания соединения из пула."""
+
+    def connect(self):
+        started = perf_counter()
+        try:
+            return super().connect()
+        finally:
+            metrics.pool_checkout_wait.observe(perf_counter() - started)
+
+
+class TimedQueuePool(_CheckoutTimingMixin, QueuePool):
+    pass
+
+
+class TimedAsyncAdaptedQueuePool(_CheckoutTimingMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def _is_sqlite_memory(url: str) -> bool:
+    database = make_url(url).database
+    return not database or database == ":memory:" or "mode=memory" in url
+
+
+def _engine_options(url: str, is_async: bool, config: Settings) -> dict:
+    """Параметры пула и подключения для create_engine в зависимости от СУБД."""
+    if url.startswith("sqlite"):
+        # timeout модуля sqlite3 задает ожидание блокировки так же, как PRAGMA busy_timeout
+        options = {"connect_args": {"check_same_thread": False, "timeout": config.sqlite_busy_timeout / 1000}}
+        if _is_sqlite_memory(url):
+            # База в памяти существует, пока открыто соединение, поэтому оно одно на весь процесс
+            options["poolclass"] = StaticPool
+            return options
+    else:
+        options = {"pool_pre_ping": config.db_pool_pre_ping, "pool_recycle": config.db_pool_recycle}
+    options.update(
+        poolclass=TimedAsyncAdaptedQueuePool if is_async else TimedQueuePool,
+        pool_size=config.db_pool_size,
+        max_overflow=config.db_max_overflow,
+        pool_timeout=config.db_pool_timeout
+    )
+    return options
+
+
+def _sqlite_pragmas(config: Settings, read_only: bool = False) -> list:
+    pragmas = [
+        f"PRAGMA journal_mode={config.sqlite_journal_mode}",
+        f"PRAGMA synchronous={config.sqlite_synchronous}",
+        f"PRAGMA busy_timeout={int(config.sqlite_busy_timeout)}",
+        f"PRAGMA cache_size={int(config.sqlite_cache_size)}",
+        f"PRAGMA mmap_size={int(config.sqlite_mmap_size)}"
+    ]
+    if read_only:
+        # query_only, а не mode=ro: соединению mode=ro нельзя создать файл -shm базы в режиме WAL
+        pragmas.append("PRAGMA query_only=ON")
+    return pragmas
+
 
+def _install_sqlite_pragmas(engine: Engine, pragmas: list) -> None:
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///.././SQLite_db.db"
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+
+def make_engine(url: str, config: Settings = settings) -> Engine:
+    engine = create_engine(url, **_engine_options(url, False, config))
+    if url.startswith("sqlite"):
+        _install_sqlite_pragmas(engine, _sqlite_pragmas(config))
+    return engine
+
+
+def make_async_engine(url: str, config: Settings = settings, read_only: bool = False) -> AsyncEngine:
+    engine = create_async_engine(url, **_engine_options(url, True, config))
+    if url.startswith("sqlite"):
+        _install_sqlite_pragmas(engine.sync_engine, _sqlite_pragmas(config, read_only))
+    return engine
+
+
+def make_read_engine(url: str, write_engine: AsyncEngine, config: Settings = settings) -> AsyncEngine:
+    """Движок пула чтения: соединения SQLite открываются только для чтения.
+
+    Для базы SQLite в памяти отдельного пула нет, ее единственное соединение принадлежит write_engine.
+    Реплику серверной СУБД защищает от записи сама СУБД.
+    """
+    if url.startswith("sqlite") and _is_sqlite_memory(url):
+        return write_engine
+    return make_async_engine(url, config, read_only=True)
+
+
+def make_sessionmaker(engine: AsyncEngine, read_only: bool = False, replica: bool = False) -> sessionmaker:
+    # Признак read_only в info сессии нужен, чтобы открывать для нее сессии шардов из пулов чтения,
+    # replica - чтобы не смешивать в кэше чтения данные реплики и основной базы
+    return sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine,
+                        class_=AsyncSession, info={"read_only": read_only, "replica": replica})
+
+
+def is_read_only(db: AsyncSession) -> bool:
+    return db.info.get("read_only", False)
+
+
+def is_replica(db: AsyncSession) -> bool:
+    """Сессия читает из реплики, которая может отставать от основной базы."""
+    return db.info.get("replica", False)
+
+
+SQLALCHEMY_DATABASE_URL = settings.database_url
+engine = make_engine(SQLALCHEMY_DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+ASYNC_SQLALCHEMY_DATABASE_URL = settings.async_database_url
+async_engine = make_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL)
+AsyncSessionLocal = make_sessionmaker(async_engine)
+
+# Пул чтения для GET-запросов: реплика, если она задана, иначе та же база
+READ_SQLALCHEMY_DATABASE_URL = settings.read_database_url or ASYNC_SQLALCHEMY_DATABASE_URL
+read_engine = make_read_engine(READ_SQLALCHEMY_DATABASE_URL, async_engine)
+ReadSessionLocal = make_sessionmaker(read_engine, read_only=True, replica=bool(settings.read_database_url))
 Base = declarative_base()
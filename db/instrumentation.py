@@ -0,0 +1,85 @@
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from config.settings import settings
+from repositories.logs import logger
+
+
+class QueryStats:
+    """Статистика SQL-запросов в рамках одного HTTP-запроса."""
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.slowest_time = 0.0
+        self.slowest_statement = ""
+
+    def add(self, statement: str, elapsed: float) -> None:
+        self.count += 1
+        self.total_time += elapsed
+        if elapsed > self.slowest_time:
+            self.slowest_time = elapsed
+            self.slowest_statement = statement
+
+
+# Объект статистики изменяется на месте, поэтому запросы из задач и greenlet'ов,
+# унаследовавших контекст обработчика, попадают в статистику своего HTTP-запроса
+current_query_stats: ContextVar[Optional[QueryStats]] = ContextVar("current_query_stats", default=None)
+
+
+def _explain(connection, statement: str, parameters) -> str:
+    """План выполнения запроса, получаемый напрямую через DBAPI, чтобы не вызывать события повторно."""
+    if connection.dialect.name != "sqlite" or not statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE")):
+        return ""
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+        return "; ".join(str(row[-1]) for row in cursor.fetchall())
+    except Exception as e:
+        return f"план недоступен: {e}"
+    finally:
+        cursor.close()
+
+
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    # Время начала хранится в контексте выполнения, который создается на каждый запрос: в connection.info
+    # время запроса, завершившегося ошибкой, оставалось бы на все время жизни соединения пула
+    context.query_started_at = perf_counter()
+
+
+def _elapsed(context) -> Optional[float]:
+    """Время выполнения запроса; после первого вызова запрос считается учтенным и возвращается None."""
+    started_at = getattr(context, "query_started_at", None)
+    if started_at is None:
+        return None
+    context.query_started_at = None
+    return perf_counter() - started_at
+
+
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    elapsed = _elapsed(context)
+    stats = current_query_stats.get()
+    if stats is not None:
+        stats.add(statement, elapsed)
+    if elapsed * 1000 >= settings.slow_query_threshold_ms:
+        plan = _explain(connection, statement, parameters) if settings.slow_query_explain and not executemany else ""
+        # Параметры в журнал не пишутся: среди них бывают email и хеши паролей
+        logger.warning("Медленный SQL-запрос (%.1f мс): %s; план: %s", elapsed * 1000, statement, plan or "-")
+
+
+def _handle_error(exception_context):
+    """Запросы, завершившиеся ошибкой (например, IntegrityError), тоже учитываются в статистике."""
+    elapsed = _elapsed(exception_context.execution_context)
+    stats = current_query_stats.get()
+    if elapsed is not None and stats is not None:
+        stats.add(exception_context.statement, elapsed)
+
+
+def install_sql_instrumentation(engine: Engine) -> None:
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
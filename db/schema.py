@@ -0,0 +1,68 @@
+from collections import Counter
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection, Engine
+
+from db.database import Base
+from db.shards import pet_shards
+from models.pets import PetModel, create_pet_id_sequence, create_pets_search_index, create_pets_unique_index
+from models.users import add_pet_count_column, add_pet_shard_column
+from repositories.logs import logger
+
+# ALTER TABLE не допускает неконстантного значения по умолчанию,
+# поэтому время изменения существующих строк заполняется отдельным запросом
+VERSION_COLUMNS = (("version", "INTEGER NOT NULL DEFAULT 1"), ("updated_at", "DATETIME"))
+
+
+def add_version_columns(connection: Connection, table_name: str) -> None:
+    """Добавляет столбцы версии строк в таблицу, созданную до их появления."""
+    existing = {column["name"] for column in inspect(connection).get_columns(table_name)}
+    for name, definition in VERSION_COLUMNS:
+        if name not in existing:
+            connection.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {name} {definition}"))
+    if "updated_at" not in existing:
+        connection.execute(text(f"UPDATE {table_name} SET updated_at = CURRENT_TIMESTAMP"))
+
+
+def prepare_database(engine: Engine) -> None:
+    """Создает недостающие таблицы и дополняет созданные прежними версиями приложения."""
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        add_pet_count_column(connection)
+        add_version_columns(connection, "users")
+        add_version_columns(connection, "pets")
+        create_pets_search_index(connection)
+        removed = create_pets_unique_index(connection)
+        add_pet_shard_column(connection)
+        create_pet_id_sequence(connection)
+        check_pet_shards(connection)
+    for shard_engine in pet_shards.sync_engines():
+        # В шарде только таблица питомцев с индексами и поиском, пользователи остаются в основной базе
+        PetModel.__table__.create(bind=shard_engine, checkfirst=True)
+        with shard_engine.begin() as connection:
+            add_version_columns(connection, "pets")
+            create_pets_search_index(connection)
+            removed += create_pets_unique_index(connection)
+        shard_engine.dispose()
+    if removed:
+        with engine.begin() as connection:
+            forget_removed_pets(connection, removed)
+
+
+def forget_removed_pets(connection: Connection, removed: Counter) -> None:
+    """Уменьшает счетчики хозяев питомцев-повторов, удаленных при создании уникального индекса."""
+    logger.warning("При создании уникального индекса питомцев удалены повторы: %s (id хозяина: число)",
+                   dict(removed))
+    connection.execute(
+        text("UPDATE users SET pet_count = pet_count - :removed, version = version + 1 WHERE id = :owner_id"),
+        [{"owner_id": owner_id, "removed": count} for owner_id, count in removed.items()]
+    )
+
+
+def check_pet_shards(connection: Connection) -> None:
+    """Не дает запуститься с меньшим числом шардов, чем уже используют пользователи."""
+    used = connection.execute(text("SELECT max(pet_shard) FROM users")).scalar()
+    if used is not None and used >= len(pet_shards):
+        raise RuntimeError(f"Питомцы пользователей хранятся в шарде {used}, а настроено шардов: {len(pet_shards)}. "
+                           f"Верните прежний список pet_shard_urls и освободите лишние шарды командой "
+                           f"rebalance-pet-shards --shards N")
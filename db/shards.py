@@ -0,0 +1,52 @@
+from typing import List
+from zlib import crc32
+
+from sqlalchemy.engine import Engine, make_url
+
+from config.settings import Settings, settings
+from db.database import make_async_engine, make_engine, make_read_engine, make_sessionmaker
+
+
+def sync_url(url: str) -> str:
+    """Синхронный URL той же базы: sqlite+aiosqlite:///x.db -> sqlite:///x.db."""
+    url = make_url(url)
+    return str(url.set(drivername=url.get_backend_name()))
+
+
+class PetShards:
+    """Базы, по которым распределяется таблица pets (настройка pet_shard_urls).
+
+    Шард хозяина хранится в users.pet_shard основной базы, NULL - питомцы хранятся в основной базе.
+    Новые пользователи закрепляются за шардом default_shard(id), перенос владельцев между шардами
+    выполняет команда rebalance-pet-shards (repositories.maintenance).
+    """
+
+    def __init__(self, urls: List[str], config: Settings = settings):
+        self.urls = list(urls)
+        self.engines = [make_async_engine(url, config) for url in self.urls]
+        self.sessions = [make_sessionmaker(engine) for engine in self.engines]
+        # Пулы чтения для GET-запросов, у шардов нет реплик: читаются те же файлы
+        self.read_engines = [make_read_engine(url, engine, config) for url, engine in zip(self.urls, self.engines)]
+        self.read_sessions = [make_sessionmaker(engine, read_only=True) for engine in self.read_engines]
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.urls)
+
+    def __len__(self) -> int:
+        return len(self.urls)
+
+    def default_shard(self, owner_id: int) -> int:
+        # crc32, а не hash(): встроенный хеш строк зависит от процесса, а шард должен быть одинаковым во всех
+        return crc32(str(owner_id).encode()) % len(self.urls)
+
+    def sync_engines(self) -> List[Engine]:
+        """Синхронные движки шардов для создания схемы, вызывающий закрывает их после использования."""
+        return [make_engine(sync_url(url)) for url in self.urls]
+
+    async def dispose(self) -> None:
+        for engine in {*self.engines, *self.read_engines}:
+            await engine.dispose()
+
+
+pet_shards = PetShards(settings.pet_shard_urls)
@@ -0,0 +1,63 @@
+"""Запуск сервера магазина питомцев.
+
+    python main.py [--workers 4] [--port 8006]
+
+Схема базы создается и обновляется один раз в главном процессе (prestart), после чего uvicorn
+запускает рабочие процессы, которые только импортируют приложение. Значения по умолчанию
+берутся из настроек server_* (переменные окружения PETS_STORE_SERVER_*).
+"""
+import argparse
+import os
+
+from config.settings import settings
+
+
+def prestart() -> None:
+    """Подготовка базы, выполняемая один раз до запуска рабочих процессов."""
+    # Модели и движок импортируются здесь: главному процессу uvicorn они больше не нужны
+    from db.database import engine
+    from db.schema import prepare_database
+
+    prepare_database(engine)
+    engine.dispose()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Сервер магазина питомцев")
+    parser.add_argument("--host", default=settings.server_host)
+    parser.add_argument("--port", type=int, default=settings.server_port)
+    parser.add_argument("--workers", type=int, default=settings.server_workers, help="Число рабочих процессов")
+    parser.add_argument("--loop", default=settings.server_loop, choices=["auto", "asyncio", "uvloop"])
+    parser.add_argument("--http", default=settings.server_http, choices=["auto", "h11", "httptools"])
+    parser.add_argument("--keep-alive", type=int, default=settings.server_keep_alive,
+                        help="Сколько секунд держать открытым простаивающее соединение")
+    parser.add_argument("--backlog", type=int, default=settings.server_backlog,
+                        help="Длина очереди входящих соединений")
+    parser.add_argument("--skip-prestart", action="store_true", help="Не проверять схему базы перед запуском")
+    return parser.parse_args()
+
+
+def main(args) -> None:
+    import uvicorn
+
+    if not args.skip_prestart:
+        prestart()
+    if args.workers > 1 and "PETS_STORE_READ_CACHE_ENABLED" not in os.environ:
+        # Кэш чтения живет в памяти процесса: изменение, сделанное одним процессом, не сбросило бы кэш
+        # остальных до истечения TTL. Без общего хранилища кэша он отключается, явная настройка сохраняется
+        os.environ["PETS_STORE_READ_CACHE_ENABLED"] = "false"
+    uvicorn.run(
+        # С несколькими процессами приложение передается строкой импорта, каждый процесс загружает его сам
+        "api.main:app",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        loop=args.loop,
+        http=args.http,
+        timeout_keep_alive=args.keep_alive,
+        backlog=args.backlog
+    )
+
+
+if __name__ == "__main__":
+    main(parse_args())
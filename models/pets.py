@@ -1,5 +1,9 @@
+from collections import Counter
+from datetime import datetime
+
 from sqlalchemy.orm import relationship
-from sqlalchemy import Column, ForeignKey, Integer, String
+from sqlalchemy import Column, DateTime, ForeignKey, Index, Integer, String, bindparam, func, inspect, text
+from sqlalchemy.engine import Connection
 
 from db.database import Base
 
@@ -11,5 +15,96 @@ class PetModel(Base):
     animal_name = Column(String, index=True)
     description = Column(String, index=True)
     owner_id = Column(Integer, ForeignKey("users.id"))
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow, server_default=func.current_timestamp())
+
+    owner = relationship("UserModel", back_populates="pets")
+
+    __table_args__ = (
+        # У одного хозяина не может быть двух питомцев с одинаковыми кличкой и описанием,
+        # отсутствующее описание считается пустым. Индекс также обслуживает выборки по owner_id
+        Index("ix_pets_owner_animal_description", owner_id, animal_name, func.coalesce(description, ""), unique=True),
+    )
+
+
+class PetIdSequenceModel(Base):
+    """Последовательность id питомцев, общая для основной базы и шардов (db.shards).
+
+    Используется только с шардами: автоинкремент каждой базы выдавал бы одинаковые id.
+    """
+    __tablename__ = "pet_id_sequence"
+
+    id = Column(Integer, primary_key=True)
+    next_id = Column(Integer, nullable=False)
+
+
+def create_pet_id_sequence(connection: Connection) -> None:
+    connection.execute(text(
+        "INSERT INTO pet_id_sequence (id, next_id) SELECT 1, 1 WHERE NOT EXISTS (SELECT 1 FROM pet_id_sequence)"
+    ))
+
+
+def create_pets_unique_index(connection: Connection) -> Counter:
+    """Создает уникальный индекс питомцев в таблице, созданной до его появления.
+
+    Повторы, мешающие созданию индекса, удаляются, остается питомец с наименьшим id.
+    Возвращает {id хозяина: число удаленных питомцев} для исправления счетчиков.
+    """
+    name = "ix_pets_owner_animal_description"
+    if connection.dialect.name == "sqlite":
+        # Отражение SQLAlchemy пропускает индексы по выражениям, поэтому наличие проверяется по sqlite_master
+        exists = connection.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = :name"), {"name": name}
+        ).first()
+    else:
+        exists = name in {index["name"] for index in inspect(connection).get_indexes("pets")}
+    if exists:
+        return Counter()
+    # Питомцы без хозяина индексу не мешают: NULL в уникальном индексе не совпадает с другим NULL
+    duplicates = connection.execute(text(
+        "SELECT id, owner_id FROM pets WHERE owner_id IS NOT NULL AND id NOT IN ("
+        "SELECT min(id) FROM pets WHERE owner_id IS NOT NULL "
+        "GROUP BY owner_id, animal_name, coalesce(description, ''))"
+    )).all()
+    if duplicates:
+        connection.execute(
+            text("DELETE FROM pets WHERE id IN :ids").bindparams(bindparam("ids", expanding=True)),
+            {"ids": [pet_id for pet_id, _ in duplicates]}
+        )
+    connection.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_pets_owner_animal_description "
+        "ON pets (owner_id, animal_name, coalesce(description, ''))"
+    ))
+    return Counter(owner_id for _, owner_id in duplicates)
+
+
+# Полнотекстовый индекс по кличке и описанию. Таблица FTS5 хранит только индекс (content='pets'),
+# а триггеры обновляют его при любых изменениях pets, в том числе массовых вставках и удалениях
+PETS_SEARCH_DDL = (
+    """CREATE VIRTUAL TABLE IF NOT EXISTS pets_fts USING fts5(
+        animal_name, description, content='pets', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS pets_fts_insert AFTER INSERT ON pets BEGIN
+        INSERT INTO pets_fts(rowid, animal_name, description) VALUES (new.id, new.animal_name, new.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS pets_fts_delete AFTER DELETE ON pets BEGIN
+        INSERT INTO pets_fts(pets_fts, rowid, animal_name, description)
+        VALUES ('delete', old.id, old.animal_name, old.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS pets_fts_update AFTER UPDATE OF animal_name, description ON pets BEGIN
+        INSERT INTO pets_fts(pets_fts, rowid, animal_name, description)
+        VALUES ('delete', old.id, old.animal_name, old.description);
+        INSERT INTO pets_fts(rowid, animal_name, description) VALUES (new.id, new.animal_name, new.description);
+    END"""
+)
+
 
-    owner = relationship("UserModel", back_populates="pets")
\ No newline at end of file
+def create_pets_search_index(connection: Connection) -> None:
+    """Создает индекс поиска питомцев, если его еще нет, и заполняет его существующими записями."""
+    if connection.dialect.name != "sqlite":
+        return
+    exists = connection.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'pets_fts'")).first()
+    for statement in PETS_SEARCH_DDL:
+        connection.execute(text(statement))
+    if not exists:
+        connection.execute(text("INSERT INTO pets_fts(pets_fts) VALUES ('rebuild')"))
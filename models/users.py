@@ -1,5 +1,8 @@
+from datetime import datetime
+
 from sqlalchemy.orm import relationship
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import Column, DateTime, Integer, String, func, inspect, text
+from sqlalchemy.engine import Connection
 
 from db.database import Base
 
@@ -10,5 +13,30 @@ class UserModel(Base):
     id = Column(Integer, primary_key=True)
     email = Column(String, unique=True, index=True)
     hashed_password = Column(String)
+    # Число питомцев пользователя, изменяется в той же транзакции, что и таблица pets
+    # (repositories.crud.change_pet_counts), сверяется командой repositories.maintenance
+    pet_count = Column(Integer, nullable=False, default=0, server_default="0", index=True)
+    # Версия и время последнего изменения, по ним строятся ETag и Last-Modified. Версия пользователя
+    # увеличивается и при изменении его питомцев, поэтому описывает и список питомцев
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow, server_default=func.current_timestamp())
+    # Номер шарда с питомцами пользователя (db.shards), NULL - питомцы хранятся в основной базе
+    pet_shard = Column(Integer, nullable=True)
+
+    # Без ORDER BY SQLite вернул бы питомцев в порядке выбранного индекса, например по кличке
+    pets = relationship("PetModel", back_populates="owner", order_by="PetModel.id")
+
+
+def add_pet_count_column(connection: Connection) -> None:
+    """Добавляет pet_count в таблицу users, созданную до его появления, и заполняет его."""
+    if "pet_count" in {column["name"] for column in inspect(connection).get_columns("users")}:
+        return
+    connection.execute(text("ALTER TABLE users ADD COLUMN pet_count INTEGER NOT NULL DEFAULT 0"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_users_pet_count ON users (pet_count)"))
+    connection.execute(text("UPDATE users SET pet_count = (SELECT count(*) FROM pets WHERE pets.owner_id = users.id)"))
+
 
-    pets = relationship("PetModel", back_populates="owner")
\ No newline at end of file
+def add_pet_shard_column(connection: Connection) -> None:
+    """Добавляет pet_shard в таблицу users, созданную до его появления: питомцы остаются в основной базе."""
+    if "pet_shard" not in {column["name"] for column in inspect(connection).get_columns("users")}:
+        connection.execute(text("ALTER TABLE users ADD COLUMN pet_shard INTEGER"))
@@ -0,0 +1,82 @@
+import asyncio
+from typing import Any, List, Optional, Tuple
+from weakref import WeakKeyDictionary
+
+
+class _LoopQueue:
+    # Очередь одного событийного цикла: будущие результаты можно выставлять только из их собственного цикла
+    def __init__(self):
+        self.pending: List[Tuple[Any, asyncio.Future]] = []
+        self.worker: Optional[asyncio.Task] = None
+        self.wakeup: Optional[asyncio.Future] = None
+
+
+class GroupCommitter:
+    """Основа групповой фиксации: записи из параллельных запросов ставятся в очередь и записываются порцией.
+
+    Очередь сбрасывается через max_delay секунд после первой записи или сразу при накоплении max_rows записей.
+    Одновременно выполняется не больше одного сброса, записи, пришедшие во время сброса,
+    попадают в следующую порцию. Наследник реализует _flush, который выставляет результат
+    или ошибку каждой записи порции. У каждого событийного цикла своя очередь (TestClient
+    выполняет запросы в разных циклах и потоках), в uvicorn цикл и очередь одни на процесс.
+    """
+
+    def __init__(self, max_delay: float, max_rows: int):
+        self.max_delay = max_delay
+        self.max_rows = max_rows
+        self.batches = 0
+        self.rows = 0
+        self._queues: "WeakKeyDictionary[asyncio.AbstractEventLoop, _LoopQueue]" = WeakKeyDictionary()
+
+    async def submit(self, item: Any) -> Any:
+        """Ставит запись в очередь и возвращает ее результат после фиксации порции."""
+        loop = asyncio.get_running_loop()
+        queue = self._queues.get(loop)
+        if queue is None:
+            queue = self._queues[loop] = _LoopQueue()
+        result = loop.create_future()
+        queue.pending.append((item, result))
+        if queue.worker is None:
+            queue.worker = loop.create_task(self._run(queue))
+        elif len(queue.pending) >= self.max_rows and queue.wakeup is not None and not queue.wakeup.done():
+            queue.wakeup.set_result(None)
+        # Отмена запроса клиентом не снимает запись: порция уже может фиксироваться
+        return await asyncio.shield(result)
+
+    async def _run(self, queue: _LoopQueue) -> None:
+        try:
+            while queue.pending:
+                if len(queue.pending) < self.max_rows:
+                    queue.wakeup = asyncio.get_running_loop().create_future()
+                    await asyncio.wait({queue.wakeup}, timeout=self.max_delay)
+                    queue.wakeup = None
+                batch, queue.pending = queue.pending[:self.max_rows], queue.pending[self.max_rows:]
+                try:
+                    await self._flush(batch)
+                except Exception as e:
+                    # Порция фиксируется целиком: при ошибке каждый вызывающий получает ее сам
+                    for _, result in batch:
+                        if not result.done():
+                            result.set_exception(e)
+                    continue
+                self.batches += 1
+                self.rows += len(batch)
+        finally:
+            queue.worker = None
+
+    async def _flush(self, batch: List[Tuple[Any, asyncio.Future]]) -> None:
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        """Дожидается записи всех принятых в текущем событийном цикле записей."""
+        queue = self._queues.get(asyncio.get_running_loop())
+        if queue is None:
+            return
+        if queue.wakeup is not None and not queue.wakeup.done():
+            queue.wakeup.set_result(None)
+        if queue.worker is not None:
+            await queue.worker
+
+    def stats(self):
+        return {"batches": self.batches, "rows": self.rows,
+                "pending": sum(len(queue.pending) for queue in list(self._queues.values()))}
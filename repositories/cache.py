@@ -0,0 +1,160 @@
+from collections import OrderedDict
+from itertools import count
+from time import monotonic, time, time_ns
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, Optional, Tuple
+
+from config.settings import settings
+
+_MISSING = object()
+
+
+class CacheBackend:
+    """Интерфейс хранилища кэша.
+
+    Разделяемое между процессами хранилище (Redis, memcached) подключается реализацией этих методов.
+    """
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        raise NotImplementedError
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        raise NotImplementedError
+
+    def delete(self, key: Hashable) -> None:
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, float]:
+        raise NotImplementedError
+
+
+class LRUTTLCache(CacheBackend):
+    """Кэш в памяти процесса с вытеснением давно не использованных записей и временем жизни записей.
+
+    Рассчитан на работу из одного потока событийного цикла, поэтому обходится без блокировок.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.get(key, _MISSING)
+        if entry is not _MISSING:
+            value, expires_at = entry
+            if expires_at > monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+        self.misses += 1
+        return default
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """Значение без учета в статистике и без продвижения в очереди вытеснения."""
+        entry = self._entries.get(key, _MISSING)
+        if entry is not _MISSING and entry[1] > monotonic():
+            return entry[0]
+        return default
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        self._entries[key] = (value, monotonic() + (self.ttl if ttl is None else ttl))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0
+        }
+
+
+class ReadThroughCache:
+    """Кэш результатов чтения с инвалидацией по пространствам имен.
+
+    Ключ записи дополняется текущими поколениями ее пространств имен ("users", ("owner", 5) и т.п.).
+    Инвалидация переводит пространство на новое поколение, и старые записи больше не находятся,
+    а со временем вытесняются. Поколения берутся из монотонного счетчика, поэтому вытесненное
+    и созданное заново поколение никогда не совпадет со старым.
+
+    Результаты чтения из реплики хранятся под отдельными ключами и не выдаются тем, кто читает
+    из основной базы. Реплика отстает от основной базы не больше чем на replica_lag секунд, поэтому
+    столько времени после инвалидации прочитанное из нее не кэшируется.
+    """
+
+    def __init__(self, backend: CacheBackend, generations: CacheBackend, enabled: bool = True,
+                 replica_lag: float = 0):
+        self.backend = backend
+        self.generations = generations
+        self.enabled = enabled
+        self.replica_lag = replica_lag
+        self._counter = count(time_ns())
+
+    def generation(self, namespace: Hashable) -> Tuple[int, float]:
+        """Текущее поколение пространства имен и время его инвалидации."""
+        generation = self.generations.get(namespace)
+        if generation is None:
+            generation = (next(self._counter), 0.0)
+            self.generations.set(namespace, generation)
+        return generation
+
+    async def read_through(
+            self,
+            key: tuple,
+            namespaces: Iterable[Hashable],
+            loader: Callable[[], Awaitable],
+            replica: bool = False
+    ) -> Any:
+        if not self.enabled:
+            return await loader()
+        # Поколения фиксируются до загрузки: если запись изменится во время чтения,
+        # результат ляжет под устаревший ключ и не будет выдан
+        generations = [self.generation(namespace) for namespace in namespaces]
+        full_key = key + (replica,) + tuple(generation for generation, _ in generations)
+        value = self.backend.get(full_key, _MISSING)
+        if value is _MISSING:
+            # Реплика могла еще не получить изменения, сбросившие кэш: такой результат отдается, но не сохраняется
+            lagging = replica and any(time() - invalidated_at < self.replica_lag for _, invalidated_at in generations)
+            value = await loader()
+            if not lagging:
+                self.backend.set(full_key, value)
+        return value
+
+    def invalidate(self, *namespaces: Hashable) -> None:
+        # Время по часам, а не monotonic(): хранилище поколений может быть общим для нескольких процессов
+        for namespace in namespaces:
+            self.generations.set(namespace, (next(self._counter), time()))
+
+    def clear(self) -> None:
+        self.backend.clear()
+        self.generations.clear()
+
+    def stats(self) -> Dict[str, float]:
+        return self.backend.stats()
+
+
+read_cache = ReadThroughCache(
+    LRUTTLCache(settings.read_cache_size, settings.read_cache_ttl),
+    # Поколения живут дольше записей: истекшее поколение лишь делает записи недостижимыми раньше срока
+    LRUTTLCache(settings.read_cache_size, settings.read_cache_ttl * 10),
+    settings.read_cache_enabled,
+    settings.read_primary_after_write if settings.read_database_url else 0
+)
@@ -1,44 +1,489 @@
-from typing import Iterable
+import asyncio
+from collections import Counter, defaultdict
+from contextlib import asynccontextmanager
+from datetime import datetime
+from heapq import merge
+from itertools import islice
+from operator import itemgetter
+from typing import (
+    AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple, TypeVar
+)
 from fastapi import HTTPException
-from sqlalchemy.orm import Session
+from sqlalchemy import bindparam, delete, desc, exists, func, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload, noload, selectinload
 
-from db.database import Base
-from models.pets import PetModel
+from config.settings import settings
+from db.database import AsyncSessionLocal, Base, is_read_only, is_replica
+from db.shards import pet_shards
+from models.pets import PetIdSequenceModel, PetModel
 from models.users import UserModel
+from repositories.batching import GroupCommitter
+from repositories.cache import read_cache
 from repositories.logs import logger
+from repositories.other_functions import chunked, decode_cursor, encode_cursor
+
+# Сколько параметров можно безопасно передать в один запрос: старые сборки SQLite
+# ограничивают их числом 999 (SQLITE_MAX_VARIABLE_NUMBER)
+MAX_QUERY_PARAMETERS = 900
+
+# Столбцы в порядке полей UserInfoSchemas и PetSchemas: строки выборки сериализуются в JSON напрямую,
+# без ORM-объектов и pydantic-моделей, и должны давать тот же ответ
+USER_COLUMNS = (UserModel.email, UserModel.id, UserModel.pet_count)
+PET_COLUMNS = (PetModel.animal_name, PetModel.description, PetModel.id, PetModel.owner_id)
+
+T = TypeVar("T")
+
+
+# Шарды питомцев (db.shards)
+def pet_stores() -> List[Optional[int]]:
+    """Хранилища питомцев: None - основная база, за ней номера шардов."""
+    return [None, *range(len(pet_shards))]
+
+
+@asynccontextmanager
+async def pets_session(shard: Optional[int], db: AsyncSession) -> AsyncIterator[AsyncSession]:
+    """Сессия хранилища питомцев: для основной базы - сама db, для шарда - своя сессия, закрываемая на выходе.
+
+    Сессия шарда берется из пула того же вида, что и db: чтения или записи.
+    """
+    if shard is None:
+        yield db
+        return
+    sessions = pet_shards.read_sessions if is_read_only(db) else pet_shards.sessions
+    async with sessions[shard]() as pets_db:
+        yield pets_db
+
+
+async def fetch_from_pet_stores(
+        db: AsyncSession,
+        fetch: Callable[[AsyncSession], Awaitable[T]],
+        stores: Optional[Sequence[Optional[int]]] = None
+) -> List[T]:
+    """Выполняет fetch в каждом хранилище питомцев (по умолчанию во всех) и возвращает результаты по порядку."""
+    results = []
+    for shard in pet_stores() if stores is None else stores:
+        async with pets_session(shard, db) as pets_db:
+            results.append(await fetch(pets_db))
+    return results
+
+
+async def get_owner_shards(owner_ids: Sequence[int], db: AsyncSession) -> Dict[int, Optional[int]]:
+    """{id владельца: шард его питомцев}, None - основная база. Без шардов запросов не выполняет."""
+    if not pet_shards.enabled:
+        return dict.fromkeys(owner_ids)
+    shards = {}
+    for ids in chunked(list(set(owner_ids)), MAX_QUERY_PARAMETERS):
+        result = await db.execute(select(UserModel.id, UserModel.pet_shard).where(UserModel.id.in_(ids)))
+        shards.update(result.all())
+    return {owner_id: shards.get(owner_id) for owner_id in owner_ids}
+
+
+async def get_owner_shard(owner_id: int, db: AsyncSession) -> Optional[int]:
+    if not pet_shards.enabled:
+        return None
+    return await read_cache.read_through(
+        ("pet_shard", owner_id), [("owner", owner_id)],
+        lambda: db.scalar(select(UserModel.pet_shard).where(UserModel.id == owner_id)),
+        replica=is_replica(db)
+    )
+
+
+def group_by_shard(items: Iterable, shard_of: Callable) -> Dict[Optional[int], list]:
+    """Группирует записи по хранилищам, основная база идет первой.
+
+    Основная сессия должна писать раньше, чем счетчики владельцев из шардов зафиксируются в основной базе
+    (commit_pet_changes): транзакция SQLite, начатая чтением, не может перейти к записи после чужой фиксации.
+    """
+    groups = defaultdict(list)
+    for item in items:
+        groups[shard_of(item)].append(item)
+    return dict(sorted(groups.items(), key=lambda group: -1 if group[0] is None else group[0]))
 
 
 # GET
-def get_entries(
+def load_pets(strategy: str = "selectin"):
+    """Стратегия загрузки питомцев пользователя.
+
+    selectin - один дополнительный запрос на всю выборку пользователей (для списков),
+    joined - питомцы приходят в том же запросе через JOIN (для одного пользователя),
+    noload - питомцы не загружаются вовсе.
+    """
+    if strategy == "selectin":
+        return selectinload(UserModel.pets)
+    if strategy == "joined":
+        return joinedload(UserModel.pets)
+    return noload(UserModel.pets)
+
+
+async def get_pet_rows_of_owners(owner_ids: Sequence[int], db: AsyncSession) -> Dict[int, List[dict]]:
+    """Питомцы владельцев в виде словарей, сгруппированные по id владельца, у каждого - по возрастанию id."""
+    pets = defaultdict(list)
+    shards = await get_owner_shards(owner_ids, db)
+    for shard, shard_owner_ids in group_by_shard(owner_ids, shards.get).items():
+        async with pets_session(shard, db) as pets_db:
+            for ids in chunked(shard_owner_ids, MAX_QUERY_PARAMETERS):
+                result = await pets_db.execute(
+                    select(*PET_COLUMNS).where(PetModel.owner_id.in_(ids)).order_by(PetModel.owner_id, PetModel.id)
+                )
+                for row in result.mappings():
+                    pets[row["owner_id"]].append(dict(row))
+    return pets
+
+
+async def get_rows(
         table_name: Base,
-        db: Session,
-        skip: int = 0,
+        db: AsyncSession,
+        after_id: Optional[int] = None,
         limit: int = 100,
-        display_all: bool = False
-) -> Iterable:
-    if display_all:
-        return db.query(table_name).all()
-    return db.query(table_name).offset(skip).limit(limit).all()
+        include_pets: bool = True,
+        cached: bool = False
+) -> List[dict]:
+    """Страница записей в виде словарей, готовых к сериализации в JSON."""
+    if cached:
+        return await read_cache.read_through(
+            ("rows", table_name.__tablename__, after_id, limit, include_pets),
+            [table_name.__tablename__],
+            lambda: get_rows(table_name, db, after_id, limit, include_pets),
+            replica=is_replica(db)
+        )
+    columns = USER_COLUMNS if table_name is UserModel else PET_COLUMNS
+    query = select(*columns).order_by(table_name.id).limit(limit)
+    if after_id is not None:
+        query = query.where(table_name.id > after_id)
 
+    async def fetch(session: AsyncSession) -> List[dict]:
+        return [dict(row) for row in (await session.execute(query)).mappings()]
 
-# DELETE
-def delete_entry(entry: Base, db: Session) -> None:
-    if isinstance(entry, UserModel):
-        db.delete(entry)
-        db.commit()
-        logger.info(f"Пользователь с id = {entry.id} удален")
-    if isinstance(entry, PetModel):
-        db.delete(entry)
-        db.commit()
-        logger.info(f"Питомец с id хозяина = {entry.owner_id} и id животного = {entry.id} удален")
+    if table_name is PetModel:
+        # id питомцев уникальны во всех хранилищах (PetIdAllocator), поэтому страницы шардов
+        # сливаются по id и курсор страницы остается одним числом
+        rows = list(islice(merge(*await fetch_from_pet_stores(db, fetch), key=itemgetter("id")), limit))
+    else:
+        rows = await fetch(db)
+    if table_name is UserModel and include_pets:
+        pets = await get_pet_rows_of_owners([row["id"] for row in rows], db)
+        for row in rows:
+            row["pets"] = pets.get(row["id"], [])
+    return rows
+
+
+async def get_rows_by_ids(
+        table_name: Base,
+        ids: Sequence[int],
+        db: AsyncSession,
+        include_pets: bool = True,
+        owner_id: Optional[int] = None
+) -> Dict[int, dict]:
+    """Записи по списку id одним IN-запросом на порцию, в виде {id: словарь}."""
+    columns = USER_COLUMNS if table_name is UserModel else PET_COLUMNS
+    rows = {}
+
+    async def fetch(session: AsyncSession) -> None:
+        for chunk in chunked(list(set(ids)), MAX_QUERY_PARAMETERS):
+            query = select(*columns).where(table_name.id.in_(chunk))
+            if owner_id is not None and table_name is PetModel:
+                query = query.where(PetModel.owner_id == owner_id)
+            rows.update((row["id"], dict(row)) for row in (await session.execute(query)).mappings())
+
+    if table_name is PetModel:
+        stores = None if owner_id is None else [await get_owner_shard(owner_id, db)]
+        await fetch_from_pet_stores(db, fetch, stores)
+    else:
+        await fetch(db)
+    if table_name is UserModel and include_pets:
+        pets = await get_pet_rows_of_owners(list(rows), db)
+        for row in rows.values():
+            row["pets"] = pets.get(row["id"], [])
+    return rows
+
+
+async def get_rows_page(
+        table_name: Base,
+        db: AsyncSession,
+        cursor: Optional[str] = None,
+        limit: int = 100,
+        include_pets: bool = True,
+        cached: bool = False
+) -> Tuple[List[dict], Optional[str]]:
+    rows = await get_rows(table_name, db, decode_cursor(cursor), limit + 1, include_pets, cached)
+    if len(rows) > limit:
+        return rows[:limit], encode_cursor(rows[limit - 1]["id"])
+    return rows, None
+
+
+async def entry_exists(table_name: Base, db: AsyncSession, *criteria) -> bool:
+    """Проверка наличия записи запросом EXISTS, без загрузки самих записей."""
+    return bool(await db.scalar(select(exists().where(*criteria).select_from(table_name))))
+
+
+async def count_entries(table_name: Base, db: AsyncSession, *criteria, cached: bool = False) -> int:
+    # Условия не входят в ключ кэша, поэтому кэшируется только подсчет всей таблицы
+    if cached and not criteria:
+        return await read_cache.read_through(
+            ("count", table_name.__tablename__), [table_name.__tablename__],
+            lambda: count_entries(table_name, db),
+            replica=is_replica(db)
+        )
+    query = select(func.count()).select_from(table_name).where(*criteria)
+    if table_name is PetModel:
+        return sum(await fetch_from_pet_stores(db, lambda pets_db: pets_db.scalar(query)))
+    return await db.scalar(query)
 
 
-def delete_entries(entries: Base, db: Session) -> None:
-    for i in entries:
-        delete_entry(i, db)
+async def get_stats(db: AsyncSession, top: int = 10, cached: bool = False) -> dict:
+    """Сводка по пользователям и питомцам, посчитанная агрегатными запросами."""
+    if cached:
+        return await read_cache.read_through(
+            ("stats", top), ["users", "pets"], lambda: get_stats(db, top), replica=is_replica(db)
+        )
+    # Распределение и крупнейшие владельцы читаются из индекса по UserModel.pet_count, без обхода pets
+    histogram = await db.execute(
+        select(UserModel.pet_count, func.count()).group_by(UserModel.pet_count).order_by(UserModel.pet_count)
+    )
+    histogram = {pets: number for pets, number in histogram}
+    users = sum(histogram.values())
+    owners = users - histogram.get(0, 0)
+    top_owners = await db.execute(
+        select(UserModel.id.label("owner_id"), UserModel.pet_count.label("pets"))
+        .where(UserModel.pet_count > 0).order_by(desc(UserModel.pet_count), UserModel.id).limit(top)
+    )
+    pets_count = func.count().label("pets")
+    names = select(PetModel.animal_name, pets_count).group_by(PetModel.animal_name)
+    if pet_shards.enabled:
+        # Популярные клички шарда могут не совпадать с общими, поэтому суммируются полные распределения
+        name_counts = Counter()
+        for result in await fetch_from_pet_stores(db, lambda pets_db: pets_db.execute(names)):
+            name_counts.update(dict(result.all()))
+        top_names = [{"animal_name": name, "pets": number} for name, number
+                     in sorted(name_counts.items(), key=lambda item: (-item[1], item[0] or ""))[:top]]
+    else:
+        result = await db.execute(names.order_by(desc(pets_count), PetModel.animal_name).limit(top))
+        top_names = [dict(row) for row in result.mappings()]
+    pets = sum(pets * number for pets, number in histogram.items())
+    return {
+        "users": users,
+        "pets": pets,
+        "owners": owners,
+        "average_pets_per_user": pets / users if users else 0.0,
+        "pets_per_owner": [{"pets": pets, "users": number} for pets, number in histogram.items()],
+        "top_owners": [dict(row) for row in top_owners.mappings()],
+        "top_animal_names": top_names
+    }
+
+
+async def stream_entries(
+        columns: Sequence,
+        db: AsyncSession,
+        chunk_size: int = 1000
+) -> AsyncIterator[List[Mapping]]:
+    """Выдает строки таблицы порциями по chunk_size через серверный курсор.
+
+    Строки читаются без создания ORM-объектов и не накапливаются в памяти,
+    поэтому выгрузка таблицы любого размера занимает память одной порции.
+    Питомцы с шардами выгружаются из хранилищ по очереди, порядок соблюдается внутри каждого.
+    """
+    stores = pet_stores() if columns[0].class_ is PetModel else [None]
+    for shard in stores:
+        async with pets_session(shard, db) as session:
+            result = await session.stream(select(*columns).order_by(columns[0]))
+            async for partition in result.mappings().partitions(chunk_size):
+                yield partition
+
+
+# DELETE
+async def delete_entries(
+        table_name: Base,
+        db: AsyncSession,
+        *criteria,
+        chunk_size: Optional[int] = None,
+        commit: bool = True,
+        update_counts: bool = True
+) -> int:
+    """Удаляет записи одним DELETE ... WHERE и возвращает их количество.
+
+    С chunk_size записи удаляются порциями, каждая в своей короткой транзакции,
+    чтобы не держать блокировку базы на все время удаления. update_counts=False - счетчики владельцев
+    удаленных питомцев не изменяются (питомцы удаляются в шарде или вместе с владельцами).
+    """
+    update_counts = update_counts and table_name is PetModel
+    if chunk_size is None:
+        if update_counts:
+            await _decrease_pet_counts(db, *criteria)
+        result = await db.execute(
+            delete(table_name).where(*criteria).execution_options(synchronize_session=False)
+        )
+        if commit:
+            await db.commit()
+        return result.rowcount
+    deleted = 0
+    while True:
+        chunk = select(table_name.id).where(*criteria).order_by(table_name.id).limit(chunk_size).scalar_subquery()
+        if update_counts:
+            await _decrease_pet_counts(db, PetModel.id.in_(chunk))
+        result = await db.execute(
+            delete(table_name).where(table_name.id.in_(chunk)).execution_options(synchronize_session=False)
+        )
+        await db.commit()
+        deleted += result.rowcount
+        if result.rowcount < chunk_size:
+            return deleted
 
 
 # Прочие функции
+async def change_pet_counts(db: AsyncSession, changes: Dict[int, int]) -> None:
+    """Изменяет UserModel.pet_count на {id пользователя: приращение} в текущей транзакции.
+
+    Счетчик меняется выражением pet_count + n, а не записью прочитанного значения,
+    поэтому параллельные изменения питомцев одного пользователя не теряются.
+    Версия пользователей увеличивается и при нулевом приращении: она описывает и список их питомцев.
+    """
+    if changes:
+        await db.execute(
+            update(UserModel).where(UserModel.id == bindparam("owner_id"))
+            .values(pet_count=UserModel.pet_count + bindparam("change"), **next_version(UserModel))
+            .execution_options(synchronize_session=False),
+            [{"owner_id": owner_id, "change": change} for owner_id, change in changes.items()]
+        )
+
+
+def next_version(model: Base) -> Dict:
+    """Значения для UPDATE, отмечающие изменение строки: следующая версия и текущее время."""
+    return {"version": model.version + 1, "updated_at": datetime.utcnow()}
+
+
+async def _decrease_pet_counts(db: AsyncSession, *criteria) -> None:
+    """Уменьшает счетчики владельцев питомцев, которые будут удалены по criteria."""
+    if not criteria:
+        await db.execute(
+            update(UserModel).values(pet_count=0, **next_version(UserModel)).execution_options(synchronize_session=False)
+        )
+        return
+    result = await db.execute(
+        select(PetModel.owner_id, func.count()).where(*criteria).group_by(PetModel.owner_id)
+    )
+    await change_pet_counts(db, {owner_id: -number for owner_id, number in result})
+
+
+class PetCountsBatcher(GroupCommitter):
+    """Групповая запись изменений счетчиков и версий владельцев, чьи питомцы хранятся в шардах.
+
+    Питомцы фиксируются в шарде, а счетчики - в основной базе. Изменения из параллельных запросов
+    складываются и записываются одной транзакцией, поэтому запись в разные шарды не выстраивается
+    в очередь за блокировкой основной базы на каждый запрос.
+    """
+
+    def __init__(self, max_delay: float, max_rows: int, session_factory: Callable = AsyncSessionLocal):
+        super().__init__(max_delay, max_rows)
+        self.session_factory = session_factory
+
+    async def _flush(self, batch: List[Tuple[Dict[int, int], asyncio.Future]]) -> None:
+        changes = Counter()
+        for item, _ in batch:
+            changes.update(item)
+        try:
+            async with self.session_factory() as db:
+                await change_pet_counts(db, changes)
+                await db.commit()
+        except Exception:
+            logger.exception("Счетчики питомцев %s владельцев не записаны, их исправит repair-pet-counts",
+                             len(changes))
+            raise
+        for _, result in batch:
+            if not result.done():
+                result.set_result(None)
+
+
+class PetIdAllocator:
+    """Выдает id питомцев, уникальные во всех хранилищах, из общей последовательности в основной базе.
+
+    Блок из block_size id резервируется одной короткой транзакцией, дальше id выдаются из памяти процесса,
+    неиспользованный остаток блока при остановке пропадает. Последовательность не отстает от id,
+    выданных автоинкрементом основной базы до включения шардов.
+    """
+
+    def __init__(self, block_size: int, session_factory: Callable = AsyncSessionLocal):
+        self.block_size = block_size
+        self.session_factory = session_factory
+        self._next = self._end = 0
+
+    async def allocate(self, count: int) -> List[int]:
+        ids = []
+        while len(ids) < count:
+            if self._next >= self._end:
+                size = max(self.block_size, count - len(ids))
+                start = await self._reserve(size)
+                # Пока шло резервирование, параллельный вызов мог получить свой блок: его остаток пропадет,
+                # но каждый id по-прежнему выдается один раз
+                self._next, self._end = start, start + size
+            taken = min(count - len(ids), self._end - self._next)
+            ids.extend(range(self._next, self._next + taken))
+            self._next += taken
+        return ids
+
+    async def _reserve(self, size: int) -> int:
+        sequence = PetIdSequenceModel.next_id
+        after_main = select(func.coalesce(func.max(PetModel.id), 0) + 1).scalar_subquery()
+        async with self.session_factory() as db:
+            await db.execute(update(PetIdSequenceModel).values(next_id=func.max(sequence, after_main) + size))
+            end = await db.scalar(select(sequence))
+            await db.commit()
+        return end - size
+
+
+pet_counts_batcher = PetCountsBatcher(
+    settings.pet_count_group_commit_max_delay_ms / 1000,
+    settings.pet_count_group_commit_max_rows
+)
+pet_id_allocator = PetIdAllocator(settings.pet_id_block_size)
+
+
+async def commit_pet_changes(pets_db: AsyncSession, db: AsyncSession, changes: Dict[int, int]) -> None:
+    """Фиксирует изменения питомцев вместе с изменением счетчиков и версий их владельцев {id: приращение}.
+
+    В основной базе это одна транзакция. В шарде сначала фиксируются питомцы, затем счетчики записываются
+    в основную базу через pet_counts_batcher: если между ними произойдет сбой, счетчики исправит
+    команда repair-pet-counts.
+    """
+    if pets_db is db:
+        await change_pet_counts(db, changes)
+        await commit(db)
+        return
+    await commit(pets_db)
+    # Транзакция основной сессии (только чтение) завершается, чтобы ее соединение вернулось в пул:
+    # иначе запросы, ждущие порцию счетчиков, могли бы занять весь пул, и самой порции не досталось бы соединения
+    await db.commit()
+    if changes:
+        await pet_counts_batcher.submit(changes)
+
+
+async def delete_pets_of_owner(owner_id: int, db: AsyncSession, *criteria) -> int:
+    """Удаляет питомцев владельца, подходящих под criteria, в его хранилище и уменьшает его счетчик."""
+    shard = await get_owner_shard(owner_id, db)
+    if shard is None:
+        return await delete_entries(PetModel, db, PetModel.owner_id == owner_id, *criteria)
+    async with pets_session(shard, db) as pets_db:
+        deleted = await delete_entries(PetModel, pets_db, PetModel.owner_id == owner_id, *criteria,
+                                       commit=False, update_counts=False)
+        await commit_pet_changes(pets_db, db, {owner_id: -deleted} if deleted else {})
+    return deleted
+
+
+async def commit(db: AsyncSession) -> None:
+    """Фиксирует транзакцию, при нарушении ограничений базы откатывает ее и пробрасывает IntegrityError."""
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise
+
+
+def invalidate_owner(owner_id: int) -> None:
+    """Сбрасывает кэш чтения всего, что показывает пользователя или его питомцев."""
+    read_cache.invalidate("users", "pets", ("owner", owner_id))
+
+
 def checking_for_matches_in_db(
         entry: Base,
         detail: str,
@@ -46,7 +491,7 @@ def checking_for_matches_in_db(
         type_error=HTTPException
 ) -> None:
     if entry:
-        logger.warning(f'{status_code} {detail}')
+        logger.warning("%s %s", status_code, detail)
         raise type_error(status_code=status_code, detail=detail)
 
 
@@ -59,8 +504,8 @@ def check_for_existence_in_db(
 ) -> None:
     if exception:
         if not entry:
-            logger.warning(f'{status_code} {detail}')
+            logger.warning("%s %s", status_code, detail)
             raise type_error(status_code=status_code, detail=detail)
     else:
         if not entry:
-            logger.warning(f'{status_code} {detail}')
+            logger.warning("%s %s", status_code, detail)
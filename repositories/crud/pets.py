@@ -1,55 +1,303 @@
-from typing import Iterable
-from sqlalchemy.orm import Session
+from collections import Counter
+from datetime import datetime
+from heapq import merge
+from itertools import islice
+from operator import itemgetter
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import and_, column, delete, func, insert, literal_column, or_, select, table, tuple_, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from db.database import is_replica
+from db.shards import pet_shards
 from models.pets import PetModel
+from models.users import UserModel
+from repositories.cache import read_cache
+from repositories.crud.general import (
+    MAX_QUERY_PARAMETERS, PET_COLUMNS, change_pet_counts, commit_pet_changes, delete_entries, delete_pets_of_owner,
+    fetch_from_pet_stores, get_owner_shard, get_owner_shards, get_pet_rows_of_owners, group_by_shard,
+    invalidate_owner, pet_id_allocator, pet_stores, pets_session
+)
 from repositories.logs import logger
-from schemas.pets import PetCreate, PetSchemas
+from repositories.other_functions import chunked, decode_search_cursor, encode_search_cursor, fts_query
+from schemas.pets import PetBulkCreate, PetCreate, PetSchemas
 
 
 # POST
-def create_user_pet(
+async def create_user_pet(
         pet: PetCreate,
         user_id: int,
-        db: Session
+        db: AsyncSession
 ) -> PetModel:
+    # Уникальность клички и описания у хозяина проверяет индекс базы:
+    # при совпадении commit пробрасывает IntegrityError
     db_pet = PetModel(**pet.dict(), owner_id=user_id)
-    db.add(db_pet)
-    db.commit()
-    db.refresh(db_pet)
-    logger.info(f'Питомец по кличке "{db_pet.animal_name}" добавлен пользователю с id = {user_id}')
+    if pet_shards.enabled:
+        db_pet.id, = await pet_id_allocator.allocate(1)
+    async with pets_session(await get_owner_shard(user_id, db), db) as pets_db:
+        pets_db.add(db_pet)
+        await commit_pet_changes(pets_db, db, {user_id: 1})
+    invalidate_owner(user_id)
+    logger.info('Питомец по кличке "%s" добавлен пользователю с id = %s', db_pet.animal_name, user_id)
     return db_pet
 
 
+def _pet_key(owner_id: int, animal_name: str, description: str) -> tuple:
+    # Питомцы без описания считаются одинаковыми, как и при проверке по одному
+    return owner_id, animal_name, description or ""
+
+
+async def _find_pet_ids(keys: List[tuple], db: AsyncSession) -> Dict[tuple, int]:
+    # Поиск id питомцев по ключам (хозяин, кличка, описание) запросами на порцию ключей
+    description = func.coalesce(PetModel.description, "")
+    ids_by_key = {}
+    for keys_chunk in chunked(keys, MAX_QUERY_PARAMETERS // 3):
+        result = await db.execute(
+            select(PetModel.owner_id, PetModel.animal_name, description, PetModel.id)
+            .where(tuple_(PetModel.owner_id, PetModel.animal_name, description).in_(keys_chunk))
+        )
+        ids_by_key.update({tuple(row[:3]): row[3] for row in result.all()})
+    return ids_by_key
+
+
+async def create_pets(pets: List[PetBulkCreate], db: AsyncSession) -> List[Dict]:
+    """Массовое создание питомцев одной транзакцией.
+
+    Существование хозяев и дубликаты проверяются запросами на порцию записей,
+    вставка - через executemany. Возвращает результат для каждой записи в порядке запроса.
+    """
+    owner_ids = list({pet.owner_id for pet in pets})
+    existing_owners = set()
+    for ids_chunk in chunked(owner_ids, MAX_QUERY_PARAMETERS):
+        result = await db.execute(select(UserModel.id).where(UserModel.id.in_(ids_chunk)))
+        existing_owners.update(result.scalars().all())
+    keys = list({_pet_key(pet.owner_id, pet.animal_name, pet.description) for pet in pets
+                 if pet.owner_id in existing_owners})
+    shards = await get_owner_shards(list(existing_owners), db)
+    existing_pets = {}
+    for shard, shard_keys in group_by_shard(keys, lambda key: shards[key[0]]).items():
+        async with pets_session(shard, db) as pets_db:
+            existing_pets.update(await _find_pet_ids(shard_keys, pets_db))
+
+    results, new_rows = [], {}
+    for index, pet in enumerate(pets):
+        key = _pet_key(pet.owner_id, pet.animal_name, pet.description)
+        if pet.owner_id not in existing_owners:
+            results.append({"index": index, "status_code": 404,
+                            "detail": f"Пользователь с id {pet.owner_id} не найден"})
+        elif key in existing_pets or key in new_rows:
+            results.append({"index": index, "status_code": 400,
+                            "detail": f"У пользователя с id {pet.owner_id} уже есть питомец "
+                                      f"с такой кличкой и описанием"})
+        else:
+            new_rows[key] = pet.dict()
+            results.append({"index": index, "status_code": 201, "detail": "Питомец добавлен"})
+    if not new_rows:
+        return results
+
+    if pet_shards.enabled:
+        ids_by_key = await _insert_pets_into_shards(new_rows, shards, db)
+    else:
+        # Предварительная проверка не защищает от параллельной вставки тех же питомцев,
+        # в этом случае индекс базы отклонит всю порцию с IntegrityError
+        try:
+            await db.execute(insert(PetModel), list(new_rows.values()))
+            await change_pet_counts(db, Counter(row["owner_id"] for row in new_rows.values()))
+            ids_by_key = await _find_pet_ids(list(new_rows), db)
+            await db.commit()
+        except IntegrityError:
+            await db.rollback()
+            raise
+    for item in results:
+        if item["status_code"] == 201:
+            pet = pets[item["index"]]
+            key = _pet_key(pet.owner_id, pet.animal_name, pet.description)
+            if key not in ids_by_key:
+                item.update(status_code=409, detail="Питомец был добавлен параллельно, повторите запрос")
+                continue
+            item["id"] = ids_by_key[key]
+            invalidate_owner(pet.owner_id)
+    logger.info("Массово добавлено питомцев: %s из %s", len(ids_by_key), len(pets))
+    return results
+
+
+async def _insert_pets_into_shards(
+        new_rows: Dict[tuple, dict],
+        shards: Dict[int, Optional[int]],
+        db: AsyncSession
+) -> Dict[tuple, int]:
+    """Вставка питомцев с шардами: id выдаются заранее, каждое хранилище фиксируется своей транзакцией.
+
+    Хранилище, отклонившее свою часть порции из-за параллельной вставки тех же питомцев, пропускается,
+    его питомцы не попадают в возвращаемый {ключ: id}.
+    """
+    for row, pet_id in zip(new_rows.values(), await pet_id_allocator.allocate(len(new_rows))):
+        row["id"] = pet_id
+    ids_by_key = {}
+    for shard, keys in group_by_shard(new_rows, lambda key: shards[key[0]]).items():
+        rows = [new_rows[key] for key in keys]
+        async with pets_session(shard, db) as pets_db:
+            try:
+                await pets_db.execute(insert(PetModel), rows)
+                await commit_pet_changes(pets_db, db, Counter(row["owner_id"] for row in rows))
+            except IntegrityError:
+                await pets_db.rollback()
+                logger.warning("Питомцы %s владельцев добавлены параллельно, часть порции отклонена", len(rows))
+                continue
+        ids_by_key.update((key, new_rows[key]["id"]) for key in keys)
+    return ids_by_key
+
+
 # GET
-def get_pet(
+async def get_pet(
         owner_id: int,
         pet_id: int,
-        db: Session
+        db: AsyncSession,
+        cached: bool = False
 ) -> PetModel:
-    return db.query(PetModel).filter_by(owner_id=owner_id, id=pet_id).first()
+    if cached:
+        return await read_cache.read_through(
+            ("pet", owner_id, pet_id), [("owner", owner_id)], lambda: get_pet(owner_id, pet_id, db),
+            replica=is_replica(db)
+        )
+    async with pets_session(await get_owner_shard(owner_id, db), db) as pets_db:
+        result = await pets_db.execute(select(PetModel).filter_by(owner_id=owner_id, id=pet_id))
+        return result.scalars().first()
 
 
-def get_pets_by_animal_name_and_description(
-        animal_name: str,
-        description: str,
-        db: Session
-) -> PetModel:
-    return db.query(PetModel).filter_by(animal_name=animal_name, description=description, ).first()
+async def get_all_pets_from_user(user_id: int, db: AsyncSession, cached: bool = False) -> List[dict]:
+    if cached:
+        return await read_cache.read_through(
+            ("pets_of_user", user_id), [("owner", user_id)], lambda: get_all_pets_from_user(user_id, db),
+            replica=is_replica(db)
+        )
+    return (await get_pet_rows_of_owners([user_id], db)).get(user_id, [])
 
 
-def get_all_pets_from_user(user_id: int, db: Session) -> Iterable:
-    return db.query(PetModel).filter_by(owner_id=user_id).all()
+# Индекс полнотекстового поиска (models.pets.PETS_SEARCH_DDL), rank - релевантность по BM25, меньше - лучше.
+# Каждый шард считает BM25 по своим питомцам, поэтому при слиянии шардов порядок по релевантности приближенный
+PETS_FTS = table("pets_fts", column("rowid"), column("rank"))
+
+
+async def search_pets(
+        query_text: str,
+        db: AsyncSession,
+        owner_id: Optional[int] = None,
+        prefix: bool = True,
+        cursor: Optional[str] = None,
+        limit: int = 100,
+        cached: bool = False
+) -> Tuple[List[dict], Optional[str]]:
+    after = decode_search_cursor(cursor)
+    if cached:
+        return await read_cache.read_through(
+            ("search", query_text, owner_id, prefix, after, limit), ["pets"],
+            lambda: search_pets(query_text, db, owner_id, prefix, cursor, limit),
+            replica=is_replica(db)
+        )
+    match = fts_query(query_text, prefix)
+    if not match:
+        return [], None
+    rank = PETS_FTS.c.rank
+    query = (
+        select(*PET_COLUMNS, rank)
+        .select_from(PETS_FTS)
+        .join(PetModel, PetModel.id == PETS_FTS.c.rowid)
+        .where(literal_column("pets_fts").match(match))
+        .order_by(rank, PetModel.id)
+        .limit(limit + 1)
+    )
+    if owner_id is not None:
+        query = query.where(PetModel.owner_id == owner_id)
+    if after is not None:
+        query = query.where(or_(rank > after[0], and_(rank == after[0], PetModel.id > after[1])))
+
+    async def fetch(pets_db: AsyncSession) -> List[dict]:
+        return [dict(row) for row in (await pets_db.execute(query)).mappings()]
+
+    stores = None if owner_id is None else [await get_owner_shard(owner_id, db)]
+    rows = list(islice(merge(*await fetch_from_pet_stores(db, fetch, stores), key=itemgetter("rank", "id")),
+                       limit + 1))
+    next_cursor = encode_search_cursor(rows[limit - 1]["rank"], rows[limit - 1]["id"]) if len(rows) > limit else None
+    for row in rows:
+        del row["rank"]
+    return rows[:limit], next_cursor
 
 
 # PUT
-def put_pet(
+async def put_pet(
         pet: PetSchemas,
         new_animal_name: str,
         new_description: str,
-        db: Session
+        db: AsyncSession
 ) -> None:
-    pet.animal_name = new_animal_name
-    pet.description = new_description
-    db.commit()
-    db.refresh(pet)
-    logger.info(f"Информация о питомце по id хозяина = {pet.owner_id} и id животного = {pet.id} изменена")
+    async with pets_session(await get_owner_shard(pet.owner_id, db), db) as pets_db:
+        # Питомец из шарда прочитан get_pet в уже закрытой сессии и привязывается к новой
+        pets_db.add(pet)
+        pet.animal_name = new_animal_name
+        pet.description = new_description
+        pet.version, pet.updated_at = PetModel.version + 1, datetime.utcnow()
+        # Число питомцев не меняется, но версия хозяина описывает и список его питомцев
+        await commit_pet_changes(pets_db, db, {pet.owner_id: 0})
+    invalidate_owner(pet.owner_id)
+    logger.info("Информация о питомце по id хозяина = %s и id животного = %s изменена", pet.owner_id, pet.id)
+
+
+# DELETE
+async def delete_user_pet(owner_id: int, pet_id: int, db: AsyncSession) -> int:
+    deleted = await delete_pets_of_owner(owner_id, db, PetModel.id == pet_id)
+    invalidate_owner(owner_id)
+    if deleted:
+        logger.info("Питомец с id хозяина = %s и id животного = %s удален", owner_id, pet_id)
+    return deleted
+
+
+async def delete_all_pets_from_user(owner_id: int, db: AsyncSession) -> int:
+    deleted = await delete_pets_of_owner(owner_id, db)
+    invalidate_owner(owner_id)
+    logger.info("У пользователя с id = %s удалено питомцев: %s", owner_id, deleted)
+    return deleted
+
+
+# Перенос между шардами (repositories.maintenance, при остановленном приложении)
+async def move_owner_pets(owner_id: int, target: Optional[int], db: AsyncSession) -> int:
+    """Переносит питомцев владельца в хранилище target (None - основная база), возвращает их число.
+
+    Питомцы копируются с прежними id, затем владелец закрепляется за новым хранилищем, и только после этого
+    питомцы удаляются из прежнего. Копии, оставшиеся после прерванного переноса, удаляет purge_stray_pets.
+    """
+    source = await get_owner_shard(owner_id, db)
+    if source == target:
+        return 0
+    async with pets_session(source, db) as source_db:
+        result = await source_db.execute(select(PetModel.__table__).where(PetModel.owner_id == owner_id))
+        rows = [dict(row) for row in result.mappings()]
+    async with pets_session(target, db) as target_db:
+        await target_db.execute(delete(PetModel).where(PetModel.owner_id == owner_id))
+        if rows:
+            await target_db.execute(insert(PetModel.__table__), rows)
+        await target_db.commit()
+    await db.execute(update(UserModel).where(UserModel.id == owner_id).values(pet_shard=target))
+    await db.commit()
+    invalidate_owner(owner_id)
+    async with pets_session(source, db) as source_db:
+        await delete_entries(PetModel, source_db, PetModel.owner_id == owner_id, update_counts=False)
+    logger.info("Питомцы пользователя с id = %s перенесены из хранилища %s в %s: %s",
+                owner_id, source, target, len(rows))
+    return len(rows)
+
+
+async def purge_stray_pets(db: AsyncSession) -> int:
+    """Удаляет питомцев из хранилищ, за которыми их владелец не закреплен, и питомцев удаленных владельцев."""
+    shards = dict((await db.execute(select(UserModel.id, UserModel.pet_shard))).all())
+    purged = 0
+    for shard in pet_stores():
+        async with pets_session(shard, db) as pets_db:
+            owner_ids = (await pets_db.execute(select(PetModel.owner_id).distinct())).scalars().all()
+            stray = [owner_id for owner_id in owner_ids if owner_id not in shards or shards[owner_id] != shard]
+            for ids in chunked(stray, MAX_QUERY_PARAMETERS):
+                purged += await delete_entries(PetModel, pets_db, PetModel.owner_id.in_(ids), update_counts=False)
+    if purged:
+        read_cache.invalidate("pets")
+        logger.warning("Удалено питомцев вне хранилища своего владельца: %s", purged)
+    return purged
@@ -1,34 +1,286 @@
-from sqlalchemy.orm import Session
+import asyncio
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import bindparam, func, insert, select, tuple_, update
+from sqlalchemy.engine import Row
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.attributes import set_committed_value
 
+from db.database import is_replica
+from db.shards import pet_shards
+from models.pets import PetModel
 from models.users import UserModel
+from repositories.cache import read_cache
+from repositories.crud.general import (
+    MAX_QUERY_PARAMETERS, USER_COLUMNS, commit, delete_entries, fetch_from_pet_stores, get_owner_shard,
+    get_pet_rows_of_owners, invalidate_owner, load_pets, pet_stores, pets_session
+)
 from repositories.logs import logger
-from repositories.other_functions import encrypt_password
+from repositories.other_functions import chunked, decode_pet_count_cursor, encode_pet_count_cursor
+from repositories.passwords import password_hasher
 from schemas.users import UserCreate, UserSchemas
 
 
 # POST
-def create_user(user: UserCreate, db: Session) -> UserModel:
-    fake_hashed_password = encrypt_password(user.password)
-    db_user = UserModel(email=user.email, hashed_password=fake_hashed_password)
+async def create_user(user: UserCreate, db: AsyncSession) -> UserModel:
+    hashed_password = await password_hasher.hash(user.password)
+    db_user = UserModel(email=user.email, hashed_password=hashed_password, pets=[])
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
-    logger.info(f'Пользователь c email: "{db_user.email}" и id = {db_user.id} создан')
+    if pet_shards.enabled:
+        # Шард выбирается по id, который становится известен только после вставки
+        try:
+            await db.flush()
+        except IntegrityError:
+            await db.rollback()
+            raise
+        db_user.pet_shard = pet_shards.default_shard(db_user.id)
+    # Уникальность email проверяет индекс базы: при совпадении commit пробрасывает IntegrityError.
+    # expire_on_commit=False: id уже получен при flush, повторная выборка не нужна
+    await commit(db)
+    invalidate_owner(db_user.id)
+    logger.info('Пользователь c email: "%s" и id = %s создан', db_user.email, db_user.id)
+    return db_user
+
+
+async def create_users(
+        users: List[UserCreate],
+        db: AsyncSession,
+        undeliverable: Optional[Dict[str, str]] = None
+) -> List[Dict]:
+    """Массовое создание пользователей одной транзакцией.
+
+    Проверка занятых email выполняется одним запросом на порцию, вставка - через executemany.
+    undeliverable - {email: ошибка} для адресов, не прошедших проверку домена.
+    Возвращает результат для каждой записи в порядке запроса.
+    """
+    emails = list({user.email for user in users})
+    registered = set()
+    for emails_chunk in chunked(emails, MAX_QUERY_PARAMETERS):
+        result = await db.execute(select(UserModel.email).where(UserModel.email.in_(emails_chunk)))
+        registered.update(result.scalars().all())
+
+    results, new_rows = [], {}
+    undeliverable = undeliverable or {}
+    for index, user in enumerate(users):
+        if user.email in undeliverable:
+            results.append({"index": index, "status_code": 422, "detail": undeliverable[user.email]})
+            continue
+        if user.email in registered or user.email in new_rows:
+            results.append({"index": index, "status_code": 400,
+                            "detail": "Пользователь с таким email уже зарегистрирован"})
+            continue
+        new_rows[user.email] = {"email": user.email, "password": user.password}
+        results.append({"index": index, "status_code": 201, "detail": "Пользователь создан"})
+    if not new_rows:
+        return results
+    # Пароли хешируются параллельно в пуле исполнителей
+    hashed_passwords = await asyncio.gather(*(password_hasher.hash(row.pop("password")) for row in new_rows.values()))
+    for row, hashed_password in zip(new_rows.values(), hashed_passwords):
+        row["hashed_password"] = hashed_password
+
+    # Параллельная регистрация тех же email отклоняется индексом базы с IntegrityError для всей порции
+    try:
+        await db.execute(insert(UserModel), list(new_rows.values()))
+        ids_by_email = {}
+        for emails_chunk in chunked(list(new_rows), MAX_QUERY_PARAMETERS):
+            result = await db.execute(select(UserModel.email, UserModel.id).where(UserModel.email.in_(emails_chunk)))
+            ids_by_email.update(result.all())
+        if pet_shards.enabled:
+            await db.execute(
+                update(UserModel).where(UserModel.id == bindparam("user_id")).values(pet_shard=bindparam("shard"))
+                .execution_options(synchronize_session=False),
+                [{"user_id": user_id, "shard": pet_shards.default_shard(user_id)} for user_id in ids_by_email.values()]
+            )
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise
+    for item in results:
+        if item["status_code"] == 201:
+            item["id"] = ids_by_email[users[item["index"]].email]
+            invalidate_owner(item["id"])
+    logger.info("Массово создано пользователей: %s из %s", len(new_rows), len(users))
+    return results
+
+
+async def authenticate_user(email: str, password: str, db: AsyncSession) -> Optional[UserModel]:
+    """Возвращает пользователя при совпадении пароля, иначе None.
+
+    Пароль, сохраненный старым форматом или с устаревшими параметрами хеширования, перехешируется.
+    """
+    result = await db.execute(select(UserModel).where(UserModel.email == email))
+    db_user = result.scalars().first()
+    # Для несуществующего email пароль тоже проверяется, чтобы время ответа не выдавало зарегистрированные адреса
+    if not await password_hasher.verify(password, db_user.hashed_password if db_user else None) or not db_user:
+        logger.info('Неудачная попытка входа пользователя с email: "%s"', email)
+        return None
+    if password_hasher.needs_rehash(db_user.hashed_password):
+        db_user.hashed_password = await password_hasher.hash(password)
+        await db.commit()
+        password_hasher.rehashed += 1
+        logger.info("Пароль пользователя с id = %s перехеширован с текущими параметрами", db_user.id)
+    logger.info('Пользователь c email: "%s" и id = %s вошел в систему', db_user.email, db_user.id)
     return db_user
 
 
 # GET
-def get_user(user_id: int, db: Session) -> UserModel:
-    return db.query(UserModel).filter(UserModel.id == user_id).first()
+async def get_user(user_id: int, db: AsyncSession, pets_loading: str = "joined", cached: bool = False) -> UserModel:
+    if cached:
+        return await read_cache.read_through(
+            ("user", user_id, pets_loading), [("owner", user_id)], lambda: get_user(user_id, db, pets_loading),
+            replica=is_replica(db)
+        )
+    if pets_loading == "joined" and pet_shards.enabled:
+        # JOIN не достанет питомцев из шарда: они читаются из хранилища владельца отдельным запросом
+        user = await get_user(user_id, db, "noload")
+        if user is not None:
+            pets = (await get_pet_rows_of_owners([user_id], db)).get(user_id, [])
+            set_committed_value(user, "pets", [PetModel(**pet) for pet in pets])
+        return user
+    result = await db.execute(
+        select(UserModel).options(load_pets(pets_loading)).filter(UserModel.id == user_id)
+    )
+    return result.unique().scalars().first()
+
+
+async def get_user_version(user_id: int, db: AsyncSession, cached: bool = False) -> Optional[Row]:
+    """Версия, время изменения и число питомцев пользователя - все, что нужно для ответа 304."""
+    if cached:
+        return await read_cache.read_through(
+            ("user_version", user_id), [("owner", user_id)], lambda: get_user_version(user_id, db),
+            replica=is_replica(db)
+        )
+    result = await db.execute(
+        select(UserModel.version, UserModel.updated_at, UserModel.pet_count).where(UserModel.id == user_id)
+    )
+    return result.first()
+
 
+async def get_users_by_pet_count(
+        db: AsyncSession,
+        cursor: Optional[str] = None,
+        limit: int = 100,
+        include_pets: bool = True,
+        cached: bool = False
+) -> Tuple[List[dict], Optional[str]]:
+    """Страница пользователей по убыванию числа питомцев, при равенстве - по убыванию id.
 
-def get_user_by_email(email: str, db: Session) -> UserModel:
-    return db.query(UserModel).filter(UserModel.email == email).first()
+    Порядок совпадает с обратным обходом индекса по pet_count, поэтому страница читается из индекса
+    без сортировки всей таблицы.
+    """
+    after = decode_pet_count_cursor(cursor)
+    if cached:
+        return await read_cache.read_through(
+            ("users_by_pet_count", after, limit, include_pets), ["users"],
+            lambda: get_users_by_pet_count(db, cursor, limit, include_pets),
+            replica=is_replica(db)
+        )
+    query = select(*USER_COLUMNS).order_by(UserModel.pet_count.desc(), UserModel.id.desc()).limit(limit + 1)
+    if after is not None:
+        query = query.where(tuple_(UserModel.pet_count, UserModel.id) < tuple_(*after))
+    rows = [dict(row) for row in (await db.execute(query)).mappings()]
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_pet_count_cursor(rows[-1]["pet_count"], rows[-1]["id"])
+    if include_pets:
+        pets = await get_pet_rows_of_owners([row["id"] for row in rows], db)
+        for row in rows:
+            row["pets"] = pets.get(row["id"], [])
+    return rows, next_cursor
+
+
+async def get_user_by_email(email: str, db: AsyncSession) -> UserModel:
+    result = await db.execute(select(UserModel).filter(UserModel.email == email))
+    return result.scalars().first()
 
 
 # PUT
-def put_user(user: UserSchemas, new_email: str, db: Session) -> None:
+async def put_user(user: UserSchemas, new_email: str, db: AsyncSession) -> None:
     user.email = new_email
-    db.commit()
-    db.refresh(user)
-    logger.info(f"Информация о пользователе с id = {user.id} изменена")
+    user.version, user.updated_at = UserModel.version + 1, datetime.utcnow()
+    await commit(db)
+    invalidate_owner(user.id)
+    logger.info("Информация о пользователе с id = %s изменена", user.id)
+
+
+async def repair_pet_counts(db: AsyncSession) -> int:
+    """Пересчитывает UserModel.pet_count по таблице pets, возвращает число исправленных пользователей."""
+    if pet_shards.enabled:
+        repaired = await _repair_sharded_pet_counts(db)
+    else:
+        actual = select(func.count()).where(PetModel.owner_id == UserModel.id).scalar_subquery()
+        result = await db.execute(
+            update(UserModel).where(UserModel.pet_count != actual).values(pet_count=actual)
+            .execution_options(synchronize_session=False)
+        )
+        repaired = result.rowcount
+    await db.commit()
+    if repaired:
+        read_cache.invalidate("users", "pets")
+        logger.warning("Исправлено число питомцев у пользователей: %s", repaired)
+    return repaired
+
+
+async def _repair_sharded_pet_counts(db: AsyncSession) -> int:
+    # Питомцы владельца считаются только в хранилище, за которым он закреплен:
+    # копии, оставшиеся после прерванного переноса, не учитываются
+    users = (await db.execute(select(UserModel.id, UserModel.pet_shard, UserModel.pet_count))).all()
+    shards = {user.id: user.pet_shard for user in users}
+    actual = dict.fromkeys(shards, 0)
+    counts = select(PetModel.owner_id, func.count()).group_by(PetModel.owner_id)
+    results = await fetch_from_pet_stores(db, lambda pets_db: pets_db.execute(counts))
+    for shard, result in zip(pet_stores(), results):
+        actual.update((owner_id, number) for owner_id, number in result
+                      if owner_id in shards and shards[owner_id] == shard)
+    wrong = [{"user_id": user.id, "pet_count": actual[user.id]} for user in users if user.pet_count != actual[user.id]]
+    if wrong:
+        await db.execute(
+            update(UserModel).where(UserModel.id == bindparam("user_id")).values(pet_count=bindparam("pet_count"))
+            .execution_options(synchronize_session=False),
+            wrong
+        )
+    return len(wrong)
+
+
+# DELETE
+async def delete_user(user_id: int, db: AsyncSession) -> Tuple[int, int]:
+    """Удаляет пользователя вместе с питомцами в одной транзакции, возвращает (пользователи, питомцы).
+
+    Питомцы из шарда удаляются транзакцией шарда, которая фиксируется до удаления пользователя.
+    """
+    shard = await get_owner_shard(user_id, db)
+    deleted_users = await delete_entries(UserModel, db, UserModel.id == user_id, commit=False)
+    if not deleted_users:
+        await db.rollback()
+        return 0, 0
+    if shard is None:
+        deleted_pets = await delete_entries(PetModel, db, PetModel.owner_id == user_id, commit=False,
+                                            update_counts=False)
+    else:
+        async with pets_session(shard, db) as pets_db:
+            deleted_pets = await delete_entries(PetModel, pets_db, PetModel.owner_id == user_id, update_counts=False)
+    await db.commit()
+    invalidate_owner(user_id)
+    logger.info("Пользователь с id = %s удален вместе с питомцами: %s", user_id, deleted_pets)
+    return deleted_users, deleted_pets
+
+
+async def delete_all_users(db: AsyncSession, chunk_size: Optional[int] = None) -> Tuple[int, int]:
+    """Очищает магазин: сначала питомцев, затем пользователей, возвращает (пользователи, питомцы)."""
+    # Счетчики питомцев не изменяются: их владельцы удаляются следом
+    deleted_pets = 0
+    for shard in range(len(pet_shards)):
+        async with pets_session(shard, db) as pets_db:
+            deleted_pets += await delete_entries(PetModel, pets_db, chunk_size=chunk_size, update_counts=False)
+    if chunk_size is None:
+        deleted_pets += await delete_entries(PetModel, db, commit=False, update_counts=False)
+        deleted_users = await delete_entries(UserModel, db, commit=False)
+        await db.commit()
+    else:
+        deleted_pets += await delete_entries(PetModel, db, chunk_size=chunk_size, update_counts=False)
+        deleted_users = await delete_entries(UserModel, db, chunk_size=chunk_size)
+    read_cache.clear()
+    logger.info("Удалено пользователей: %s, питомцев: %s", deleted_users, deleted_pets)
+    return deleted_users, deleted_pets
@@ -0,0 +1,124 @@
+import asyncio
+from functools import partial
+from typing import Callable, Dict, Iterable
+
+from email_validator import (
+    EMAIL_MAX_LENGTH, EmailNotValidError, EmailSyntaxError, EmailUndeliverableError,
+    validate_email, validate_email_deliverability
+)
+from fastapi import HTTPException
+
+from config.settings import settings
+from repositories.cache import LRUTTLCache
+from repositories.logs import logger
+
+
+def check_syntax(email: str) -> str:
+    """Проверяет синтаксис email без обращения к сети и возвращает нормализованный адрес."""
+    if len(email) >= EMAIL_MAX_LENGTH:
+        logger.info('Введен слишком длинный email: "%s", создание пользователя провалено', email)
+        raise HTTPException(status_code=422, detail="Введен слишком длинный email")
+    try:
+        valid = validate_email(email, check_deliverability=False)
+    except (EmailNotValidError, EmailSyntaxError) as e:
+        logger.info('Введен некорректный email: "%s", создание пользователя провалено', email)
+        raise HTTPException(status_code=422, detail=str(e))
+    return valid.email
+
+
+def normalize(email: str) -> str:
+    """Нормализованный адрес без проверки домена, для некорректного адреса - исходная строка."""
+    try:
+        return validate_email(email, check_deliverability=False).email
+    except (EmailNotValidError, EmailSyntaxError):
+        return email
+
+
+class DomainDeliverabilityChecker:
+    """Проверка почтовых доменов через DNS с кэшем результатов.
+
+    Поиск MX-записей выполняется в пуле потоков с ограничением по времени, поэтому не блокирует
+    событийный цикл. Положительные и отрицательные результаты кэшируются по домену,
+    одновременные проверки одного домена объединяются в один DNS-запрос.
+    """
+
+    def __init__(
+            self,
+            cache: LRUTTLCache,
+            timeout: float,
+            fallback: str = "syntax",
+            negative_ttl: float = 300,
+            resolver: Callable = validate_email_deliverability
+    ):
+        self.cache = cache
+        self.timeout = timeout
+        self.fallback = fallback
+        self.negative_ttl = negative_ttl
+        self.resolver = resolver
+        self.timeouts = 0
+        self._in_flight: Dict[str, asyncio.Future] = {}
+
+    async def check(self, email: str) -> None:
+        valid = validate_email(email, check_deliverability=False)
+        domain = valid.ascii_domain.lower()
+        result = self.cache.get(domain)
+        if result is None:
+            in_flight = self._in_flight.get(domain)
+            if in_flight is None:
+                in_flight = self._in_flight[domain] = asyncio.ensure_future(self._lookup(domain, valid.domain))
+                in_flight.add_done_callback(lambda _: self._in_flight.pop(domain, None))
+            result = await asyncio.shield(in_flight)
+        if result is not True:
+            logger.info('Введен email с недоступным доменом: "%s", создание пользователя провалено', email)
+            raise HTTPException(status_code=422, detail=result)
+
+    async def _lookup(self, domain: str, domain_i18n: str):
+        """Возвращает True для доступного домена или текст ошибки."""
+        try:
+            # Поток из пула executor'а не блокирует отмену по таймауту: ожидание прерывается сразу,
+            # а DNS-запрос завершится в фоне по собственному таймауту
+            answer = await asyncio.wait_for(
+                asyncio.get_running_loop().run_in_executor(
+                    None, partial(self.resolver, domain, domain_i18n, self.timeout)
+                ),
+                self.timeout
+            )
+        except EmailUndeliverableError as e:
+            self.cache.set(domain, str(e), ttl=self.negative_ttl)
+            return str(e)
+        except asyncio.TimeoutError:
+            answer = {"unknown-deliverability": "timeout"}
+        if "unknown-deliverability" in answer:
+            # Неизвестный результат не кэшируется: при следующей регистрации домен проверится заново
+            self.timeouts += 1
+            logger.warning('Не удалось проверить домен "%s": %s', domain, answer["unknown-deliverability"])
+            if self.fallback == "reject":
+                return f"Не удалось проверить почтовый домен {domain_i18n}, повторите попытку позже"
+            return True
+        self.cache.set(domain, True)
+        return True
+
+    def stats(self) -> Dict[str, float]:
+        return {**self.cache.stats(), "timeouts": self.timeouts, "in_flight": len(self._in_flight)}
+
+
+domain_checker = DomainDeliverabilityChecker(
+    LRUTTLCache(settings.email_cache_size, settings.email_cache_ttl),
+    settings.email_dns_timeout,
+    settings.email_dns_fallback,
+    settings.email_cache_negative_ttl
+)
+
+
+async def check_deliverability(email: str) -> None:
+    if settings.email_check_deliverability:
+        await domain_checker.check(email)
+
+
+async def find_undeliverable(emails: Iterable[str]) -> Dict[str, str]:
+    """Проверяет адреса пачкой: по одному DNS-запросу на домен, возвращает {email: ошибка} для отклоненных."""
+    if not settings.email_check_deliverability:
+        return {}
+    emails = list(set(emails))
+    checks = await asyncio.gather(*(domain_checker.check(email) for email in emails), return_exceptions=True)
+    return {email: error.detail for email, error in zip(emails, checks) if isinstance(error, HTTPException)}
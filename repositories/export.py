@@ -0,0 +1,50 @@
+import csv
+import io
+import json
+from typing import AsyncIterator, Callable, Dict, List, Mapping, Sequence
+
+from fastapi.responses import StreamingResponse
+
+from db.database import ReadSessionLocal
+from repositories import crud
+from repositories.logs import logger
+
+EXPORT_MEDIA_TYPES: Dict[str, str] = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def to_ndjson(rows: List[Mapping]) -> str:
+    return "".join(json.dumps(dict(row), ensure_ascii=False) + "\n" for row in rows)
+
+
+def to_csv(rows: List[Mapping], header: Sequence[str] = ()) -> str:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    if header:
+        writer.writerow(header)
+    writer.writerows(row.values() for row in rows)
+    return buffer.getvalue()
+
+
+async def export_rows(
+        columns: Sequence, export_format: str, chunk_size: int, session_factory: Callable = ReadSessionLocal
+) -> AsyncIterator[bytes]:
+    # Ответ отправляется уже после выхода из обработчика, поэтому выгрузка открывает собственную сессию
+    async with session_factory() as db:
+        if export_format == "csv":
+            # Заголовок уходит сразу, еще до первой порции строк
+            yield to_csv([], [column.key for column in columns]).encode()
+        exported = 0
+        async for rows in crud.stream_entries(columns, db, chunk_size):
+            exported += len(rows)
+            yield (to_csv(rows) if export_format == "csv" else to_ndjson(rows)).encode()
+    logger.info("Выгрузка завершена, строк: %s", exported)
+
+
+def export_response(
+        columns: Sequence, export_format: str, chunk_size: int, filename: str, session_factory: Callable = ReadSessionLocal
+) -> StreamingResponse:
+    return StreamingResponse(
+        export_rows(columns, export_format, chunk_size, session_factory),
+        media_type=EXPORT_MEDIA_TYPES[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{export_format}"'}
+    )
@@ -0,0 +1,69 @@
+import asyncio
+from typing import Callable, Dict, List, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy.exc import IntegrityError
+
+from config.settings import settings
+from db.database import AsyncSessionLocal
+from repositories.batching import GroupCommitter
+from repositories.crud.pets import create_pets
+from repositories.logs import logger
+from schemas.pets import PetBulkCreate, PetCreate
+
+
+class PetInsertBatcher(GroupCommitter):
+    """Групповая фиксация добавления питомцев.
+
+    Питомцы из параллельных запросов записываются одной транзакцией через crud.create_pets,
+    каждый вызывающий получает id своего питомца или свою ошибку. Если порцию отклонил уникальный
+    индекс, ее питомцы записываются по одному.
+    """
+
+    def __init__(self, max_delay: float, max_rows: int, session_factory: Callable = AsyncSessionLocal):
+        super().__init__(max_delay, max_rows)
+        self.session_factory = session_factory
+
+    async def submit(self, pet: PetCreate, user_id: int) -> int:
+        """Ставит питомца в очередь и возвращает его id после фиксации порции."""
+        return await super().submit(PetBulkCreate(**pet.dict(), owner_id=user_id))
+
+    async def _flush(self, batch: List[Tuple[PetBulkCreate, asyncio.Future]]) -> None:
+        try:
+            results = await self._create([pet for pet, _ in batch])
+        except IntegrityError:
+            # Параллельная вставка того же питомца отклонила всю порцию: питомцы записываются по одному,
+            # и ошибку получает только вызывающий с конфликтующей записью
+            for pet, result in batch:
+                try:
+                    item, = await self._create([pet])
+                except IntegrityError as e:
+                    if not result.done():
+                        result.set_exception(e)
+                    continue
+                self._resolve(result, item)
+            return
+        except Exception:
+            logger.exception("Ошибка групповой записи питомцев, порция из %s записей отклонена", len(batch))
+            raise
+        for (_, result), item in zip(batch, results):
+            self._resolve(result, item)
+
+    async def _create(self, pets: List[PetBulkCreate]) -> List[Dict]:
+        async with self.session_factory() as db:
+            return await create_pets(pets, db)
+
+    @staticmethod
+    def _resolve(result: asyncio.Future, item: Dict) -> None:
+        if result.done():
+            return
+        if item["status_code"] == 201:
+            result.set_result(item["id"])
+        else:
+            result.set_exception(HTTPException(status_code=item["status_code"], detail=item["detail"]))
+
+
+pet_insert_batcher = PetInsertBatcher(
+    settings.pet_group_commit_max_delay_ms / 1000,
+    settings.pet_group_commit_max_rows
+)
@@ -1,19 +1,66 @@
-import logging.config
-from os import path, remove
+import atexit
+import copy
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import SimpleQueue
+from random import random
 
+from config.settings import settings
 
-if path.isfile("../python_logging.log"):
-    remove("../python_logging.log")
 
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
+class SamplingFilter(logging.Filter):
+    """Пропускает долю sample_rate сообщений ниже WARNING, предупреждения и ошибки - всегда."""
 
-logger_handler = logging.FileHandler("../python_logging.log")
-logger_handler.setLevel(logging.DEBUG)
+    def __init__(self, sample_rate: float):
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or random() < self.sample_rate
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на сообщение для сборщиков структурированных логов."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "message": record.getMessage(),
+            "file": record.filename,
+            "line": record.lineno
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
 
-logger_formatter = logging.Formatter('%(asctime)s  %(levelname)-8s %(message)s (%(filename)s:%(lineno)d)')
-logger_handler.setFormatter(logger_formatter)
 
-logger.addHandler(logger_handler)
+class DeferredQueueHandler(QueueHandler):
+    """Кладет в очередь копию записи без форматирования: сообщение собирает обработчик в потоке QueueListener."""
 
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Очередь живет в том же процессе, поэтому args и exc_info не нужно сводить к строкам заранее
+        return copy.copy(record)
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(settings.log_level)
+if settings.log_sample_rate < 1:
+    logger.addFilter(SamplingFilter(settings.log_sample_rate))
+
+# Обработчики запросов только кладут запись в очередь, форматирование и запись в файл
+# выполняет фоновый поток QueueListener
+logger_handler = RotatingFileHandler(settings.log_file, maxBytes=settings.log_max_bytes,
+                                     backupCount=settings.log_backup_count, encoding="utf-8", delay=True)
+if settings.log_json:
+    logger_formatter = JsonFormatter()
+else:
+    logger_formatter = logging.Formatter('%(asctime)s  %(levelname)-8s %(message)s (%(filename)s:%(lineno)d)')
+logger_handler.setFormatter(logger_formatter)
 
+log_queue = SimpleQueue()
+logger.addHandler(DeferredQueueHandler(log_queue))
+logger_listener = QueueListener(log_queue, logger_handler, respect_handler_level=True)
+logger_listener.start()
+atexit.register(logger_listener.stop)
@@ -0,0 +1,124 @@
+"""Служебные команды для базы данных.
+
+Запуск из каталога tests (пути к базе в настройках заданы относительно него):
+    PYTHONPATH=.. python -m repositories.maintenance repair-pet-counts
+    PYTHONPATH=.. python -m repositories.maintenance move-owner-pets --owner 15 --shard 2
+    PYTHONPATH=.. python -m repositories.maintenance rebalance-pet-shards [--shards N]
+
+Команды переноса питомцев между шардами выполняются при остановленном приложении: запущенные
+процессы кэшируют шард владельца и продолжили бы писать в прежнее хранилище.
+"""
+import argparse
+import asyncio
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import select
+
+from db.database import AsyncSessionLocal, async_engine, engine
+from db.schema import prepare_database
+from db.shards import pet_shards
+from models.users import UserModel
+from repositories import crud
+
+
+async def repair_pet_counts(args) -> None:
+    async with AsyncSessionLocal() as db:
+        repaired = await crud.repair_pet_counts(db)
+    print(f"Исправлено пользователей: {repaired}")
+
+
+async def move_owner_pets(args) -> None:
+    async with AsyncSessionLocal() as db:
+        moved = await crud.move_owner_pets(args.owner, args.shard, db)
+    print(f"Перенесено питомцев: {moved}")
+
+
+def plan_rebalance(owners: List[Tuple[int, Optional[int], int]], shards: int) -> Dict[int, int]:
+    """Переносы {id владельца: шард}, выравнивающие число питомцев в шардах 0..shards-1.
+
+    owners - (id, текущий шард, число питомцев). Владельцы из основной базы и из шардов с номером
+    не меньше shards переносятся все, начиная с крупных, в наименее загруженный шард. Затем из самого
+    загруженного шарда в наименее загруженный переносятся владельцы, пока перенос сокращает разницу между ними.
+    """
+    loads = [0] * shards
+    members = [set() for _ in range(shards)]
+    placement, homeless = {}, []
+    for owner_id, shard, pet_count in owners:
+        if shard is None or shard >= shards:
+            homeless.append((pet_count, owner_id))
+            continue
+        loads[shard] += pet_count
+        members[shard].add((pet_count, owner_id))
+        placement[owner_id] = shard
+    moves = {}
+
+    def move(owner: Tuple[int, int], source: Optional[int], target: int) -> None:
+        if source is not None:
+            loads[source] -= owner[0]
+            members[source].discard(owner)
+        loads[target] += owner[0]
+        members[target].add(owner)
+        moves[owner[1]] = target
+
+    for owner in sorted(homeless, reverse=True):
+        move(owner, None, loads.index(min(loads)))
+    while True:
+        heavy, light = loads.index(max(loads)), loads.index(min(loads))
+        gap = loads[heavy] - loads[light]
+        # Перенос владельца с n питомцами сокращает разницу при 0 < n < gap, лучше всего - при n около gap / 2.
+        # Сумма квадратов загрузок при этом строго убывает, поэтому цикл конечен
+        candidates = [owner for owner in members[heavy] if 0 < owner[0] < gap]
+        if not candidates:
+            break
+        move(min(candidates, key=lambda owner: (abs(gap - 2 * owner[0]), owner[1])), heavy, light)
+    return {owner_id: target for owner_id, target in moves.items() if placement.get(owner_id) != target}
+
+
+async def rebalance_pet_shards(args) -> None:
+    shards = args.shards or len(pet_shards)
+    async with AsyncSessionLocal() as db:
+        purged = await crud.purge_stray_pets(db)
+        # План строится по счетчикам, поэтому сначала они сверяются с питомцами
+        await crud.repair_pet_counts(db)
+        owners = (await db.execute(select(UserModel.id, UserModel.pet_shard, UserModel.pet_count))).all()
+        moves = plan_rebalance(owners, shards)
+        moved = 0
+        for owner_id, target in moves.items():
+            moved += await crud.move_owner_pets(owner_id, target, db)
+    print(f"Удалено лишних копий питомцев: {purged}, перенесено владельцев: {len(moves)}, питомцев: {moved}")
+
+
+COMMANDS = {
+    "repair-pet-counts": repair_pet_counts,
+    "move-owner-pets": move_owner_pets,
+    "rebalance-pet-shards": rebalance_pet_shards
+}
+SHARD_COMMANDS = {"move-owner-pets", "rebalance-pet-shards"}
+
+
+async def main(args) -> None:
+    prepare_database(engine)
+    try:
+        await COMMANDS[args.command](args)
+    finally:
+        await async_engine.dispose()
+        await pet_shards.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Служебные команды магазина питомцев")
+    parser.add_argument("command", choices=sorted(COMMANDS))
+    parser.add_argument("--owner", type=int, help="move-owner-pets: id владельца")
+    parser.add_argument("--shard", type=int, help="move-owner-pets: номер шарда, без него - основная база")
+    parser.add_argument("--shards", type=int,
+                        help="rebalance-pet-shards: сколько первых шардов использовать, остальные освобождаются")
+    parsed = parser.parse_args()
+    if parsed.command in SHARD_COMMANDS and not pet_shards.enabled:
+        parser.error("шарды питомцев не настроены (pet_shard_urls)")
+    if parsed.command == "move-owner-pets" and parsed.owner is None:
+        parser.error("для move-owner-pets нужен --owner")
+    if parsed.shard is not None and not 0 <= parsed.shard < len(pet_shards):
+        parser.error(f"номер шарда должен быть от 0 до {len(pet_shards) - 1}")
+    if parsed.shards is not None and not 1 <= parsed.shards <= len(pet_shards):
+        parser.error(f"--shards должно быть от 1 до {len(pet_shards)}")
+    asyncio.run(main(parsed))
@@ -0,0 +1,130 @@
+from bisect import bisect_left
+from time import perf_counter
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+from fastapi.exceptions import RequestValidationError
+from fastapi.routing import APIRoute
+from starlette.exceptions import HTTPException
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Границы корзин гистограмм времени ответа и ожидания соединения, в секундах
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATUS_CLASSES = ("1xx", "2xx", "3xx", "4xx", "5xx")
+
+
+def _series(name: str, labels: str) -> str:
+    return f"{name}{{{labels}}}" if labels else name
+
+
+class Histogram:
+    """Гистограмма в формате Prometheus.
+
+    Значения обновляются только из потока событийного цикла, поэтому запись обходится без блокировок,
+    а накопительные суммы по корзинам считаются при выгрузке.
+    """
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name: str, labels: str) -> List[str]:
+        separator = "," if labels else ""
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}')
+        cumulative += self.counts[-1]
+        lines.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {cumulative}')
+        lines.append(f"{_series(name + '_sum', labels)} {self.sum}")
+        lines.append(f"{_series(name + '_count', labels)} {cumulative}")
+        return lines
+
+
+class RouteMetrics:
+    """Счетчики одного маршрута: ответы по классам статусов, время ответа и число запросов в обработке."""
+
+    def __init__(self, path: str, methods: Iterable[str]):
+        self.labels = f'route="{path}",method="{",".join(sorted(methods))}"'
+        self.responses = dict.fromkeys(STATUS_CLASSES, 0)
+        self.latency = Histogram()
+        self.in_progress = 0
+
+    def wrap(self, app: ASGIApp) -> ASGIApp:
+        async def instrumented(scope: Scope, receive: Receive, send: Send) -> None:
+            status_code = 500
+            started = perf_counter()
+            self.in_progress += 1
+
+            async def send_with_status(message: Message) -> None:
+                nonlocal status_code
+                if message["type"] == "http.response.start":
+                    status_code = message["status"]
+                await send(message)
+
+            try:
+                await app(scope, receive, send_with_status)
+            except HTTPException as e:
+                # Ответ на исключение формирует обработчик приложения уже за пределами маршрута
+                status_code = e.status_code
+                raise
+            except RequestValidationError:
+                status_code = 422
+                raise
+            finally:
+                self.in_progress -= 1
+                self.latency.observe(perf_counter() - started)
+                self.responses[STATUS_CLASSES[min(max(status_code // 100, 1), 5) - 1]] += 1
+        return instrumented
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.routes: List[RouteMetrics] = []
+        self.pool_checkout_wait = Histogram()
+        # Источники значений, снимаемых в момент выгрузки: функция возвращает {(имя метрики, метки): значение}
+        self.collectors: List[Callable[[], Dict[Tuple[str, str], float]]] = []
+
+    def instrument_routes(self, routes: Iterable) -> None:
+        """Оборачивает обработчики маршрутов FastAPI: метки маршрутов регистрируются один раз заранее."""
+        for route in routes:
+            if isinstance(route, APIRoute):
+                metrics = RouteMetrics(route.path_format, route.methods)
+                route.app = metrics.wrap(route.app)
+                self.routes.append(metrics)
+
+    def render(self) -> str:
+        lines = [
+            "# HELP http_requests_total Число обработанных запросов по маршрутам и классам статусов",
+            "# TYPE http_requests_total counter"
+        ]
+        for route in self.routes:
+            lines.extend(f'http_requests_total{{{route.labels},status="{status}"}} {count}'
+                         for status, count in route.responses.items())
+        lines += [
+            "# HELP http_request_duration_seconds Время обработки запроса",
+            "# TYPE http_request_duration_seconds histogram"
+        ]
+        for route in self.routes:
+            lines.extend(route.latency.samples("http_request_duration_seconds", route.labels))
+        lines += [
+            "# HELP http_requests_in_progress Запросы в обработке",
+            "# TYPE http_requests_in_progress gauge"
+        ]
+        lines.extend(f"http_requests_in_progress{{{route.labels}}} {route.in_progress}" for route in self.routes)
+        lines += [
+            "# HELP db_pool_checkout_wait_seconds Ожидание соединения из пула",
+            "# TYPE db_pool_checkout_wait_seconds histogram"
+        ]
+        lines.extend(self.pool_checkout_wait.samples("db_pool_checkout_wait_seconds", ""))
+        for collect in self.collectors:
+            for (name, labels), value in collect().items():
+                lines.append(f"{_series(name, labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
@@ -1,7 +1,69 @@
-from pydantic import validate_arguments
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+from typing import Iterator, Optional, Sequence, Tuple
 
+from fastapi import HTTPException
 
-@validate_arguments
-def encrypt_password(password: str) -> str:
-    return password + "abracadabra"
 
+def encode_cursor(last_id: int) -> str:
+    # Курсор непрозрачен для клиента: внутри лишь первичный ключ последней выданной записи
+    return urlsafe_b64encode(f"id:{last_id}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[int]:
+    if cursor is None:
+        return None
+    try:
+        prefix, _, last_id = urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode().partition(":")
+        if prefix != "id":
+            raise ValueError(cursor)
+        return int(last_id)
+    except (BinasciiError, UnicodeDecodeError, ValueError):
+        raise HTTPException(status_code=400, detail="Некорректный курсор")
+
+
+def encode_search_cursor(last_rank: float, last_id: int) -> str:
+    # Результаты поиска упорядочены по релевантности, поэтому курсор хранит и ее, и id последней записи
+    return urlsafe_b64encode(f"rank:{last_rank!r}:{last_id}".encode()).decode().rstrip("=")
+
+
+def decode_search_cursor(cursor: Optional[str]) -> Optional[Tuple[float, int]]:
+    if cursor is None:
+        return None
+    try:
+        prefix, last_rank, last_id = urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode().split(":")
+        if prefix != "rank":
+            raise ValueError(cursor)
+        return float(last_rank), int(last_id)
+    except (BinasciiError, UnicodeDecodeError, ValueError):
+        raise HTTPException(status_code=400, detail="Некорректный курсор")
+
+
+def encode_pet_count_cursor(last_pet_count: int, last_id: int) -> str:
+    return urlsafe_b64encode(f"pet_count:{last_pet_count}:{last_id}".encode()).decode().rstrip("=")
+
+
+def decode_pet_count_cursor(cursor: Optional[str]) -> Optional[Tuple[int, int]]:
+    if cursor is None:
+        return None
+    try:
+        prefix, last_pet_count, last_id = urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode().split(":")
+        if prefix != "pet_count":
+            raise ValueError(cursor)
+        return int(last_pet_count), int(last_id)
+    except (BinasciiError, UnicodeDecodeError, ValueError):
+        raise HTTPException(status_code=400, detail="Некорректный курсор")
+
+
+def fts_query(text: str, prefix: bool = True) -> str:
+    """Запрос FTS5 из пользовательской строки: каждое слово в кавычках (операторы FTS5 не действуют),
+    все слова обязательны, последнее при prefix=True ищется как начало слова."""
+    words = ['"' + word.replace('"', '""') + '"' for word in text.split()]
+    if words and prefix:
+        words[-1] += "*"
+    return " ".join(words)
+
+
+def chunked(items: Sequence, size: int) -> Iterator[Sequence]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
@@ -0,0 +1,117 @@
+import asyncio
+import hashlib
+import hmac
+import os
+from base64 import b64decode, b64encode
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+from config.settings import Settings, settings
+
+# Старый формат хранения пароля: пароль с добавленной строкой, без соли и стойкой функции.
+# Такие пароли принимаются при входе и сразу перехешируются
+LEGACY_SUFFIX = "abracadabra"
+SALT_SIZE = 16
+
+
+def _scrypt(password: bytes, salt: bytes, n: int, r: int, p: int) -> bytes:
+    # maxmem по умолчанию (32 МиБ) меньше, чем нужно scrypt при n = 2**15 и выше
+    return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p, maxmem=128 * n * r * p + 2 ** 20, dklen=32)
+
+
+def _pbkdf2_sha256(password: bytes, salt: bytes, iterations: int) -> bytes:
+    return hashlib.pbkdf2_hmac("sha256", password, salt, iterations)
+
+
+KDF = {"scrypt": _scrypt, "pbkdf2_sha256": _pbkdf2_sha256}
+
+
+def derive(algorithm: str, password: str, salt: bytes, params: Tuple[int, ...]) -> bytes:
+    """Вычисляет хеш пароля. Функция уровня модуля, чтобы ее можно было выполнять в пуле процессов."""
+    return KDF[algorithm](password.encode(), salt, *params)
+
+
+def encode_hash(algorithm: str, params: Tuple[int, ...], salt: bytes, digest: bytes) -> str:
+    # Формат: алгоритм$параметры через запятую$соль$хеш, соль и хеш в base64
+    return "$".join((algorithm, ",".join(map(str, params)), b64encode(salt).decode(), b64encode(digest).decode()))
+
+
+def decode_hash(hashed_password: str) -> Optional[Tuple[str, Tuple[int, ...], bytes, bytes]]:
+    """Разбирает сохраненный хеш, для паролей старого формата возвращает None."""
+    parts = hashed_password.split("$")
+    if len(parts) != 4 or parts[0] not in KDF:
+        return None
+    algorithm, params, salt, digest = parts
+    return algorithm, tuple(map(int, params.split(","))), b64decode(salt), b64decode(digest)
+
+
+class PasswordHasher:
+    """Хеширование и проверка паролей в пуле потоков или процессов.
+
+    scrypt и PBKDF2 из hashlib освобождают GIL на время вычисления, поэтому пула потоков достаточно,
+    чтобы событийный цикл продолжал обслуживать запросы. Число одновременных вычислений ограничено
+    размером пула, остальные ждут в очереди executor'а. Параметры стоимости хранятся вместе с хешем,
+    и после их изменения пароль перехешируется при следующем успешном входе.
+    """
+
+    def __init__(self, config: Settings = settings):
+        self.algorithm = config.password_hash_algorithm
+        if self.algorithm not in KDF:
+            raise ValueError(f"Неизвестный алгоритм хеширования паролей: {self.algorithm}")
+        self.params = {
+            "scrypt": (config.password_scrypt_n, config.password_scrypt_r, config.password_scrypt_p),
+            "pbkdf2_sha256": (config.password_pbkdf2_iterations,)
+        }[self.algorithm]
+        self.workers = config.password_hash_workers
+        self.executor_kind = config.password_hash_executor
+        self.in_flight = 0
+        self.rehashed = 0
+        self._executor: Optional[Executor] = None
+        # Хеш, с которым сравнивается пароль несуществующего пользователя: ответ занимает столько же времени,
+        # сколько для существующего, и не выдает зарегистрированные email
+        self._dummy_hash = encode_hash(self.algorithm, self.params, b"\0" * SALT_SIZE, b"")
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            if self.executor_kind == "process":
+                self._executor = ProcessPoolExecutor(self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="password-hasher")
+        return self._executor
+
+    async def _derive(self, algorithm: str, password: str, salt: bytes, params: Tuple[int, ...]) -> bytes:
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, derive, algorithm, password, salt, params
+            )
+        finally:
+            self.in_flight -= 1
+
+    async def hash(self, password: str) -> str:
+        salt = os.urandom(SALT_SIZE)
+        return encode_hash(self.algorithm, self.params, salt, await self._derive(self.algorithm, password, salt,
+                                                                                  self.params))
+
+    async def verify(self, password: str, hashed_password: Optional[str]) -> bool:
+        decoded = decode_hash(hashed_password or self._dummy_hash)
+        if decoded is None:
+            return hmac.compare_digest(hashed_password.encode(), (password + LEGACY_SUFFIX).encode())
+        algorithm, params, salt, digest = decoded
+        return hmac.compare_digest(await self._derive(algorithm, password, salt, params), digest)
+
+    def needs_rehash(self, hashed_password: str) -> bool:
+        decoded = decode_hash(hashed_password)
+        return decoded is None or decoded[:2] != (self.algorithm, self.params)
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def stats(self) -> Dict[str, float]:
+        return {"in_flight": self.in_flight, "rehashed": self.rehashed}
+
+
+password_hasher = PasswordHasher()
@@ -1,6 +1,57 @@
-from pydantic import BaseModel as PydanticBaseModel
+from typing import Generic, List, Optional, TypeVar
+from pydantic import BaseModel as PydanticBaseModel, Field
+from pydantic.generics import GenericModel
+
+ItemT = TypeVar("ItemT")
 
 
 class ModBaseModel(PydanticBaseModel):
     class Config:
         anystr_strip_whitespace = True
+
+
+class Page(GenericModel, Generic[ItemT]):
+    items: List[ItemT] = Field(..., title="Записи страницы")
+    next_cursor: Optional[str] = Field(None, title="Курсор следующей страницы, null - страница последняя")
+
+
+class BatchResult(GenericModel, Generic[ItemT]):
+    items: List[Optional[ItemT]] = Field(..., title="Записи в порядке id запроса, null - запись не найдена")
+    missing: List[int] = Field(..., title="id, которые не найдены")
+
+
+class BulkItemResult(PydanticBaseModel):
+    index: int = Field(..., title="Позиция записи в запросе")
+    status_code: int = Field(..., title="Код результата для записи")
+    detail: str = Field(..., title="Описание результата")
+    id: Optional[int] = Field(None, title="id созданной записи")
+
+
+class BulkResult(PydanticBaseModel):
+    created: int = Field(..., title="Сколько записей создано")
+    items: List[BulkItemResult] = Field(..., title="Результаты в порядке записей запроса")
+
+
+class Detail(PydanticBaseModel):
+    detail: str = Field(..., title="Описание результата")
+
+
+class DeletedPets(PydanticBaseModel):
+    pets: int = Field(..., title="Сколько питомцев удалено")
+
+
+class DeletedUsers(PydanticBaseModel):
+    users: int = Field(..., title="Сколько пользователей удалено")
+    pets: int = Field(..., title="Сколько питомцев удалено вместе с пользователями")
+
+
+class PetsDeleteResult(Detail):
+    deleted: DeletedPets
+
+
+class UsersDeleteResult(Detail):
+    deleted: DeletedUsers
+
+
+class Count(PydanticBaseModel):
+    count: int = Field(..., title="Число записей")
@@ -20,6 +20,10 @@ class PetCreate(PetBase):
     pass
 
 
+class PetBulkCreate(PetCreate):
+    owner_id: int = Field(..., title="Пользовательский id")
+
+
 class PetSchemas(PetBase):
     id: int
     owner_id: int
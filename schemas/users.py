@@ -1,9 +1,7 @@
-from typing import List
-from fastapi import HTTPException
+from typing import List, Optional
 from pydantic import Field, validator
-from email_validator import validate_email, EmailNotValidError, EmailSyntaxError, EMAIL_MAX_LENGTH
 
-from repositories.logs import logger
+from repositories.email_validation import check_syntax, normalize
 from schemas.base_schemas import ModBaseModel
 from schemas.pets import PetSchemas
 
@@ -15,20 +13,6 @@ class UserBase(ModBaseModel):
         example="example@mail.ru"
     )
 
-    @classmethod
-    @validator('email')
-    def check_email(cls, email):
-        if len(email) >= EMAIL_MAX_LENGTH:
-            logger.info(f'Введен слишком длинный email: "{email}", создание пользователя провалено')
-            raise HTTPException(status_code=422, detail="Введен слишком длинный email")
-        try:
-            valid = validate_email(email, check_deliverability=True)
-            email = valid.email
-            return email
-        except (EmailNotValidError, EmailSyntaxError) as e:
-            logger.info(f'Введен некорректный email: "{email}", создание пользователя провалено')
-            raise HTTPException(status_code=422, detail=str(e))
-
 
 class UserCreate(UserBase):
     password: str = Field(
@@ -37,10 +21,54 @@ class UserCreate(UserBase):
         example="example_password", min_length=8
     )
 
+    # Во время разбора запроса проверяется только синтаксис: доступность домена требует
+    # обращения к DNS и проверяется асинхронно в обработчике через email_validation.check_deliverability
+    @validator('email')
+    def check_email(cls, email):
+        return check_syntax(email)
+
 
-class UserSchemas(UserBase):
+class UserLogin(UserBase):
+    password: str = Field(..., title="Пароль", example="example_password")
+
+    # Email приводится к тому же виду, что и при регистрации; некорректный адрес просто не найдется
+    @validator('email')
+    def normalize_email(cls, email):
+        return normalize(email)
+
+
+class UserInfoSchemas(UserBase):
     id: int
-    pets: List[PetSchemas] = []
+    pet_count: int = Field(0, title="Число питомцев пользователя")
 
     class Config:
         orm_mode = True
+
+
+class UserSchemas(UserInfoSchemas):
+    pets: List[PetSchemas] = []
+
+
+class PetsPerOwner(ModBaseModel):
+    pets: int = Field(..., title="Число питомцев")
+    users: int = Field(..., title="Сколько пользователей имеют столько питомцев")
+
+
+class TopOwner(ModBaseModel):
+    owner_id: int
+    pets: int
+
+
+class TopAnimalName(ModBaseModel):
+    animal_name: Optional[str]
+    pets: int
+
+
+class UsersStats(ModBaseModel):
+    users: int = Field(..., title="Число пользователей")
+    pets: int = Field(..., title="Число питомцев")
+    owners: int = Field(..., title="Пользователи, у которых есть питомцы")
+    average_pets_per_user: float
+    pets_per_owner: List[PetsPerOwner] = Field(..., title="Распределение пользователей по числу питомцев")
+    top_owners: List[TopOwner] = Field(..., title="Пользователи с наибольшим числом питомцев")
+    top_animal_names: List[TopAnimalName] = Field(..., title="Самые частые клички")
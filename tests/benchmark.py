@@ -0,0 +1,405 @@
+"""Нагрузочное тестирование API.
+
+Заполняет отдельную базу SQLite заданным числом пользователей и питомцев, прогоняет все методы
+api/users.py и api/pets.py внутри процесса (TestClient) и через локальный uvicorn с параллельными
+клиентами и сохраняет p50/p95/p99, запросы в секунду и число SQL-запросов на запрос в JSON.
+При указании эталона (--baseline) результаты сравниваются с ним, и при деградации больше
+--threshold скрипт завершается с кодом 1.
+
+Запуск из каталога tests:
+    PYTHONPATH=.. python benchmark.py --users 100000 --pets 1000000 --output bench.json
+    PYTHONPATH=.. python benchmark.py --baseline bench.json --threshold 0.2
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from statistics import quantiles
+from typing import Callable, Dict, List, NamedTuple
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочное тестирование API магазина питомцев")
+    parser.add_argument("--db", default="../benchmark_db.db", help="Файл базы данных для тестирования")
+    parser.add_argument("--users", type=int, default=10000, help="Сколько пользователей создать в базе")
+    parser.add_argument("--pets", type=int, default=100000, help="Сколько питомцев создать в базе")
+    parser.add_argument("--requests", type=int, default=200, help="Запросов на каждый метод")
+    parser.add_argument("--concurrency", type=int, default=8, help="Число параллельных клиентов")
+    parser.add_argument("--mode", choices=["inprocess", "uvicorn", "both"], default="both")
+    parser.add_argument("--port", type=int, default=8016)
+    parser.add_argument("--only", nargs="+", help="Замерить только сценарии, в названии которых есть подстрока")
+    parser.add_argument("--no-read-cache", action="store_true", help="Отключить кэш чтения")
+    parser.add_argument("--group-commit", action="store_true", help="Групповая запись POST /pet/{user_id}/")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="Распределить питомцев по стольким базам SQLite рядом с --db (pet_shard_urls)")
+    parser.add_argument("--delete-all", action="store_true",
+                        help="Замерить и DELETE /users/ (база заполняется заново перед следующим режимом)")
+    parser.add_argument("--output", help="Куда сохранить результаты в формате JSON")
+    parser.add_argument("--baseline", help="Результаты предыдущего запуска для сравнения")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Допустимая деградация p95 и запросов в секунду относительно эталона")
+    return parser.parse_args()
+
+
+ARGS = parse_args() if __name__ == "__main__" else None
+if ARGS:
+    # Настройки читаются при импорте приложения, поэтому задаются до него
+    db_path = os.path.abspath(ARGS.db)
+    os.environ["PETS_STORE_DATABASE_URL"] = f"sqlite:///{db_path}"
+    os.environ["PETS_STORE_ASYNC_DATABASE_URL"] = f"sqlite+aiosqlite:///{db_path}"
+    os.environ["PETS_STORE_EMAIL_CHECK_DELIVERABILITY"] = "false"
+    os.environ.setdefault("PETS_STORE_LOG_LEVEL", "WARNING")
+    # Стоимость хеширования паролей замеряет benchmark_passwords.py, здесь она снижена,
+    # чтобы массовая регистрация измеряла работу с базой
+    os.environ.setdefault("PETS_STORE_PASSWORD_SCRYPT_N", "1024")
+    if ARGS.no_read_cache:
+        os.environ["PETS_STORE_READ_CACHE_ENABLED"] = "false"
+    if ARGS.group_commit:
+        os.environ["PETS_STORE_PET_GROUP_COMMIT_ENABLED"] = "true"
+    if ARGS.shards:
+        os.environ["PETS_STORE_PET_SHARD_URLS"] = json.dumps(
+            [f"sqlite+aiosqlite:///{db_path}.shard{shard}" for shard in range(ARGS.shards)]
+        )
+
+import requests
+import uvicorn
+from fastapi.testclient import TestClient
+from sqlalchemy import bindparam, event, func, insert, select, text, update
+
+from api.main import app
+from db.database import async_engine, engine, read_engine
+from db.schema import prepare_database
+from db.shards import pet_shards
+from models.pets import PetIdSequenceModel, PetModel
+from models.users import UserModel
+from repositories.passwords import password_hasher
+
+SEED_PASSWORD = "benchmark_password"
+
+
+class Scenario(NamedTuple):
+    name: str
+    method: str
+    # Функция от генератора случайных чисел, возвращает (url, json тела или None[, заголовки])
+    request: Callable
+    expected_status: int = 200
+    # Ограничение числа запросов для тяжелых методов (выгрузка всей таблицы), 0 - без ограничения
+    max_requests: int = 0
+
+
+class StatementCounter:
+    """Считает SQL-запросы, выполненные асинхронными движками приложения (пулы записи и чтения, шарды питомцев)."""
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+        for counted_engine in {async_engine, read_engine, *pet_shards.engines, *pet_shards.read_engines}:
+            event.listen(counted_engine.sync_engine, "before_cursor_execute", self._count)
+
+    def _count(self, *_):
+        with self._lock:
+            self.value += 1
+
+
+# Подготовка данных
+def seed(users: int, pets: int, chunk_size: int = 50000) -> None:
+    prepare_database(engine)
+    # С шардами питомцы владельца записываются в шард, за которым он закреплен, а основная база хранит
+    # только пользователей и последовательность id питомцев
+    pet_engines = pet_shards.sync_engines() or [engine]
+    with engine.begin() as connection:
+        existing_users = connection.execute(select(func.count()).select_from(UserModel)).scalar()
+    existing_pets = 0
+    for pet_engine in pet_engines:
+        with pet_engine.begin() as connection:
+            existing_pets += connection.execute(select(func.count()).select_from(PetModel)).scalar()
+    if existing_users >= users and existing_pets >= pets:
+        print(f"База уже заполнена: пользователей {existing_users}, питомцев {existing_pets}")
+        return
+    started = time.perf_counter()
+    # Один хеш на всех: вычислять его для каждого из тысяч пользователей слишком долго
+    hashed_password = asyncio.run(password_hasher.hash(SEED_PASSWORD))
+    with engine.begin() as connection:
+        connection.execute(PetModel.__table__.delete())
+        connection.execute(UserModel.__table__.delete())
+        for start in range(1, users + 1, chunk_size):
+            connection.execute(insert(UserModel), [
+                {"id": i, "email": f"seed_{i}@mail.ru", "hashed_password": hashed_password,
+                 "pet_shard": pet_shards.default_shard(i) if pet_shards.enabled else None}
+                for i in range(start, min(start + chunk_size, users + 1))
+            ])
+    for shard, pet_engine in enumerate(pet_engines):
+        with pet_engine.begin() as connection:
+            if pet_engine is not engine:
+                connection.execute(PetModel.__table__.delete())
+            for start in range(1, pets + 1, chunk_size):
+                rows = [
+                    {"id": i, "animal_name": f"seed_pet_{i}", "description": "Заполнение базы для тестирования",
+                     "owner_id": i % users + 1}
+                    for i in range(start, min(start + chunk_size, pets + 1))
+                ]
+                if pet_shards.enabled:
+                    rows = [row for row in rows if pet_shards.default_shard(row["owner_id"]) == shard]
+                if rows:
+                    connection.execute(insert(PetModel), rows)
+        if pet_engine is not engine:
+            pet_engine.dispose()
+    with engine.begin() as connection:
+        if pet_shards.enabled:
+            pet_counts = Counter(i % users + 1 for i in range(1, pets + 1))
+            connection.execute(
+                update(UserModel).where(UserModel.id == bindparam("user_id")).values(pet_count=bindparam("pets")),
+                [{"user_id": user_id, "pets": number} for user_id, number in pet_counts.items()]
+            )
+            connection.execute(update(PetIdSequenceModel).values(next_id=pets + 1))
+        else:
+            connection.execute(text(
+                "UPDATE users SET pet_count = (SELECT count(*) FROM pets WHERE pets.owner_id = users.id)"
+            ))
+    print(f"База заполнена за {time.perf_counter() - started:.1f} с: пользователей {users}, питомцев {pets}")
+
+
+def create_targets(call: Callable, users: int, pets_per_user: int) -> Dict[str, List]:
+    """Создает записи, которые удаляют и изменяют сценарии, чтобы не трогать заполненную базу."""
+    tag = uuid.uuid4().hex[:8]
+    created_users = []
+    for start in range(0, users, 500):
+        response = call("POST", "/users/bulk", [
+            {"email": f"target_{tag}_{i}@mail.ru", "password": "benchmark_password"}
+            for i in range(start, min(start + 500, users))
+        ])
+        created_users.extend(item["id"] for item in response.json()["items"])
+    created_pets = []
+    for start in range(0, len(created_users), 500):
+        response = call("POST", "/pets/bulk", [
+            {"owner_id": owner_id, "animal_name": f"target_{tag}_{n}", "description": None}
+            for owner_id in created_users[start:start + 500] for n in range(pets_per_user)
+        ])
+        created_pets.extend(
+            (item["id"], created_users[start + item["index"] // pets_per_user]) for item in response.json()["items"]
+        )
+    return {"users": created_users, "pets": created_pets}
+
+
+def build_scenarios(users: int, pets: int, targets: Dict[str, List]) -> List[Scenario]:
+    tag = uuid.uuid4().hex[:8]
+    counter = iter(range(10 ** 9))
+    # Email меняется только у созданных для прогона пользователей: заполненные входят в POST /user/login
+    # и должны сохранять свои email между прогонами
+    email_targets = targets["users"][:len(targets["users"]) // 2]
+    user_targets = iter(email_targets)
+    owners_for_pet_deletion = iter(targets["users"][len(targets["users"]) // 2:])
+    pet_targets = iter(pet for pet in targets["pets"] if pet[1] in set(targets["users"][:len(targets["users"]) // 2]))
+
+    def random_user(rng):
+        return rng.randint(1, users)
+
+    def random_pet(rng):
+        pet_id = rng.randint(1, pets)
+        return pet_id, pet_id % users + 1
+
+    return [
+        Scenario("POST /user/", "POST",
+                 lambda rng: ("/user/", {"email": f"bench_{tag}_{next(counter)}@mail.ru",
+                                         "password": "benchmark_password"})),
+        Scenario("POST /users/bulk", "POST",
+                 lambda rng: ("/users/bulk", [{"email": f"bench_{tag}_{next(counter)}@mail.ru",
+                                               "password": "benchmark_password"} for _ in range(100)])),
+        Scenario("POST /user/login", "POST",
+                 lambda rng: ("/user/login", {"email": f"seed_{random_user(rng)}@mail.ru", "password": SEED_PASSWORD})),
+        Scenario("GET /users/", "GET", lambda rng: ("/users/?limit=100", None)),
+        Scenario("GET /users/ without pets", "GET", lambda rng: ("/users/?limit=100&include_pets=false", None)),
+        Scenario("GET /users/ by pet count", "GET", lambda rng: ("/users/?limit=100&order_by=pet_count", None)),
+        Scenario("GET /users/count", "GET", lambda rng: ("/users/count", None)),
+        Scenario("GET /users/stats", "GET", lambda rng: ("/users/stats", None)),
+        Scenario("GET /users/batch", "GET",
+                 lambda rng: ("/users/batch?" + "&".join(f"ids={random_user(rng)}" for _ in range(50)), None)),
+        Scenario("GET /users/export", "GET", lambda rng: ("/users/export", None), max_requests=5),
+        Scenario("GET /user/{user_id}/", "GET", lambda rng: (f"/user/{random_user(rng)}/", None)),
+        # Повторный опрос без изменений: "*" совпадает с любой версией, проверка идет тем же путем, что и по ETag
+        Scenario("GET /user/{user_id}/ not modified", "GET",
+                 lambda rng: (f"/user/{random_user(rng)}/", None, {"If-None-Match": "*"}), expected_status=304),
+        Scenario("PUT /user/{user_id}/", "PUT",
+                 lambda rng: (f"/user/{rng.choice(email_targets)}/?new_email=bench_{tag}_{next(counter)}@mail.ru",
+                              None)),
+        Scenario("POST /pet/{user_id}/", "POST",
+                 lambda rng: (f"/pet/{random_user(rng)}/", {"animal_name": f"bench_{tag}_{next(counter)}",
+                                                            "description": "Тестовый питомец"})),
+        Scenario("POST /pets/bulk", "POST",
+                 lambda rng: ("/pets/bulk", [{"owner_id": random_user(rng), "animal_name": f"bench_{tag}_{next(counter)}",
+                                              "description": None} for _ in range(100)])),
+        Scenario("GET /pet/", "GET", lambda rng: ("/pet/?pet_id={}&owner_id={}".format(*random_pet(rng)), None)),
+        Scenario("GET /pets/{user_id}/", "GET", lambda rng: (f"/pets/{random_user(rng)}/", None)),
+        Scenario("GET /pets/{user_id}/ not modified", "GET",
+                 lambda rng: (f"/pets/{random_user(rng)}/", None, {"If-None-Match": "*"}), expected_status=304),
+        Scenario("GET /pets/", "GET", lambda rng: ("/pets/?limit=100", None)),
+        Scenario("GET /pets/count", "GET", lambda rng: (f"/pets/count?owner_id={random_user(rng)}", None)),
+        Scenario("GET /pets/batch", "GET",
+                 lambda rng: ("/pets/batch?" + "&".join(f"ids={random_pet(rng)[0]}" for _ in range(50)), None)),
+        Scenario("GET /pets/search", "GET",
+                 lambda rng: (f"/pets/search?q=seed_pet_{random_pet(rng)[0]}&limit=20&prefix=false", None)),
+        Scenario("GET /pets/export", "GET", lambda rng: ("/pets/export?format=csv", None), max_requests=5),
+        Scenario("PUT /pet/{pet_id}/{owner_id}/", "PUT",
+                 lambda rng: ("/pet/{}/{}/?new_animal_name=bench_{}_{}&new_description=changed".format(
+                     *random_pet(rng), tag, next(counter)), None)),
+        Scenario("DELETE /pet/{pet_id}/{owner_id}/", "DELETE",
+                 lambda rng: ("/pet/{}/{}/".format(*next(pet_targets)), None)),
+        Scenario("DELETE /pets/{owner_id}/", "DELETE", lambda rng: (f"/pets/{next(owners_for_pet_deletion)}/", None)),
+        Scenario("DELETE /user/{user_id}/", "DELETE", lambda rng: (f"/user/{next(user_targets)}/", None)),
+    ]
+
+
+# Прогон
+def run_scenario(call: Callable, scenario: Scenario, requests_number: int, concurrency: int,
+                 statements: StatementCounter) -> Dict:
+    rng = random.Random(scenario.name)
+    lock = threading.Lock()
+    if scenario.max_requests:
+        requests_number = min(requests_number, scenario.max_requests)
+    prepared = [scenario.request(rng) for _ in range(requests_number)]
+    latencies, errors = [], 0
+
+    def worker(item):
+        nonlocal errors
+        url, body, *headers = item
+        started = time.perf_counter()
+        response = call(scenario.method, url, body, *headers)
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            if response.status_code != scenario.expected_status:
+                errors += 1
+
+    statements_before = statements.value
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(worker, prepared))
+    wall_time = time.perf_counter() - started
+    percentiles = quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "p50_ms": percentiles[49] * 1000,
+        "p95_ms": percentiles[94] * 1000,
+        "p99_ms": percentiles[98] * 1000,
+        "rps": len(latencies) / wall_time,
+        "sql_per_request": (statements.value - statements_before) / len(latencies)
+    }
+
+
+def run_mode(call: Callable, args, statements: StatementCounter) -> Dict[str, Dict]:
+    targets = create_targets(call, args.requests * 2, 2)
+    results = {}
+    for scenario in build_scenarios(args.users, args.pets, targets):
+        if args.only and not any(part in scenario.name for part in args.only):
+            continue
+        results[scenario.name] = run_scenario(call, scenario, args.requests, args.concurrency, statements)
+        print_result(scenario.name, results[scenario.name])
+    if args.delete_all:
+        scenario = Scenario("DELETE /users/", "DELETE", lambda rng: ("/users/?chunk_size=10000", None))
+        results[scenario.name] = run_scenario(call, scenario, 1, 1, statements)
+        print_result(scenario.name, results[scenario.name])
+        seed(args.users, args.pets)
+    return results
+
+
+def in_process_caller(client: TestClient) -> Callable:
+    return lambda method, url, body=None, headers=None: client.request(method, url, json=body, headers=headers)
+
+
+class BackgroundServer:
+    """uvicorn в фоновом потоке того же процесса, чтобы считать SQL-запросы приложения."""
+
+    def __init__(self, port: int):
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+        self.server.install_signal_handlers = lambda: None
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.05)
+        return self
+
+    def __exit__(self, *_):
+        self.server.should_exit = True
+        self.thread.join()
+
+
+def http_caller(port: int) -> Callable:
+    local = threading.local()
+
+    def call(method, url, body=None, headers=None):
+        # У каждого клиентского потока свое keep-alive соединение
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        return local.session.request(method, f"http://127.0.0.1:{port}{url}", json=body, headers=headers)
+    return call
+
+
+# Отчет
+def print_result(name: str, result: Dict) -> None:
+    print(f"  {name:<36} p50 {result['p50_ms']:8.2f} мс  p95 {result['p95_ms']:8.2f} мс  "
+          f"p99 {result['p99_ms']:8.2f} мс  {result['rps']:8.1f} rps  "
+          f"SQL {result['sql_per_request']:5.1f}  ошибок {result['errors']}")
+
+
+def compare_with_baseline(results: Dict, baseline: Dict, threshold: float) -> List[str]:
+    regressions = []
+    for mode, scenarios in results["results"].items():
+        for name, result in scenarios.items():
+            reference = baseline.get("results", {}).get(mode, {}).get(name)
+            if not reference:
+                continue
+            if result["p95_ms"] > reference["p95_ms"] * (1 + threshold):
+                regressions.append(f"{mode} {name}: p95 {reference['p95_ms']:.2f} -> {result['p95_ms']:.2f} мс")
+            if result["rps"] < reference["rps"] * (1 - threshold):
+                regressions.append(f"{mode} {name}: rps {reference['rps']:.1f} -> {result['rps']:.1f}")
+            if result["sql_per_request"] > reference["sql_per_request"] + 0.5:
+                regressions.append(f"{mode} {name}: SQL на запрос {reference['sql_per_request']:.1f} -> "
+                                   f"{result['sql_per_request']:.1f}")
+            if result["errors"] > reference["errors"]:
+                regressions.append(f"{mode} {name}: ошибок {reference['errors']} -> {result['errors']}")
+    return regressions
+
+
+def main(args) -> int:
+    seed(args.users, args.pets)
+    statements = StatementCounter()
+    results = {"meta": {"users": args.users, "pets": args.pets, "requests": args.requests,
+                        "concurrency": args.concurrency, "read_cache": not args.no_read_cache, "shards": args.shards,
+                        "python": sys.version.split()[0], "started_at": time.strftime("%Y-%m-%dT%H:%M:%S")},
+               "results": {}}
+    if args.mode in ("inprocess", "both"):
+        print("Внутри процесса (TestClient):")
+        # Внутри with все запросы из потоков клиентов выполняются в одном событийном цикле TestClient,
+        # как в рабочем процессе uvicorn: соединения пулов привязаны к циклу, в котором созданы.
+        # При выходе приложение закрывает соединения в том же цикле (событие shutdown)
+        with TestClient(app) as client:
+            results["results"]["inprocess"] = run_mode(in_process_caller(client), args, statements)
+    if args.mode in ("uvicorn", "both"):
+        print(f"Через uvicorn на порту {args.port}:")
+        with BackgroundServer(args.port):
+            results["results"]["uvicorn"] = run_mode(http_caller(args.port), args, statements)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(results, output, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline:
+            regressions = compare_with_baseline(results, json.load(baseline), args.threshold)
+        for regression in regressions:
+            print("Деградация:", regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(ARGS))
@@ -0,0 +1,68 @@
+"""Отзывчивость событийного цикла при всплеске регистраций.
+
+Запуск из каталога tests:
+    PYTHONPATH=.. python benchmark_passwords.py --hashes 200 --concurrency 50
+
+Одновременно с хешированием паролей работает проба, которая каждые --interval мс засыпает
+и измеряет, насколько позже положенного цикл вернул ей управление. Сравниваются хеширование
+прямо в событийном цикле (как делалось бы в create_user без пула) и через PasswordHasher.
+"""
+import argparse
+import asyncio
+import os
+from statistics import quantiles
+from time import perf_counter
+
+from repositories.passwords import PasswordHasher, SALT_SIZE, derive
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Задержка событийного цикла при хешировании паролей")
+    parser.add_argument("--hashes", type=int, default=200, help="Сколько паролей захешировать")
+    parser.add_argument("--concurrency", type=int, default=50, help="Одновременных регистраций")
+    parser.add_argument("--interval", type=float, default=5, help="Период пробы событийного цикла, мс")
+    return parser.parse_args()
+
+
+async def probe(interval: float, lags: list, stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        started = perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(perf_counter() - started - interval)
+
+
+async def run(name: str, hash_password, args) -> None:
+    lags, stop = [], asyncio.Event()
+    probe_task = asyncio.ensure_future(probe(args.interval / 1000, lags, stop))
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def signup(number: int) -> None:
+        async with semaphore:
+            await hash_password(f"benchmark_password_{number}")
+
+    started = perf_counter()
+    await asyncio.gather(*(signup(number) for number in range(args.hashes)))
+    wall_time = perf_counter() - started
+    stop.set()
+    await probe_task
+    lags = [lag * 1000 for lag in lags] or [0.0]
+    percentiles = quantiles(lags, n=100) if len(lags) > 1 else lags * 99
+    print(f"  {name:<28} {args.hashes / wall_time:8.1f} хешей/с  задержка цикла: p50 {percentiles[49]:8.2f} мс  "
+          f"p99 {percentiles[98]:8.2f} мс  max {max(lags):8.2f} мс  проб {len(lags)}")
+
+
+def main(args) -> None:
+    hasher = PasswordHasher()
+    print(f"Алгоритм {hasher.algorithm}, параметры {hasher.params}, исполнителей {hasher.workers} "
+          f"({hasher.executor_kind})")
+
+    async def inline(password: str) -> None:
+        derive(hasher.algorithm, password, os.urandom(SALT_SIZE), hasher.params)
+
+    asyncio.run(run("в событийном цикле", inline, args))
+    asyncio.run(run("PasswordHasher", hasher.hash, args))
+    hasher.close()
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -1,11 +1,120 @@
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+# Тесты не должны зависеть от DNS: доступность доменов проверяется отдельным тестом с подменой резолвера
+os.environ.setdefault("PETS_STORE_EMAIL_CHECK_DELIVERABILITY", "false")
+
+from email_validator import EmailUndeliverableError
+from fastapi import HTTPException, Request
 from fastapi.testclient import TestClient
 
-from api.main import app
-from repositories.logs import logger
+from sqlalchemy import event, text, update
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from api.dependencies import read_session_factory
+from api.main import app, close_db_connections
+from main import prestart
+from config.settings import settings
+from db.database import AsyncSessionLocal, Base, ReadSessionLocal, async_engine, engine, make_engine
+from db.instrumentation import QueryStats, current_query_stats, install_sql_instrumentation
+from db.schema import prepare_database
+from models.users import UserModel
+from schemas.pets import PetCreate
+from schemas.users import UserCreate
+from repositories import crud
+from repositories.cache import LRUTTLCache, ReadThroughCache, read_cache
+from repositories.email_validation import DomainDeliverabilityChecker, domain_checker
+from repositories.group_commit import pet_insert_batcher
+from repositories.passwords import password_hasher
+from repositories.logs import JsonFormatter, SamplingFilter, logger
 
 client = TestClient(app)
 
 
+def assert_max_queries(response, max_queries):
+    # Число SQL-запросов берется из заголовка Server-Timing, который добавляет SQLTimingMiddleware
+    timing = response.headers["server-timing"]
+    queries = int(timing.split('queries=', 1)[1].split('"', 1)[0])
+    assert queries <= max_queries, f"{response.request.method} {response.request.url}: {queries} > {max_queries}"
+
+
+# Тестирование журналирования
+def formatting_log_records_as_json():
+    record = logging.LogRecord("test", logging.INFO, "test_main.py", 1, 'Пользователь c email: "%s"', ("a@mail.ru",),
+                               None)
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry["level"] == "INFO"
+    assert entry["message"] == 'Пользователь c email: "a@mail.ru"'
+
+
+def sampling_log_records():
+    no_debug = SamplingFilter(0)
+    assert not no_debug.filter(logging.LogRecord("test", logging.INFO, "", 1, "", (), None))
+    assert no_debug.filter(logging.LogRecord("test", logging.WARNING, "", 1, "", (), None))
+
+
+# Тестирование запуска
+def measuring_startup_time(max_seconds=10):
+    # Импорт приложения в чистом процессе, как в рабочем процессе uvicorn: база не затрагивается,
+    # а сервер и модули подготовки базы не загружаются
+    code = ("import json, sys, time\n"
+            "started = time.perf_counter()\n"
+            "import api.main\n"
+            "print(json.dumps({'seconds': time.perf_counter() - started, 'modules': sorted(sys.modules)}))")
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, "startup.db")
+        env = {**os.environ, "PETS_STORE_DATABASE_URL": f"sqlite:///{db_path}",
+               "PETS_STORE_ASYNC_DATABASE_URL": f"sqlite+aiosqlite:///{db_path}"}
+        result = json.loads(subprocess.run([sys.executable, "-c", code], env=env, capture_output=True,
+                                           check=True, text=True).stdout)
+        assert not os.path.exists(db_path)
+    assert not {"uvicorn", "db.schema"} & set(result["modules"])
+    assert result["seconds"] < max_seconds
+    logger.info("Импорт приложения занял %.3f с", result["seconds"])
+
+
+# Тестирование обновления базы, созданной без уникального индекса питомцев
+def adding_unique_pet_index_to_old_database():
+    with tempfile.TemporaryDirectory() as directory:
+        old_engine = make_engine(f"sqlite:///{directory}/old.db")
+        try:
+            Base.metadata.create_all(bind=old_engine)
+            with old_engine.begin() as connection:
+                connection.execute(text("DROP INDEX ix_pets_owner_animal_description"))
+                connection.execute(text("INSERT INTO users (id, email, hashed_password, pet_count) "
+                                        "VALUES (1, 'old@mail.ru', 'hash', 4)"))
+                for animal_name, description in [("Кот", None), ("Кот", None), ("Кот", "рыжий"), ("Кот", None)]:
+                    connection.execute(text("INSERT INTO pets (animal_name, description, owner_id) "
+                                            "VALUES (:animal_name, :description, 1)"),
+                                       {"animal_name": animal_name, "description": description})
+            prepare_database(old_engine)
+            with old_engine.begin() as connection:
+                assert connection.execute(text("SELECT id FROM pets ORDER BY id")).scalars().all() == [1, 3]
+                assert connection.execute(text("SELECT pet_count FROM users")).scalar() == 2
+            try:
+                with old_engine.begin() as connection:
+                    connection.execute(text("INSERT INTO pets (animal_name, owner_id) VALUES ('Кот', 1)"))
+            except IntegrityError:
+                pass
+            else:
+                raise AssertionError("Уникальный индекс питомцев не создан")
+        finally:
+            old_engine.dispose()
+
+
+# Тестирование шардов питомцев
+def sharding_pets():
+    # Шарды задаются настройками при импорте приложения, поэтому сценарий выполняется в отдельном процессе
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_shards.py")
+    subprocess.run([sys.executable, script], check=True, cwd=os.path.dirname(script))
+
+
 # POST
 # Тестирование метода create_user
 def test_creating_new_original_user(sequential_number, email, password):
@@ -16,6 +125,7 @@ def test_creating_new_original_user(sequential_number, email, password):
     assert response.status_code == 200
     assert response.json() == {"email": email,
                                "id": sequential_number,
+                               "pet_count": 0,
                                "pets": []}
 
 
@@ -25,6 +135,56 @@ def test_creating_user_with_an_email_that_already_exists_in_the_db(email, passwo
     assert response.json() == {"detail": 'Пользователь с таким email уже зарегистрирован'}
 
 
+def creating_user_with_invalid_email(email, password):
+    response = client.post("/user/", json={"email": email, "password": password})
+    assert response.status_code == 422
+
+
+# Тестирование проверки доступности почтовых доменов
+def checking_email_domains_with_cache():
+    lookups = []
+
+    def fake_resolver(domain, domain_i18n, timeout):
+        lookups.append(domain)
+        if domain == "slow.ru":
+            time.sleep(timeout * 2)
+        if domain == "missing.ru":
+            raise EmailUndeliverableError(f"The domain name {domain} does not exist.")
+        return {"mx": [(10, f"mx.{domain}")]}
+
+    async def check(checker, email):
+        try:
+            await checker.check(email)
+            return True
+        except HTTPException as e:
+            assert e.status_code == 422
+            return False
+
+    async def scenario():
+        checker = DomainDeliverabilityChecker(LRUTTLCache(), timeout=0.05, resolver=fake_resolver)
+        # одновременные проверки одного домена объединяются в один DNS-запрос
+        assert await asyncio.gather(*(check(checker, f"user_{i}@mail.ru") for i in range(10))) == [True] * 10
+        assert await check(checker, "other@mail.ru")
+        # отрицательный результат тоже кэшируется
+        assert not await check(checker, "user@missing.ru")
+        assert not await check(checker, "other@missing.ru")
+        # разбор запроса не зависит от кэша: недоступный домен отклоняет обработчик, в bulk - только свой элемент
+        domain_checker.cache.set("missing.ru", "The domain name missing.ru does not exist.")
+        try:
+            assert UserCreate(email="other@missing.ru", password="password").email == "other@missing.ru"
+        finally:
+            domain_checker.cache.delete("missing.ru")
+        # медленный DNS: регистрация проходит по синтаксису, результат не кэшируется
+        assert await check(checker, "user@slow.ru")
+        checker.fallback = "reject"
+        assert not await check(checker, "user@slow.ru")
+        return checker.stats()
+
+    stats = asyncio.run(scenario())
+    assert lookups.count("mail.ru") == 1 and lookups.count("missing.ru") == 1 and lookups.count("slow.ru") == 2
+    assert stats["hits"] == 2 and stats["timeouts"] == 2
+
+
 # Тестирование метода create_pet_for_user
 def creating_new_pet_for_user(user_id, animal_name, description):
     response = client.post(f"/pet/{user_id}/", json={"animal_name": animal_name, "description": description})
@@ -44,25 +204,204 @@ def creating_pet_with_pre_existing_name_and_description(user_id, animal_name, de
     assert response.json() == {"detail": f"У пользователя с id {user_id} уже есть питомец с такой кличкой и описанием"}
 
 
+# Тестирование метода create_users
+def creating_users_in_bulk(users, expected_status_codes):
+    response = client.post("/users/bulk", json=users)
+    assert response.status_code == 200
+    result = response.json()
+    assert [item["status_code"] for item in result["items"]] == expected_status_codes
+    assert result["created"] == expected_status_codes.count(201)
+    return [item["id"] for item in result["items"]]
+
+
+def creating_too_many_users_in_bulk(number_of_users):
+    users = [{"email": f"bulk_{i}@mail.ru", "password": "test_password"} for i in range(number_of_users)]
+    response = client.post("/users/bulk", json=users)
+    assert response.status_code == 422
+
+
+# Тестирование метода create_pets
+def creating_pets_in_bulk(pets, expected_status_codes):
+    response = client.post("/pets/bulk", json=pets)
+    assert response.status_code == 200
+    result = response.json()
+    assert [item["status_code"] for item in result["items"]] == expected_status_codes
+    assert result["created"] == expected_status_codes.count(201)
+    return [item["id"] for item in result["items"]]
+
+
+def creating_pets_with_group_commit(user_id):
+    # Одиночные запросы проходят через очередь с теми же ответами, параллельные записываются одной порцией
+    settings.pet_group_commit_enabled = True
+    try:
+        creating_new_pet_for_user(user_id, "group_animal", "group_description_1")
+        creating_pet_with_pre_existing_name_and_description(user_id, "group_animal", "group_description_1")
+        creating_pet_for_user_that_does_not_exist(99, "group_animal", "group_description_1")
+    finally:
+        settings.pet_group_commit_enabled = False
+
+    async def create_concurrently():
+        batches = pet_insert_batcher.batches
+        ids = await asyncio.gather(*(
+            pet_insert_batcher.submit(PetCreate(animal_name="group_animal", description=f"group_description_{i}"),
+                                      user_id)
+            for i in range(2, 5)
+        ))
+        assert pet_insert_batcher.batches == batches + 1
+        return ids
+
+    ids = asyncio.run(create_concurrently())
+    assert len(set(ids)) == 3
+    response = client.get("/pets/batch", params={"ids": ids})
+    assert [pet["owner_id"] for pet in response.json()["items"]] == [user_id] * 3
+
+
+def resolving_group_commit_conflicts(user_id):
+    # Тот же питомец вставляется параллельно после проверки дубликатов, перед вставкой порции:
+    # уникальный индекс отклоняет порцию, и ошибку получает только конфликтующий запрос
+    inserted = []
+
+    def insert_concurrently(connection, cursor, statement, *_):
+        if statement.startswith("INSERT INTO pets") and not inserted:
+            inserted.append(statement)
+            with engine.begin() as other:
+                other.execute(text("INSERT INTO pets (animal_name, description, owner_id) "
+                                   "VALUES ('race_animal', 'race_2', :owner_id)"), {"owner_id": user_id})
+                other.execute(text("UPDATE users SET pet_count = pet_count + 1 WHERE id = :owner_id"),
+                              {"owner_id": user_id})
+
+    async def create_concurrently():
+        return await asyncio.gather(*(
+            pet_insert_batcher.submit(PetCreate(animal_name="race_animal", description=f"race_{i}"), user_id)
+            for i in range(1, 4)
+        ), return_exceptions=True)
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", insert_concurrently)
+    try:
+        first, conflict, third = asyncio.run(create_concurrently())
+    finally:
+        event.remove(async_engine.sync_engine, "before_cursor_execute", insert_concurrently)
+    assert isinstance(first, int) and isinstance(third, int), (first, third)
+    assert isinstance(conflict, HTTPException) and conflict.status_code == 400, conflict
+    read_cache.clear()
+    for pet in client.get(f"/pets/{user_id}/").json():
+        if pet["animal_name"] == "race_animal":
+            deleting_pet(pet["id"], user_id)
+
+
+# Тестирование метода login_user
+def logging_in(email, password, expected_id):
+    response = client.post("/user/login", json={"email": email, "password": password})
+    assert response.status_code == 200
+    assert response.json()["id"] == expected_id
+
+
+def logging_in_with_wrong_credentials(email, password):
+    response = client.post("/user/login", json={"email": email, "password": password})
+    assert response.status_code == 401
+    assert response.json() == {"detail": "Неверный email или пароль"}
+
+
+def rehashing_legacy_password_on_login(user_id, email, password):
+    # Пароль в старом формате принимается и сразу перехешируется с текущими параметрами
+    async def stored_hash(new_hash=None):
+        async with AsyncSessionLocal() as db:
+            if new_hash:
+                await db.execute(update(UserModel).where(UserModel.id == user_id).values(hashed_password=new_hash))
+                await db.commit()
+            return (await db.get(UserModel, user_id)).hashed_password
+
+    asyncio.run(stored_hash(password + "abracadabra"))
+    logging_in(email, password, user_id)
+    hashed_password = asyncio.run(stored_hash())
+    assert hashed_password.startswith(f"{settings.password_hash_algorithm}$") and password not in hashed_password
+    assert not password_hasher.needs_rehash(hashed_password)
+
+
 # GET
 # Тестирование метода show_users
-def displaying_all_users_when_db_is_not_empty(skip=0, limit=100):
-    response = client.get(f"/users/?skip={skip}&limit={limit}")
+def displaying_all_users_when_db_is_not_empty(limit=100):
+    response = client.get(f"/users/?limit={limit}")
     assert response.status_code == 200
 
 
-def displaying_all_users_when_db_is_empty(skip=0, limit=100):
-    response = client.get(f"/users/?skip={skip}&limit={limit}")
+def displaying_all_users_when_db_is_empty(limit=100):
+    response = client.get(f"/users/?limit={limit}")
     assert response.status_code == 404
     assert response.json() == {"detail": "База данных пользователей пуста"}
 
 
+def displaying_all_users_without_pets(limit=100):
+    response = client.get(f"/users/?limit={limit}&include_pets=false")
+    assert response.status_code == 200
+    assert all("pets" not in user for user in response.json()["items"])
+
+
+def displaying_users_page_by_page(expected_ids, limit=1):
+    # Обходим все страницы по next_cursor и сверяем порядок и полноту выдачи
+    ids, cursor = [], None
+    while True:
+        response = client.get("/users/", params={"limit": limit, "cursor": cursor} if cursor else {"limit": limit})
+        assert response.status_code == 200
+        page = response.json()
+        assert len(page["items"]) <= limit
+        ids.extend(user["id"] for user in page["items"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert ids == expected_ids
+
+
+def displaying_users_with_invalid_cursor():
+    response = client.get("/users/?cursor=not-a-cursor")
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Некорректный курсор"}
+
+
 # Тестирование метода show_user
 def display_an_existing_user(user_id):
     response = client.get(f"/user/{user_id}")
     assert response.status_code == 200
 
 
+def display_an_existing_user_without_pets(user_id, email, pet_count):
+    response = client.get(f"/user/{user_id}/?include_pets=false")
+    assert response.status_code == 200
+    assert response.json() == {"email": email, "id": user_id, "pet_count": pet_count}
+
+
+def display_user_after_change_from_cache(user_id, email, pet_count):
+    # Повторное чтение отдается из кэша, а изменение email должно его сбросить
+    hits = read_cache.stats()["hits"]
+    expected = {"email": email, "id": user_id, "pet_count": pet_count}
+    response = client.get(f"/user/{user_id}/?include_pets=false")
+    assert response.status_code == 200
+    assert response.json() == expected
+    assert client.get(f"/user/{user_id}/?include_pets=false").json() == expected
+    assert read_cache.stats()["hits"] > hits or not read_cache.enabled
+
+
+
+def caching_replica_reads_separately():
+    # Запись меняет email, а отстающая реплика еще отдает старый
+    cache = ReadThroughCache(LRUTTLCache(), LRUTTLCache(), replica_lag=60)
+    primary, replica = {"email": "old@mail.ru"}, {"email": "old@mail.ru"}
+
+    def read(source, from_replica=False):
+        return asyncio.run(cache.read_through(("user", 1), [("owner", 1)], lambda: asyncio.sleep(0, dict(source)),
+                                              replica=from_replica))
+    assert read(replica, True) == read(primary) == {"email": "old@mail.ru"}
+    primary["email"] = "new@mail.ru"
+    cache.invalidate(("owner", 1))
+    # Прочитанное из реплики сразу после инвалидации не сохраняется и не выдается читающим из основной базы
+    assert read(replica, True) == {"email": "old@mail.ru"}
+    assert read(primary) == {"email": "new@mail.ru"}
+    replica["email"] = "new@mail.ru"
+    assert read(replica, True) == {"email": "new@mail.ru"}
+    primary["email"] = replica["email"] = "newer@mail.ru"
+    assert read(primary) == {"email": "new@mail.ru"}
+
+
 def display_non_existent_user(user_id):
     response = client.get(f"/user/{user_id}")
     assert response.status_code == 404
@@ -91,6 +430,18 @@ def display_all_pets_of_user(user_id):
     assert response.status_code == 200
 
 
+def displaying_pets_in_id_order(user_id):
+    # Клички идут в обратном порядке: питомцы выдаются по возрастанию id, а не в порядке индекса по кличке
+    for animal_name in ["zz_order_animal", "aa_order_animal"]:
+        creating_new_pet_for_user(user_id, animal_name, None)
+    pets = client.get(f"/pets/{user_id}/").json()
+    ids = [pet["id"] for pet in pets]
+    assert ids == sorted(ids)
+    assert [pet["id"] for pet in client.get(f"/user/{user_id}/").json()["pets"]] == ids
+    for pet in pets[-2:]:
+        deleting_pet(pet["id"], user_id)
+
+
 def display_all_pets_of_non_existent_user(user_id):
     response = client.get(f"/pets/{user_id}/")
     assert response.status_code == 404
@@ -99,17 +450,237 @@ def display_all_pets_of_non_existent_user(user_id):
 
 
 # Тестирование метода show_all_pets
-def display_all_pets_when_they_are(skip=0, limit=100):
-    response = client.get(f"/pets/?skip={skip}&limit={limit}")
+def display_all_pets_when_they_are(limit=100):
+    response = client.get(f"/pets/?limit={limit}")
     assert response.status_code == 200
+    assert response.json()["next_cursor"] is None
 
 
-def display_all_pets_when_there_are_none(skip=0, limit=100):
-    response = client.get(f"/pets/?skip={skip}&limit={limit}")
+def display_all_pets_when_there_are_none(limit=100):
+    response = client.get(f"/pets/?limit={limit}")
     assert response.status_code == 404
     assert response.json() == {"detail": "База данных питомцев пуста"}
 
 
+# Тестирование подсчета и статистики
+def counting_users_and_pets(number_of_users, number_of_pets, pets_of_user=None):
+    assert client.get("/users/count").json() == {"count": number_of_users}
+    assert client.get("/pets/count").json() == {"count": number_of_pets}
+    if pets_of_user:
+        user_id, number = pets_of_user
+        assert client.get(f"/pets/count?owner_id={user_id}").json() == {"count": number}
+
+
+def displaying_users_stats(expected_pets_per_owner, expected_top_owner):
+    response = client.get("/users/stats?top=1")
+    assert response.status_code == 200
+    stats = response.json()
+    assert stats["pets_per_owner"] == expected_pets_per_owner
+    assert stats["top_owners"] == [expected_top_owner]
+    assert stats["pets"] == sum(item["pets"] * item["users"] for item in expected_pets_per_owner)
+
+
+# Тестирование счетчика питомцев
+def displaying_users_by_pet_count(expected):
+    # expected - [(id, pet_count)] по убыванию числа питомцев, обход по одной записи на страницу
+    users, cursor = [], None
+    while True:
+        params = {"order_by": "pet_count", "limit": 1, "include_pets": False}
+        response = client.get("/users/", params={**params, "cursor": cursor} if cursor else params)
+        assert response.status_code == 200
+        users.extend((user["id"], user["pet_count"]) for user in response.json()["items"])
+        cursor = response.json()["next_cursor"]
+        if cursor is None:
+            break
+    assert users == expected
+
+
+def repairing_pet_counts(user_id):
+    async def scenario():
+        async with AsyncSessionLocal() as db:
+            await db.execute(update(UserModel).where(UserModel.id == user_id).values(pet_count=100))
+            await db.commit()
+            assert await crud.repair_pet_counts(db) == 1
+            assert await crud.repair_pet_counts(db) == 0
+
+    asyncio.run(scenario())
+
+
+# Тестирование методов show_users_by_ids и show_pets_by_ids
+def displaying_users_by_ids(ids, expected_missing):
+    response = client.get("/users/batch", params={"ids": ids})
+    assert response.status_code == 200
+    result = response.json()
+    assert [user and user["id"] for user in result["items"]] == [None if i in expected_missing else i for i in ids]
+    assert result["missing"] == expected_missing
+    assert all("pets" in user for user in result["items"] if user)
+
+
+def displaying_pets_by_ids(ids, expected_missing, **params):
+    response = client.get("/pets/batch", params={"ids": ids, **params})
+    assert response.status_code == 200
+    result = response.json()
+    assert [pet and pet["id"] for pet in result["items"]] == [None if i in expected_missing else i for i in ids]
+    assert result["missing"] == expected_missing
+
+
+# Тестирование метода search_pets
+def searching_pets(query, expected_ids, **params):
+    response = client.get("/pets/search", params={"q": query, **params})
+    assert response.status_code == 200
+    assert sorted(pet["id"] for pet in response.json()["items"]) == expected_ids
+
+
+def searching_pets_page_by_page(query, expected_ids):
+    ids, cursor = [], None
+    while True:
+        response = client.get("/pets/search", params={"q": query, "limit": 1, **({"cursor": cursor} if cursor else {})})
+        assert response.status_code == 200
+        ids.extend(pet["id"] for pet in response.json()["items"])
+        cursor = response.json()["next_cursor"]
+        if cursor is None:
+            break
+    assert sorted(ids) == expected_ids
+
+
+# Тестирование выгрузки таблиц
+def exporting_users_as_ndjson(expected_emails):
+    response = client.get("/users/export")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert [json.loads(line)["email"] for line in response.text.splitlines()] == expected_emails
+
+
+def exporting_pets_as_csv(number_of_pets):
+    response = client.get("/pets/export?format=csv")
+    assert response.status_code == 200
+    lines = response.text.splitlines()
+    assert lines[0] == "id,animal_name,description,owner_id"
+    assert len(lines) == number_of_pets + 1
+
+
+# Тестирование учета SQL-запросов
+def counting_sql_queries_per_endpoint(user_id, pet_id):
+    # Кэш чтения отключается, чтобы считались запросы к базе, а не попадания в кэш
+    read_cache.enabled, cache_enabled = False, read_cache.enabled
+    try:
+        assert_max_queries(client.get(f"/user/{user_id}/"), 1)
+        assert_max_queries(client.get(f"/user/{user_id}/?include_pets=false"), 1)
+        assert_max_queries(client.get("/users/"), 2)
+        assert_max_queries(client.get(f"/pet/?pet_id={pet_id}&owner_id={user_id}"), 1)
+        # версия хозяина для ETag читается отдельно от питомцев
+        assert_max_queries(client.get(f"/pets/{user_id}/"), 2)
+        assert_max_queries(client.get("/pets/"), 1)
+    finally:
+        read_cache.enabled = cache_enabled
+
+
+# Тестирование условных GET-запросов
+def answering_conditional_requests(user_id, pet_id):
+    for url in (f"/user/{user_id}/", f"/user/{user_id}/?include_pets=false", f"/pets/{user_id}/"):
+        response = client.get(url)
+        etag, last_modified = response.headers["etag"], response.headers["last-modified"]
+        not_modified = client.get(url, headers={"If-None-Match": etag})
+        assert not_modified.status_code == 304 and not_modified.content == b""
+        assert not_modified.headers["etag"] == etag
+        assert client.get(url, headers={"If-Modified-Since": last_modified}).status_code == 304
+        assert client.get(url, headers={"If-None-Match": '"stale"'}).status_code == 200
+    etags = [client.get(url).headers["etag"] for url in (f"/user/{user_id}/", f"/pets/{user_id}/")]
+    # изменение питомца меняет версию хозяина, и ответ отдается заново с новым ETag
+    pet = client.get(f"/pet/?pet_id={pet_id}&owner_id={user_id}").json()
+    client.put(f"/pet/{pet_id}/{user_id}/?new_animal_name=conditional&new_description=conditional")
+    client.put(f"/pet/{pet_id}/{user_id}/?new_animal_name={pet['animal_name']}&new_description={pet['description']}")
+    for url, etag in zip((f"/user/{user_id}/", f"/pets/{user_id}/"), etags):
+        response = client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 200 and response.headers["etag"] != etag
+
+
+def logging_slow_queries(user_id):
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    logger.addHandler(handler)
+    settings.slow_query_threshold_ms, threshold = 0, settings.slow_query_threshold_ms
+    read_cache.enabled, cache_enabled = False, read_cache.enabled
+    try:
+        client.get(f"/pets/{user_id}/")
+        client.post("/user/login", json={"email": "slow_query_secret@mail.ru", "password": "slow_query_secret"})
+    finally:
+        settings.slow_query_threshold_ms = threshold
+        read_cache.enabled = cache_enabled
+        logger.removeHandler(handler)
+    slow = [record.getMessage() for record in records if record.getMessage().startswith("Медленный SQL-запрос")]
+    assert any("SEARCH pets" in message for message in slow)
+    assert not any("slow_query_secret" in message for message in slow)
+
+
+
+def counting_failed_queries():
+    # Запрос, завершившийся ошибкой, учитывается в статистике и не оставляет следов в соединении пула
+    failing_engine = make_engine("sqlite://")
+    install_sql_instrumentation(failing_engine)
+    stats = QueryStats()
+    token = current_query_stats.set(stats)
+    try:
+        with failing_engine.connect() as connection:
+            for _ in range(3):
+                try:
+                    connection.execute(text("SELECT * FROM missing_table"))
+                except OperationalError:
+                    pass
+            connection.execute(text("SELECT 1"))
+            assert "query_started_at" not in connection.info
+    finally:
+        current_query_stats.reset(token)
+        failing_engine.dispose()
+    assert stats.count == 4, stats.count
+
+
+# Тестирование метрик
+def exporting_metrics(user_id):
+    series = 'http_requests_total{route="/user/{user_id}/",method="GET",status="2xx"}'
+
+    def requests_served():
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        return int(next(line for line in response.text.splitlines() if line.startswith(series)).split()[-1])
+
+    served = requests_served()
+    client.get(f"/user/{user_id}/")
+    assert requests_served() == served + 1
+    assert "db_pool_checkout_wait_seconds_count" in client.get("/metrics").text
+    assert 'db_pool_checked_out{pool="read"}' in client.get("/metrics").text
+
+
+# Тестирование пула чтения
+def reading_from_read_only_pool(user_id, email):
+    async def write_in_read_session():
+        async with ReadSessionLocal() as db:
+            await db.execute(update(UserModel).where(UserModel.id == user_id).values(email=email))
+
+    try:
+        asyncio.run(write_in_read_session())
+    except OperationalError as error:
+        assert "readonly" in str(error)
+    else:
+        raise AssertionError("Пул чтения разрешил запись")
+
+    def session_factory(headers=()):
+        return read_session_factory(Request({"type": "http", "headers": list(headers)}))
+    assert session_factory() is ReadSessionLocal
+    assert session_factory([(b"x-read-primary", b"1")]) is AsyncSessionLocal
+    assert session_factory([(b"cookie", b"read_primary=1")]) is AsyncSessionLocal
+    # С репликой после записи клиент на время переключается на чтение из основной базы
+    settings.read_database_url, read_database_url = "sqlite+aiosqlite:///replica.db", settings.read_database_url
+    try:
+        response = client.put(f"/user/{user_id}/?new_email={email}")
+    finally:
+        settings.read_database_url = read_database_url
+    assert response.status_code == 200 and response.cookies.get("read_primary") == "1"
+    client.cookies.clear()
+    assert client.get(f"/user/{user_id}/").json()["email"] == email
+
+
 # PUT
 # Тестирование метода change_user_by_id
 def changing_the_email_of_user_that_does_not_exist_in_db(user_id, new_email):
@@ -182,6 +753,8 @@ def deleting_non_existent_user(user_id):
 def deleting_user(user_id):
     response = client.delete(f"/user/{user_id}/")
     assert response.status_code == 200
+    # Счетчик питомцев удаляемого пользователя не пересчитывается
+    assert_max_queries(response, 2)
     assert {"detail": "Пользователь удален"}
 
 
@@ -206,10 +779,10 @@ def deleting_all_pets_from_the_user_by_wrong(user_id):
                       f"или такого пользователя не существует"}
 
 
-def deleting_all_pets_from_the_user(user_id):
+def deleting_all_pets_from_the_user(user_id, number_of_pets):
     response = client.delete(f"/pets/{user_id}/")
     assert response.status_code == 200
-    assert {"detail": "Все питомцы пользователя удалены"}
+    assert response.json() == {"detail": "Все питомцы пользователя удалены", "deleted": {"pets": number_of_pets}}
 
 
 # Тестирование метода delete_all_users
@@ -223,6 +796,15 @@ def deleting_all_users_in_db():
     response = client.delete("/users/")
     assert response.status_code == 200
     assert {"detail": "Все пользователи удалены"}
+    # Только два DELETE: счетчики питомцев удаляемых пользователей не пересчитываются
+    assert_max_queries(response, 2)
+
+
+def deleting_all_users_in_db_in_chunks(number_of_users, number_of_pets, chunk_size=1):
+    response = client.delete(f"/users/?chunk_size={chunk_size}")
+    assert response.status_code == 200
+    assert response.json() == {"detail": "Все пользователи удалены",
+                               "deleted": {"users": number_of_users, "pets": number_of_pets}}
 
 
 # Удаление всех пользователей
@@ -230,14 +812,31 @@ def deleting_all():
     response = client.delete("/users/")
 
 
+def closing_db_connections_on_failure(*exc_info):
+    # Иначе потоки соединений aiosqlite из пула не дадут процессу завершиться после упавшей проверки
+    asyncio.run(close_db_connections())
+    sys.__excepthook__(*exc_info)
+
+
 if __name__ == '__main__':
+    sys.excepthook = closing_db_connections_on_failure
     logger.info("Начато тестирование модуля main")
+    measuring_startup_time()
+    adding_unique_pet_index_to_old_database()
+    sharding_pets()
+    prestart()
+    formatting_log_records_as_json()
+    sampling_log_records()
     # полная очистка базы
     deleting_all()
     # создаем оригинального пользователя
     test_creating_new_original_user(1, "test_email_1@mail.ru", "test_password")
     # создаем пользователя с таким же email
     test_creating_user_with_an_email_that_already_exists_in_the_db("test_email_1@mail.ru", "test_password")
+    # создаем пользователя с некорректным email
+    creating_user_with_invalid_email("test_email", "test_password")
+    # проверяем кэш доступности почтовых доменов
+    checking_email_domains_with_cache()
     # создаем ему питомца
     creating_new_pet_for_user(1, "test_animal_name_1", "test_description_1")
     # создаем питомца с таким же описанием
@@ -264,10 +863,54 @@ if __name__ == '__main__':
     test_creating_new_original_user(2, "test_email_2@mail.ru", "test_password")
     # создаем питомца второму пользователю
     creating_new_pet_for_user(2, "test_animal_name_2", "test_description_2")
+    # питомцы без описания тоже не должны повторяться
+    creating_new_pet_for_user(2, "test_animal_name_3", None)
+    creating_pet_with_pre_existing_name_and_description(2, "test_animal_name_3", None)
+    # считаем пользователей и питомцев, получаем статистику
+    counting_users_and_pets(2, 4, (1, 2))
+    displaying_users_stats([{"pets": 2, "users": 2}], {"owner_id": 1, "pets": 2})
+    # получаем пользователей и питомцев списком id
+    displaying_users_by_ids([2, 99, 1, 2], [99])
+    # вход по паролю
+    logging_in("test_email_2@mail.ru", "test_password", 2)
+    logging_in_with_wrong_credentials("test_email_2@mail.ru", "wrong_password")
+    logging_in_with_wrong_credentials("nobody@mail.ru", "test_password")
+    rehashing_legacy_password_on_login(1, "test_email_1@mail.ru", "test_password")
+    displaying_pets_by_ids([4, 1, 77], [77])
+    displaying_pets_by_ids([1, 3], [3], owner_id=1)
+    # ищем питомцев по словам и началу слова
+    searching_pets("test_animal_name_2", [2, 3])
+    searching_pets("description 1", [1], prefix=False)
+    searching_pets("test_desc", [1, 2], owner_id=1)
+    searching_pets_page_by_page("test_animal", [1, 2, 3, 4])
     # получаем список всех питомцев в магазине
     display_all_pets_when_they_are()
+    # получаем список всех пользователей с питомцами и без них
+    displaying_all_users_when_db_is_not_empty()
+    displaying_all_users_without_pets()
+    # постранично обходим пользователей
+    displaying_users_page_by_page([1, 2])
+    displaying_users_with_invalid_cursor()
+    # выгружаем пользователей и питомцев потоком
+    exporting_users_as_ndjson(["test_email_1@mail.ru", "test_email_2@mail.ru"])
+    exporting_pets_as_csv(4)
+    # проверяем число SQL-запросов на чтение и журнал медленных запросов
+    counting_sql_queries_per_endpoint(1, 1)
+    logging_slow_queries(1)
+    counting_failed_queries()
+    # отвечаем 304 на условные запросы неизменившихся данных
+    answering_conditional_requests(1, 1)
+    # выгружаем метрики
+    exporting_metrics(1)
+    # GET-запросы читают из пула только для чтения
+    reading_from_read_only_pool(1, "test_email_1@mail.ru")
+    # получаем пользователя без питомцев
+    display_an_existing_user_without_pets(2, "test_email_2@mail.ru", 2)
     # первому пользователю меняем email
+    display_user_after_change_from_cache(1, "test_email_1@mail.ru", 2)
     change_email_to_user(1, "new_test_email_1@mail.ru")
+    display_user_after_change_from_cache(1, "new_test_email_1@mail.ru", 2)
+    caching_replica_reads_separately()
     # второму меняем email на такой же как у первого
     changing_the_user_email_to_an_existing_one_in_db(2, "new_test_email_1@mail.ru")
     # меняем почту несуществующему пользователю
@@ -281,9 +924,11 @@ if __name__ == '__main__':
     # редактируем описание питомца первого пользователя на такое же
     changing_pet_data_to_existing_ones_for_the_user(2, 1, "new_test_animal_name_1", "new_test_description_1")
     # удаляем всех питомцев первого пользователя
-    deleting_all_pets_from_the_user(1)
+    deleting_all_pets_from_the_user(1, 2)
     # удаляем питомца второго пользователя
     deleting_pet(3, 2)
+    # счетчики питомцев уменьшились вместе с удалением
+    displaying_users_by_pet_count([(2, 1), (1, 0)])
     # пытаемя удалить несуществующего питомца по id хозяина
     deleting_pet_for_wrong_id(77, 1)
     # пытаемся удалить питомца у несуществующего пользователя
@@ -304,6 +949,35 @@ if __name__ == '__main__':
     test_creating_new_original_user(1, "test_email_3@mail.ru", "test_password")
     # отображаем питомцев пользователя у которого нет питомцев
     display_all_pets_when_there_are_none(1)
-    # очищаем базу
-    deleting_all_users_in_db()
+    # создаем еще одного пользователя с питомцами
+    test_creating_new_original_user(2, "test_email_4@mail.ru", "test_password")
+    creating_new_pet_for_user(2, "test_animal_name_1", "test_description_1")
+    creating_new_pet_for_user(2, "test_animal_name_2", "test_description_2")
+    # массово создаем пользователей: второй повторяет email первого, третий уже зарегистрирован
+    bulk_user_ids = creating_users_in_bulk([{"email": "bulk_1@mail.ru", "password": "test_password"},
+                                            {"email": "bulk_1@mail.ru", "password": "test_password"},
+                                            {"email": "test_email_4@mail.ru", "password": "test_password"},
+                                            {"email": "bulk_2@mail.ru", "password": "test_password"}],
+                                           [201, 400, 400, 201])
+    assert bulk_user_ids == [3, None, None, 4]
+    creating_too_many_users_in_bulk(settings.bulk_max_items + 1)
+    # массово создаем питомцев: дубликат в запросе, уже существующий питомец и несуществующий хозяин
+    creating_pets_in_bulk([{"owner_id": 3, "animal_name": "bulk_animal", "description": None},
+                           {"owner_id": 3, "animal_name": "bulk_animal", "description": None},
+                           {"owner_id": 2, "animal_name": "test_animal_name_1", "description": "test_description_1"},
+                           {"owner_id": 99, "animal_name": "bulk_animal", "description": "bulk_description"},
+                           {"owner_id": 4, "animal_name": "bulk_animal", "description": "bulk_description"}],
+                          [201, 400, 400, 404, 201])
+    # пользователи по убыванию числа питомцев, сверка счетчиков с таблицей питомцев
+    displaying_users_by_pet_count([(2, 2), (4, 1), (3, 1), (1, 0)])
+    repairing_pet_counts(3)
+    # групповая запись питомцев
+    creating_pets_with_group_commit(1)
+    resolving_group_commit_conflicts(1)
+    displaying_users_by_pet_count([(1, 4), (2, 2), (4, 1), (3, 1)])
+    # питомцы пользователя выдаются по возрастанию id
+    displaying_pets_in_id_order(3)
+    # очищаем базу порциями по одной записи
+    deleting_all_users_in_db_in_chunks(4, 8)
+    asyncio.run(close_db_connections())
     logger.info("Тестирование модуля main успешно завершено")
@@ -0,0 +1,216 @@
+"""Сценарий работы с питомцами, распределенными по шардам.
+
+Шарды задаются настройками при импорте, поэтому сценарий выполняется в отдельном процессе
+со своими временными базами (его запускает test_main.py):
+    PYTHONPATH=.. python test_shards.py
+"""
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+
+directory = tempfile.mkdtemp(prefix="pets_shards_")
+SHARDS = 3
+os.environ.update({
+    "PETS_STORE_EMAIL_CHECK_DELIVERABILITY": "false",
+    "PETS_STORE_DATABASE_URL": f"sqlite:///{directory}/main.db",
+    "PETS_STORE_ASYNC_DATABASE_URL": f"sqlite+aiosqlite:///{directory}/main.db",
+    "PETS_STORE_PET_SHARD_URLS": json.dumps([f"sqlite+aiosqlite:///{directory}/shard_{shard}.db"
+                                             for shard in range(SHARDS)]),
+    "PETS_STORE_PET_ID_BLOCK_SIZE": "4"
+})
+
+from fastapi.testclient import TestClient
+from sqlalchemy import func, select, update
+
+from api.main import app, close_db_connections
+from db.database import AsyncSessionLocal
+from db.shards import pet_shards
+from main import prestart
+from models.pets import PetModel
+from models.users import UserModel
+from repositories import crud
+from repositories.maintenance import plan_rebalance
+
+client = TestClient(app)
+
+
+def run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+async def _pets_in_stores():
+    # {хранилище: число питомцев}, None - основная база
+    async with AsyncSessionLocal() as db:
+        counts = await crud.fetch_from_pet_stores(
+            db, lambda pets_db: pets_db.scalar(select(func.count()).select_from(PetModel))
+        )
+    return dict(zip(crud.pet_stores(), counts))
+
+
+async def _set_owner_shard(user_id, shard):
+    async with AsyncSessionLocal() as db:
+        await db.execute(update(UserModel).where(UserModel.id == user_id).values(pet_shard=shard))
+        await db.commit()
+    crud.invalidate_owner(user_id)
+
+
+def pet_count_of(user_id):
+    return client.get(f"/user/{user_id}/", params={"include_pets": False}).json()["pet_count"]
+
+
+def creating_users_in_shards(number_of_users):
+    for user_id in range(1, number_of_users + 1):
+        response = client.post("/user/", json={"email": f"owner{user_id}@mail.ru", "password": "password"})
+        assert response.json()["id"] == user_id
+    # Пользователь, созданный до включения шардов: его питомцы хранятся в основной базе
+    run(_set_owner_shard(number_of_users, None))
+
+
+def creating_pets_in_owner_shards(number_of_users, pets_per_user):
+    for user_id in range(1, number_of_users + 1):
+        for number in range(pets_per_user):
+            response = client.post(f"/pet/{user_id}/", json={"animal_name": f"Кот{number}", "description": "рыжий"})
+            assert response.status_code == 200, response.text
+    response = client.post("/pet/1/", json={"animal_name": "Кот0", "description": "рыжий"})
+    assert response.status_code == 400
+    expected = {shard: 0 for shard in crud.pet_stores()}
+    for user_id in range(1, number_of_users):
+        expected[pet_shards.default_shard(user_id)] += pets_per_user
+    expected[None] = pets_per_user
+    assert run(_pets_in_stores()) == expected
+    assert [pet_count_of(user_id) for user_id in range(1, number_of_users + 1)] == [pets_per_user] * number_of_users
+
+
+def creating_pets_in_bulk_across_shards(number_of_users):
+    pets = [{"animal_name": "Пес", "description": "черный", "owner_id": user_id}
+            for user_id in range(1, number_of_users + 1)]
+    response = client.post("/pets/bulk", json=pets + [pets[0], {**pets[0], "owner_id": 100}])
+    assert response.status_code == 200
+    assert [item["status_code"] for item in response.json()["items"]] == [201] * number_of_users + [400, 404]
+    return [item["id"] for item in response.json()["items"][:number_of_users]]
+
+
+def displaying_all_pets_across_shards(number_of_pets, limit):
+    ids, cursor = [], None
+    while True:
+        params = {"limit": limit} if cursor is None else {"limit": limit, "cursor": cursor}
+        page = client.get("/pets/", params=params).json()
+        ids += [pet["id"] for pet in page["items"]]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert ids == sorted(set(ids)) and len(ids) == number_of_pets
+    return ids
+
+
+def reading_pets_of_sharded_owner(user_id, pet_ids, pets_per_user):
+    user = client.get(f"/user/{user_id}/").json()
+    assert len(user["pets"]) == pets_per_user + 1 and all(pet["owner_id"] == user_id for pet in user["pets"])
+    pets = client.get(f"/pets/{user_id}/").json()
+    assert sorted(pet["id"] for pet in pets) == sorted(pet["id"] for pet in user["pets"])
+    pet_id = pets[0]["id"]
+    assert client.get("/pet/", params={"pet_id": pet_id, "owner_id": user_id}).json()["id"] == pet_id
+    assert client.get("/pets/count", params={"owner_id": user_id}).json() == {"count": pets_per_user + 1}
+    batch = client.get("/pets/batch", params={"ids": pet_ids + [10 ** 6]}).json()
+    assert [pet["id"] for pet in batch["items"][:-1]] == pet_ids and batch["missing"] == [10 ** 6]
+
+
+def searching_and_counting_across_shards(number_of_users, pets_per_user):
+    total = number_of_users * (pets_per_user + 1)
+    assert client.get("/pets/count").json() == {"count": total}
+    found = client.get("/pets/search", params={"q": "черн"}).json()
+    assert len(found["items"]) == number_of_users
+    pages, cursor = [], None
+    while True:
+        params = {"q": "рыж", "limit": 2} if cursor is None else {"q": "рыж", "limit": 2, "cursor": cursor}
+        page = client.get("/pets/search", params=params).json()
+        pages += [pet["id"] for pet in page["items"]]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert len(pages) == len(set(pages)) == number_of_users * pets_per_user
+    stats = client.get("/users/stats").json()
+    assert stats["pets"] == total
+    assert stats["top_animal_names"][0] == {"animal_name": "Кот0", "pets": number_of_users}
+    exported = client.get("/pets/export", params={"format": "csv"}).text.splitlines()
+    assert len(exported) == total + 1
+
+
+def changing_and_deleting_pets_in_shard(user_id):
+    pets = client.get(f"/pets/{user_id}/").json()
+    first, second = pets[0], pets[1]
+    response = client.put(f"/pet/{first['id']}/{user_id}/",
+                          params={"new_animal_name": second["animal_name"], "new_description": second["description"]})
+    assert response.status_code == 400
+    response = client.put(f"/pet/{first['id']}/{user_id}/",
+                          params={"new_animal_name": "Барсик", "new_description": "пушистый"})
+    assert response.status_code == 200
+    assert client.get("/pet/", params={"pet_id": first["id"], "owner_id": user_id}).json()["animal_name"] == "Барсик"
+    response = client.delete(f"/pet/{second['id']}/{user_id}/")
+    assert response.json()["deleted"] == {"pets": 1}
+    assert pet_count_of(user_id) == len(pets) - 1
+
+
+def moving_owner_between_shards(user_id, target):
+    async def move():
+        async with AsyncSessionLocal() as db:
+            moved = await crud.move_owner_pets(user_id, target, db)
+            return moved, await crud.get_owner_shard(user_id, db)
+    before = client.get(f"/pets/{user_id}/").json()
+    assert run(move()) == (len(before), target)
+    assert client.get(f"/pets/{user_id}/").json() == before
+    assert pet_count_of(user_id) == len(before)
+
+
+def planning_rebalance():
+    owners = [(1, 0, 10), (2, 0, 6), (3, 0, 4), (4, None, 5), (5, 2, 3)]
+    moves = plan_rebalance(owners, 2)
+    placement = {owner_id: moves.get(owner_id, shard) for owner_id, shard, _ in owners}
+    loads = [sum(pets for owner_id, _, pets in owners if placement[owner_id] == shard) for shard in range(2)]
+    assert set(placement.values()) == {0, 1} and abs(loads[0] - loads[1]) <= 2, (moves, loads)
+
+
+def repairing_counts_across_shards(user_id):
+    async def break_count():
+        async with AsyncSessionLocal() as db:
+            await db.execute(update(UserModel).where(UserModel.id == user_id).values(pet_count=100))
+            await db.commit()
+
+    async def repair():
+        async with AsyncSessionLocal() as db:
+            return await crud.repair_pet_counts(db)
+    expected = pet_count_of(user_id)
+    run(break_count())
+    assert run(repair()) == 1
+    assert pet_count_of(user_id) == expected
+
+
+def deleting_sharded_users(user_id, number_of_pets):
+    pets = len(client.get(f"/pets/{user_id}/").json())
+    assert client.delete(f"/user/{user_id}/").json()["deleted"] == {"users": 1, "pets": pets}
+    response = client.delete("/users/")
+    assert response.json()["deleted"]["pets"] == number_of_pets - pets
+    assert run(_pets_in_stores()) == {shard: 0 for shard in crud.pet_stores()}
+
+
+if __name__ == "__main__":
+    prestart()
+    try:
+        creating_users_in_shards(6)
+        creating_pets_in_owner_shards(6, 3)
+        bulk_ids = creating_pets_in_bulk_across_shards(6)
+        displaying_all_pets_across_shards(24, 5)
+        reading_pets_of_sharded_owner(1, bulk_ids, 3)
+        searching_and_counting_across_shards(6, 3)
+        changing_and_deleting_pets_in_shard(2)
+        moving_owner_between_shards(1, (pet_shards.default_shard(1) + 1) % SHARDS)
+        moving_owner_between_shards(6, 0)
+        moving_owner_between_shards(2, None)
+        planning_rebalance()
+        repairing_counts_across_shards(3)
+        deleting_sharded_users(3, 23)
+    finally:
+        run(close_db_connections())
+        shutil.rmtree(directory, ignore_errors=True)